@@ -34,11 +34,10 @@ import {
 import { AIService } from "@/lib/services/ai-service";
 import { ExportButton } from "@/components/ExportButton";
 import { 
-  getControllingAreaOptions, 
   getProjectTypeOptions, 
-  getFunctionalAreaOptions, 
   getProjectSpecOptions 
 } from "@/components/forms/WBSForm";
+import { getControllingAreaOptions, getFunctionalAreaOptions, useLookups } from "@/lib/services/lookups";
 
 // Status color mapping
 const statusColors: Record<RequestStatus, "default" | "secondary" | "warning" | "success" | "destructive"> = {
@@ -77,6 +76,7 @@ export default function RequestDetailPage({
   params: Promise<{ id: string }>;
 }) {
   const { id: requestId } = React.use(params);
+  useLookups();
 
   const { user } = useAuth();
   const router = useRouter();
@@ -198,6 +198,7 @@ export default function RequestDetailPage({
             <ExportButton 
               wbsData={data} 
               requestName={request.requestName}
+              requestType={request.requestType}
               submissionDate={
                 (() => {
                   const d = request.createdAt;
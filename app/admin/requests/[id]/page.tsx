@@ -37,11 +37,10 @@ import { AIService } from "@/lib/services/ai-service";
 import { AiButton } from "@/components/ui/ai-button";
 import { ExportButton } from "@/components/ExportButton";
 import {
-  getControllingAreaOptions,
   getProjectTypeOptions,
-  getFunctionalAreaOptions,
   getProjectSpecOptions,
 } from "@/components/forms/WBSForm";
+import { getControllingAreaOptions, getFunctionalAreaOptions, useLookups } from "@/lib/services/lookups";
 
 // Type guard for WBS data
 function isWBSRow(wbs: unknown): wbs is StoredWBSData {
@@ -81,6 +80,7 @@ export default function AdminRequestDetailPage({
   params: Promise<{ id: string }>;
 }) {
   const { id: requestId } = React.use(params);
+  useLookups();
   const { user } = useAuth();
   const router = useRouter();
   const [request, setRequest] = useState<Request | null>(null);
@@ -385,6 +385,8 @@ export default function AdminRequestDetailPage({
             <ExportButton 
               wbsData={wbsData} 
               requestName={request.requestName}
+              requestType={request.requestType}
+              requestId={request.id}
               submissionDate={(() => {
                 const d = request.createdAt;
                 let dateObj;
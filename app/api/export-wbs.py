@@ -1,13 +1,20 @@
 from fastapi import FastAPI, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
-import openpyxl
 import os
-import tempfile
 import json
 from fastapi.responses import StreamingResponse
 import io
 import sys
 
+# Share the template registry, cache and column mapping with the service in the repository root
+ROOT_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..'))
+if ROOT_DIR not in sys.path:
+    sys.path.insert(0, ROOT_DIR)
+from fill_excel_template import get_template
+from template_cache import template_cache
+from template_registry import template_layout
+from wbs_columns import WBS_ROWS
+
 app = FastAPI()
 
 app.add_middleware(
@@ -19,124 +26,31 @@ app.add_middleware(
 )
 
 def fill_excel_template(template_path, output_path, wbs_data):
-    wb = openpyxl.load_workbook(template_path, keep_vba=True)
-    ws = wb['Shared Template']
-    start_row = 18
-    ws['D7'] = wbs_data[0].get('requesterDisplayName', '') if wbs_data else ''
-    ws['D8'] = wbs_data[0].get('responsiblePerson', '') if wbs_data else ''
-    # Helper to write integer if possible
-    def write_int(ws, row, col, value):
-        try:
-            if value is not None and value != '':
-                ws.cell(row=row, column=col, value=int(value))
-            else:
-                ws.cell(row=row, column=col, value=value)
-        except Exception:
-            ws.cell(row=row, column=col, value=value)
-
-    for i, element in enumerate(wbs_data):
-        row = start_row + i
-        ws.cell(row=row, column=1, value=element.get('regionLabel', ''))
-        ws.cell(row=row, column=2, value=element.get('type', ''))
-        ws.cell(row=row, column=3, value=element.get('system', 'KIS'))
-        ws.cell(row=row, column=4, value=element.get('controllingAreaLabel', element.get('controllingArea', '')))
-        write_int(ws, row, 5, element.get('companyCode', ''))
-        ws.cell(row=row, column=6, value=element.get('projectName', ''))
-        ws.cell(row=row, column=7, value=element.get('projectDefinition', ''))
-        write_int(ws, row, 8, element.get('level', ''))
-        ws.cell(row=row, column=9, value=element.get('projectType', ''))
-        write_int(ws, row, 10, element.get('investmentProfile', ''))
-        write_int(ws, row, 11, element.get('responsibleProfitCenter', ''))
-        write_int(ws, row, 12, element.get('responsibleCostCenter', ''))
-        ws.cell(row=row, column=13, value='x' if element.get('planningElement') else '')
-        ws.cell(row=row, column=14, value='x' if element.get('rubricElement') else '')
-        ws.cell(row=row, column=15, value='x' if element.get('billingElement') else '')
-        percent = element.get('settlementRulePercent', '')
-        if percent not in ('', None):
-            try:
-                ws.cell(row=row, column=16, value=float(percent) / 100)
-            except Exception:
-                ws.cell(row=row, column=16, value=percent)
-        else:
-            ws.cell(row=row, column=16, value='')
-        ws.cell(row=row, column=17, value=element.get('settlementRuleGoal', ''))
-        ws.cell(row=row, column=18, value=element.get('projectProfile', ''))
-        ws.cell(row=row, column=19, value=element.get('responsiblePerson', ''))
-        ws.cell(row=row, column=20, value=element.get('userId', ''))
-        ws.cell(row=row, column=21, value=element.get('employmentNumber', ''))
-        ws.cell(row=row, column=22, value=element.get('functionalArea', ''))
-        ws.cell(row=row, column=24, value=element.get('comment', ''))
-        ws.cell(row=row, column=25, value=element.get('tm1Project', ''))
-        ws.cell(row=row, column=26, value=element.get('tgPhase', ''))
-        ws.cell(row=row, column=27, value=element.get('projectSpec', ''))
-        ws.cell(row=row, column=28, value=element.get('motherCode', ''))
-    wb.save(output_path)
+    layout = template_layout(template_path)
+    with template_cache.checkout(template_path) as wb:
+        ws = wb[layout.sheet_name]
+        for (row, column), value in layout.header_values(wbs_data).items():
+            ws.cell(row=row, column=column, value=value)
+        WBS_ROWS.write_openpyxl(ws, layout.start_row, WBS_ROWS.iter_rows(wbs_data))
+        wb.save(output_path)
 
 @app.post("/export")
 async def export_excel(payload: dict):
     wbs_data = payload.get("wbsData", [])
     try:
-        template_path = os.path.join(os.path.dirname(__file__), 'templates', 'wbs_template_actual.xlsm')
-        wb = openpyxl.load_workbook(template_path, keep_vba=True)
-        ws = wb['Shared Template']
-        start_row = 18
-        ws['D7'] = wbs_data[0].get('requesterDisplayName', '') if wbs_data else ''
-        ws['D8'] = wbs_data[0].get('responsiblePerson', '') if wbs_data else ''
-        # Helper to write integer if possible
-        def write_int(ws, row, col, value):
-            try:
-                if value is not None and value != '':
-                    ws.cell(row=row, column=col, value=int(value))
-                else:
-                    ws.cell(row=row, column=col, value=value)
-            except Exception:
-                ws.cell(row=row, column=col, value=value)
-
-        for i, element in enumerate(wbs_data):
-            row = start_row + i
-            ws.cell(row=row, column=1, value=element.get('regionLabel', ''))
-            ws.cell(row=row, column=2, value=element.get('type', ''))
-            ws.cell(row=row, column=3, value=element.get('system', 'KIS'))
-            ws.cell(row=row, column=4, value=element.get('controllingAreaLabel', element.get('controllingArea', '')))
-            write_int(ws, row, 5, element.get('companyCode', ''))
-            ws.cell(row=row, column=6, value=element.get('projectName', ''))
-            ws.cell(row=row, column=7, value=element.get('projectDefinition', ''))
-            write_int(ws, row, 8, element.get('level', ''))
-            ws.cell(row=row, column=9, value=element.get('projectType', ''))
-            write_int(ws, row, 10, element.get('investmentProfile', ''))
-            write_int(ws, row, 11, element.get('responsibleProfitCenter', ''))
-            write_int(ws, row, 12, element.get('responsibleCostCenter', ''))
-            ws.cell(row=row, column=13, value='x' if element.get('planningElement') else '')
-            ws.cell(row=row, column=14, value='x' if element.get('rubricElement') else '')
-            ws.cell(row=row, column=15, value='x' if element.get('billingElement') else '')
-            percent = element.get('settlementRulePercent', '')
-            if percent not in ('', None):
-                try:
-                    ws.cell(row=row, column=16, value=float(percent) / 100)
-                except Exception:
-                    ws.cell(row=row, column=16, value=percent)
-            else:
-                ws.cell(row=row, column=16, value='')
-            ws.cell(row=row, column=17, value=element.get('settlementRuleGoal', ''))
-            ws.cell(row=row, column=18, value=element.get('projectProfile', ''))
-            ws.cell(row=row, column=19, value=element.get('responsiblePerson', ''))
-            ws.cell(row=row, column=20, value=element.get('userId', ''))
-            ws.cell(row=row, column=21, value=element.get('employmentNumber', ''))
-            ws.cell(row=row, column=22, value=element.get('functionalArea', ''))
-            ws.cell(row=row, column=24, value=element.get('comment', ''))
-            ws.cell(row=row, column=25, value=element.get('tm1Project', ''))
-            ws.cell(row=row, column=26, value=element.get('tgPhase', ''))
-            ws.cell(row=row, column=27, value=element.get('projectSpec', ''))
-            ws.cell(row=row, column=28, value=element.get('motherCode', ''))
-        with tempfile.NamedTemporaryFile(suffix='.xlsm', delete=False, dir='/tmp') as tmp:
-            wb.save(tmp.name)
-            tmp.seek(0)
-            excel_data = tmp.read()
-        os.unlink(tmp.name)
+        region = wbs_data[0].get('region') if wbs_data else None
+        template = get_template(region, payload.get("requestType"))
+        buffer = io.BytesIO()
+        fill_excel_template(template.path, buffer, wbs_data)
+        excel_data = buffer.getvalue()
         return StreamingResponse(
             io.BytesIO(excel_data),
             media_type="application/vnd.ms-excel.sheet.macroEnabled.12",
-            headers={"Content-Disposition": "attachment; filename=wbs_export.xlsm"}
+            headers={
+                "Content-Disposition": "attachment; filename=wbs_export.xlsm",
+                "Content-Length": str(len(excel_data)),
+                "X-Template-Version": template.version,
+            }
         )
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
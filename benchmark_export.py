@@ -0,0 +1,450 @@
+"""Benchmark every WBS export implementation across payload sizes.
+
+Two kinds of measurement are taken for each payload (1 to 10k rows, single
+region or mixed DE/NL/SE/DK/UK, built from sample_data.json):
+
+* fill: the fill function called directly, each case in a fresh process so
+  its peak RSS is its own. 'daemon' measures round trips through a
+  ``fill_excel_template.py --serve`` worker, as used by the Next.js route.
+* http: a local uvicorn serving the app, hit by concurrent clients. Peak RSS
+  is summed over the server and its worker processes.
+
+Results are written as JSON to benchmarks/<commit>.json (ignored by git) so
+runs can be compared across commits:
+
+    python benchmark_export.py --rows 1,100,1000
+    python benchmark_export.py --compare benchmarks/<older>.json
+"""
+import argparse
+import copy
+import http.client
+import importlib.util
+import io
+import json
+import math
+import multiprocessing
+import os
+import platform
+import resource
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import warnings
+from datetime import datetime, timezone
+
+ROOT_DIR = os.path.dirname(os.path.abspath(__file__))
+TEMPLATE_PATH = os.path.join(ROOT_DIR, 'templates', 'wbs_template_actual.xlsm')
+REGIONS = ['DE', 'NL', 'SE', 'DK', 'UK']
+DEFAULT_ROWS = [1, 10, 100, 1000, 10000]
+ELEMENTS_PER_PROJECT = 50
+
+# name -> (uvicorn app, --app-dir relative to the repo, required module)
+HTTP_TARGETS = {
+    'main': ('main:app', '.', None),
+    'export-wbs': ('export-wbs:app', os.path.join('app', 'api'), None),
+    'excel_export_service': ('excel_export_service:app', '.', 'xlwings'),
+}
+FILL_TARGETS = ['fill_excel_template:openpyxl', 'fill_excel_template:xml', 'daemon', 'export-wbs']
+
+
+def build_payload(rows, mixed=False):
+    """WBS elements cloned from sample_data.json with a small project hierarchy."""
+    with open(os.path.join(ROOT_DIR, 'sample_data.json'), 'r', encoding='utf-8') as f:
+        sample = json.load(f)[0]
+    elements = []
+    for i in range(rows):
+        element = copy.deepcopy(sample)
+        region = REGIONS[i % len(REGIONS)] if mixed else REGIONS[0]
+        root = i - i % ELEMENTS_PER_PROJECT
+        element['region'] = region
+        # The sample's placeholder values would fail the service's validation
+        element['projectSpec'] = 'ASSET'
+        element['tgPhase'] = '1'
+        element['settlementRulePercent'] = '100'
+        element['projectDefinition'] = f"{sample['projectDefinition']}.{i:05d}"
+        element['projectName'] = f"{sample['projectName']} {i}"
+        element['level'] = '1' if i == root else '2'
+        element['motherCode'] = '' if i == root else f"{sample['projectDefinition']}.{root:05d}"
+        elements.append(element)
+    return elements
+
+
+def percentile(samples, pct):
+    """Nearest-rank percentile of a list of numbers."""
+    if not samples:
+        return None
+    ordered = sorted(samples)
+    rank = max(math.ceil(pct / 100 * len(ordered)) - 1, 0)
+    return ordered[min(rank, len(ordered) - 1)]
+
+
+def summarize(latencies, elapsed, rows):
+    return {
+        'samples': len(latencies),
+        'p50Ms': round(percentile(latencies, 50) * 1000, 2) if latencies else None,
+        'p99Ms': round(percentile(latencies, 99) * 1000, 2) if latencies else None,
+        'meanMs': round(sum(latencies) / len(latencies) * 1000, 2) if latencies else None,
+        'throughputRps': round(len(latencies) / elapsed, 3) if elapsed else None,
+        'rowsPerSec': round(len(latencies) * rows / elapsed, 1) if elapsed else None,
+    }
+
+
+def _load_export_wbs():
+    spec = importlib.util.spec_from_file_location(
+        'export_wbs', os.path.join(ROOT_DIR, 'app', 'api', 'export-wbs.py'))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+class _Daemon:
+    """Fills through a ``fill_excel_template.py --serve`` worker over stdin/stdout."""
+
+    def __init__(self):
+        self.process = subprocess.Popen(
+            [sys.executable, 'fill_excel_template.py', '--serve', '--engine', 'xml'],
+            cwd=ROOT_DIR, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+
+    def __call__(self, data, out):
+        from fill_excel_template import read_frame, write_frame
+        write_frame(self.process.stdin, json.dumps({'wbsData': data}).encode('utf-8'))
+        self.process.stdin.flush()
+        reply = json.loads(read_frame(self.process.stdout))
+        if not reply['ok']:
+            raise RuntimeError(reply['error'])
+        out.write(read_frame(self.process.stdout))
+
+    def close(self):
+        peak = _peak_rss(self.process.pid)
+        self.process.stdin.close()
+        self.process.wait()
+        return peak
+
+
+def _fill_function(target):
+    if target == 'daemon':
+        return _Daemon()
+    if target == 'export-wbs':
+        module = _load_export_wbs()
+        return lambda data, out: module.fill_excel_template(TEMPLATE_PATH, out, data)
+    import fill_excel_template
+    engine = target.split(':', 1)[1]
+    return lambda data, out: fill_excel_template.fill_excel_template(TEMPLATE_PATH, out, data, engine=engine)
+
+
+def _fill_case(target, rows, mixed, repeat, results):
+    sys.path.insert(0, ROOT_DIR)
+    warnings.filterwarnings('ignore', category=UserWarning, module='openpyxl')
+    try:
+        fill = _fill_function(target)
+        data = build_payload(rows, mixed)
+        start = time.perf_counter()
+        out = io.BytesIO()
+        fill(data, out)
+        first = time.perf_counter() - start
+        latencies = []
+        started = time.perf_counter()
+        for _ in range(repeat):
+            out = io.BytesIO()
+            start = time.perf_counter()
+            fill(data, out)
+            latencies.append(time.perf_counter() - start)
+        result = summarize(latencies, time.perf_counter() - started, rows)
+        if isinstance(fill, _Daemon):
+            peak_rss = fill.close()
+        else:
+            # ru_maxrss is in KiB on Linux
+            peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+        result.update({
+            'firstMs': round(first * 1000, 2),
+            'outputBytes': len(out.getvalue()),
+            'peakRssBytes': peak_rss,
+        })
+        results.put(result)
+    except Exception as e:
+        results.put({'error': f"{type(e).__name__}: {e}"})
+
+
+def run_fill(target, rows, mixed, repeat):
+    """Run one fill case in a fresh process and return its measurements."""
+    ctx = multiprocessing.get_context('spawn')
+    results = ctx.Queue()
+    process = ctx.Process(target=_fill_case, args=(target, rows, mixed, repeat, results))
+    process.start()
+    result = results.get()
+    process.join()
+    return result
+
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def _children(pid):
+    children = []
+    try:
+        for task in os.listdir(f'/proc/{pid}/task'):
+            with open(f'/proc/{pid}/task/{task}/children') as f:
+                children.extend(int(child) for child in f.read().split())
+    except OSError:
+        pass
+    return children
+
+
+def _peak_rss(pid):
+    """Sum of VmHWM over pid and its descendants, or None off Linux."""
+    total = 0
+    pending = [pid]
+    while pending:
+        current = pending.pop()
+        try:
+            with open(f'/proc/{current}/status') as f:
+                for line in f:
+                    if line.startswith('VmHWM:'):
+                        total += int(line.split()[1]) * 1024
+        except OSError:
+            if current == pid:
+                return None
+        pending.extend(_children(current))
+    return total
+
+
+class Server:
+    """A uvicorn process serving one of the export apps on a free local port."""
+
+    def __init__(self, app, app_dir, env=None):
+        self.port = _free_port()
+        # A file rather than a pipe, so a chatty server never blocks on stderr
+        self.log = tempfile.TemporaryFile()
+        self.process = subprocess.Popen(
+            [sys.executable, '-m', 'uvicorn', app, '--app-dir', app_dir,
+             '--host', '127.0.0.1', '--port', str(self.port), '--log-level', 'warning'],
+            cwd=ROOT_DIR, env=dict(os.environ, **(env or {})),
+            stdout=subprocess.DEVNULL, stderr=self.log)
+
+    def wait_ready(self, timeout=60):
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if self.process.poll() is not None:
+                self.log.seek(0)
+                raise RuntimeError(self.log.read().decode('utf-8', 'replace')[-2000:])
+            try:
+                conn = http.client.HTTPConnection('127.0.0.1', self.port, timeout=1)
+                conn.request('GET', '/')
+                conn.getresponse().read()
+                conn.close()
+                return
+            except OSError:
+                time.sleep(0.2)
+        raise RuntimeError(f"Server did not start within {timeout}s")
+
+    def stop(self):
+        self.process.terminate()
+        try:
+            self.process.wait(10)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+            self.process.wait()
+        self.log.close()
+
+
+def _post(conn, path, body):
+    start = time.perf_counter()
+    conn.request('POST', path, body=body, headers={'Content-Type': 'application/json'})
+    response = conn.getresponse()
+    data = response.read()
+    return time.perf_counter() - start, response.status, len(data)
+
+
+def run_http(target, rows, mixed, concurrency, requests, env):
+    """Start target under uvicorn and measure it under concurrent clients."""
+    app, app_dir, requires = HTTP_TARGETS[target]
+    if requires and importlib.util.find_spec(requires) is None:
+        return {'skipped': f"{requires} is not installed"}
+    # /export on main writes every element into one workbook; mixed regions go through /export/batch
+    path = '/export/batch' if target == 'main' and mixed else '/export'
+    body = json.dumps({
+        'wbsData': build_payload(rows, mixed),
+        'requestName': 'Benchmark',
+        'submissionDate': '2024-01-01',
+    }).encode('utf-8')
+    server = Server(app, app_dir, env)
+    try:
+        server.wait_ready()
+        conn = http.client.HTTPConnection('127.0.0.1', server.port, timeout=600)
+        first, status, output_bytes = _post(conn, path, body)
+        conn.close()
+        if status != 200:
+            return {'endpoint': path, 'error': f"HTTP {status} on first request"}
+
+        latencies = []
+        errors = []
+        lock = threading.Lock()
+        remaining = [requests]
+
+        def client():
+            conn = http.client.HTTPConnection('127.0.0.1', server.port, timeout=600)
+            while True:
+                with lock:
+                    if remaining[0] <= 0:
+                        break
+                    remaining[0] -= 1
+                try:
+                    latency, status, _ = _post(conn, path, body)
+                except (OSError, http.client.HTTPException) as e:
+                    conn.close()
+                    conn = http.client.HTTPConnection('127.0.0.1', server.port, timeout=600)
+                    with lock:
+                        errors.append(type(e).__name__)
+                    continue
+                with lock:
+                    if status == 200:
+                        latencies.append(latency)
+                    else:
+                        errors.append(status)
+            conn.close()
+
+        started = time.perf_counter()
+        clients = [threading.Thread(target=client) for _ in range(concurrency)]
+        for thread in clients:
+            thread.start()
+        for thread in clients:
+            thread.join()
+        result = summarize(latencies, time.perf_counter() - started, rows)
+        result.update({
+            'endpoint': path,
+            'concurrency': concurrency,
+            'firstMs': round(first * 1000, 2),
+            'outputBytes': output_bytes,
+            'peakRssBytes': _peak_rss(server.process.pid),
+            'errors': len(errors),
+        })
+        return result
+    finally:
+        server.stop()
+
+
+def git_revision():
+    try:
+        commit = subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'], cwd=ROOT_DIR, stderr=subprocess.DEVNULL).decode().strip()
+        dirty = bool(subprocess.check_output(
+            ['git', 'status', '--porcelain', '--untracked-files=no'], cwd=ROOT_DIR).strip())
+        return commit, dirty
+    except (OSError, subprocess.CalledProcessError):
+        return None, None
+
+
+def result_key(result):
+    return (result['kind'], result['target'], result['rows'], result['regions'])
+
+
+def compare(results, baseline_path):
+    """Print p50 and peak RSS of this run against an earlier results file."""
+    with open(baseline_path, 'r', encoding='utf-8') as f:
+        baseline = {result_key(r): r for r in json.load(f)['results']}
+    print(f"\nCompared with {baseline_path}:")
+    for result in results:
+        old = baseline.get(result_key(result))
+        if not old or not old.get('p50Ms') or not result.get('p50Ms'):
+            continue
+        line = f"  {'/'.join(str(part) for part in result_key(result))}: p50 {old['p50Ms']} -> {result['p50Ms']} ms"
+        line += f" ({result['p50Ms'] / old['p50Ms']:.2f}x)"
+        if old.get('peakRssBytes') and result.get('peakRssBytes'):
+            line += f", peak RSS {old['peakRssBytes'] >> 20} -> {result['peakRssBytes'] >> 20} MiB"
+        print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--rows', default=','.join(map(str, DEFAULT_ROWS)),
+                        help='comma-separated payload sizes')
+    parser.add_argument('--regions', default='single,mixed', help='single, mixed or both')
+    parser.add_argument('--fill-targets', default=','.join(FILL_TARGETS),
+                        help='fill functions to call directly (empty for none)')
+    parser.add_argument('--http-targets', default=','.join(HTTP_TARGETS),
+                        help='apps to serve with uvicorn (empty for none)')
+    parser.add_argument('--repeat', type=int, default=5, help='timed runs per fill case')
+    parser.add_argument('--concurrency', type=int, default=4, help='concurrent HTTP clients')
+    parser.add_argument('--requests', type=int, default=20, help='timed requests per HTTP case')
+    parser.add_argument('--output', help='results file (default benchmarks/<commit>.json)')
+    parser.add_argument('--compare', help='earlier results file to compare against')
+    args = parser.parse_args()
+
+    sizes = [int(size) for size in args.rows.split(',') if size]
+    region_modes = [mode for mode in args.regions.split(',') if mode]
+    fill_targets = [target for target in args.fill_targets.split(',') if target]
+    http_targets = [target for target in args.http_targets.split(',') if target]
+    for target in http_targets:
+        if target not in HTTP_TARGETS:
+            parser.error(f"unknown HTTP target {target!r}")
+    for target in fill_targets:
+        if target not in FILL_TARGETS:
+            parser.error(f"unknown fill target {target!r}")
+
+    work_dir = tempfile.mkdtemp(prefix='wbs_benchmark_')
+    # Every request must do the work: no export cache, and jobs kept out of the repo
+    server_env = {
+        'EXPORT_CACHE_BYTES': '0',
+        'EXPORT_CACHE_DISK_BYTES': '0',
+        'EXPORT_CACHE_DIR': os.path.join(work_dir, 'cache'),
+        'EXPORT_JOBS_DIR': os.path.join(work_dir, 'jobs'),
+        'EXPORT_QUEUE_SIZE': str(max(args.concurrency, 16)),
+    }
+
+    results = []
+    cases = [('fill', target) for target in fill_targets] + [('http', target) for target in http_targets]
+    for kind, target in cases:
+        for mode in region_modes:
+            for rows in sizes:
+                print(f"{kind:4} {target:28} {mode:6} {rows:>6} rows ... ", end='', flush=True)
+                if kind == 'fill':
+                    result = run_fill(target, rows, mode == 'mixed', args.repeat)
+                else:
+                    try:
+                        result = run_http(target, rows, mode == 'mixed', args.concurrency,
+                                          args.requests, server_env)
+                    except RuntimeError as e:
+                        result = {'error': str(e)}
+                result = dict({'kind': kind, 'target': target, 'rows': rows, 'regions': mode}, **result)
+                results.append(result)
+                if 'p50Ms' in result:
+                    print(f"p50 {result['p50Ms']} ms, p99 {result['p99Ms']} ms, "
+                          f"{result['throughputRps']} req/s, {result['outputBytes']} bytes")
+                else:
+                    print(result.get('skipped') or result.get('error'))
+
+    commit, dirty = git_revision()
+    report = {
+        'commit': commit,
+        'dirty': dirty,
+        'timestamp': datetime.now(timezone.utc).isoformat(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpuCount': os.cpu_count(),
+        'config': {
+            'rows': sizes,
+            'regions': region_modes,
+            'repeat': args.repeat,
+            'concurrency': args.concurrency,
+            'requests': args.requests,
+            'exportEngine': os.getenv('EXPORT_ENGINE', 'openpyxl'),
+        },
+        'results': results,
+    }
+    output = args.output or os.path.join(ROOT_DIR, 'benchmarks', f"{(commit or 'unknown')[:12]}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w', encoding='utf-8') as f:
+        json.dump(report, f, indent=2)
+    print(f"Results written to {output}")
+    if args.compare:
+        compare(results, args.compare)
+
+
+if __name__ == '__main__':
+    main()
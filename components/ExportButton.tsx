@@ -1,74 +1,173 @@
 import { Button } from "@/components/ui/button";
-import { Download } from "lucide-react";
+import { Download, GitCompare } from "lucide-react";
 import { StoredWBSData } from "@/types";
 import { toast } from "sonner";
 import { useState } from "react";
-import { getControllingAreaOptions, getFunctionalAreaOptions } from "@/components/forms/WBSForm";
 
 export interface ExportButtonProps {
   wbsData: StoredWBSData[];
   requestName: string;
   submissionDate: string; // in YYYYMMDD format
+  requestType?: string; // selects the template together with the region
+  requestId?: string; // shows "Export changes": the rows changed since this request's last changes export
 }
 
-export function ExportButton({ wbsData, requestName, submissionDate }: ExportButtonProps) {
+export function ExportButton({ wbsData, requestName, submissionDate, requestType, requestId }: ExportButtonProps) {
   const [loading, setLoading] = useState(false);
 
-  const handleExport = async () => {
+  const handleExport = async (changesOnly = false) => {
     setLoading(true);
     try {
       const API_URL = process.env.NEXT_PUBLIC_API_URL || 'http://127.0.0.1:8000';
 
-      // Enrich WBS data with controllingAreaLabel and functionalAreaLabel
-      const enrichedWBSData = wbsData.map(wbs => {
-        const controllingAreaOption = getControllingAreaOptions(wbs.region).find(opt => opt.value === wbs.controllingArea);
-        const functionalAreaOption = getFunctionalAreaOptions(wbs.region).find(opt => opt.value === wbs.functionalArea);
-        return {
-          ...wbs,
-          controllingAreaLabel: controllingAreaOption ? controllingAreaOption.label : wbs.controllingArea,
-          functionalAreaLabel: functionalAreaOption ? functionalAreaOption.label : wbs.functionalArea,
-        };
-      });
-
-      // Group WBS elements by region
-      const wbsByRegion = enrichedWBSData.reduce((acc, wbs) => {
+      // Group WBS elements by region. Only codes are sent: the service adds the
+      // controlling and functional area labels from its lookup tables (GET /lookups)
+      const wbsByRegion = wbsData.reduce((acc, wbs) => {
         const region = wbs.region;
         if (!acc[region]) {
           acc[region] = [];
         }
         acc[region].push(wbs);
         return acc;
-      }, {} as Record<string, typeof enrichedWBSData>);
+      }, {} as Record<string, StoredWBSData[]>);
+
+      const triggerDownload = (blob: Blob, filename: string) => {
+        const url = window.URL.createObjectURL(blob);
+        const link = document.createElement('a');
+        link.href = url;
+        link.download = filename;
+
+        // Trigger the download
+        document.body.appendChild(link);
+        link.click();
+        document.body.removeChild(link);
+        window.URL.revokeObjectURL(url);
+      };
+
+      // Validation failures (422) list the offending rows of wbsData
+      const exportError = async (response: Response, fallback: string) => {
+        if (response.status === 422) {
+          const body = await response.json().catch(() => null);
+          const rows = Object.keys(body?.detail?.errors ?? {}).map(row => Number(row) + 1);
+          if (rows.length) {
+            return new Error(`WBS data failed validation on row(s) ${rows.join(', ')}`);
+          }
+        }
+        return new Error(fallback);
+      };
+
+      // Per-stage server timings (also shown under Timing in the devtools Network tab),
+      // the template version each workbook was filled into and, for re-exports, what changed
+      const logServerTiming = (response: Response, label: string) => {
+        const serverTiming = response.headers.get('Server-Timing');
+        if (serverTiming) {
+          console.debug(`Export ${label} server timing: ${serverTiming}`);
+        }
+        const templateVersion = response.headers.get('X-Template-Version');
+        if (templateVersion) {
+          console.debug(`Export ${label} template version: ${templateVersion}`);
+        }
+        const changes = response.headers.get('X-Export-Changes');
+        if (changes) {
+          console.debug(`Export ${label} rows since last export: ${changes}`);
+        }
+      };
+
+      const regions = Object.keys(wbsByRegion);
+      if (changesOnly && requestId) {
+        // The service keeps this request's last changes export per region and
+        // returns a workbook with only the rows changed or added since then
+        const fullRegions: string[] = [];
+        for (const [region, regionData] of Object.entries(wbsByRegion)) {
+          const exportRequest = (changesOnly: boolean) => fetch(
+            `${API_URL}/export/requests/${encodeURIComponent(requestId)}?changesOnly=${changesOnly}`, {
+            method: 'POST',
+            headers: {
+              'Content-Type': 'application/json',
+            },
+            body: JSON.stringify({ wbsData: regionData, requestType }),
+          });
+
+          let response = await exportRequest(true);
+          let full = false;
+          if (response.status === 409) {
+            // Nothing to compare with yet: export every row, which later changes exports compare against
+            response = await exportRequest(false);
+            full = true;
+          }
+
+          if (!response.ok) {
+            throw await exportError(response, `Export of changes failed for region ${region}`);
+          }
+
+          logServerTiming(response, region);
+          const blob = await response.blob();
+          if (full) {
+            fullRegions.push(region);
+            triggerDownload(blob, `MDM WBS ${submissionDate} ${region} - ${requestName}.xlsm`);
+          } else {
+            triggerDownload(blob, `MDM WBS ${submissionDate} ${region} - ${requestName} - Changes.xlsm`);
+          }
+        }
+        if (fullRegions.length) {
+          toast.info(`No earlier changes export for regions ${fullRegions.join(', ')}; exported all rows instead`);
+        }
+        const changedRegions = regions.filter(region => !fullRegions.includes(region));
+        if (changedRegions.length) {
+          toast.success(`Exported changes for regions: ${changedRegions.join(', ')}`);
+        }
+        return;
+      }
+
+      if (regions.length > 1) {
+        // Export all regions in one call; the server returns a zip with one workbook per region
+        const response = await fetch(`${API_URL}/export/batch`, {
+          method: 'POST',
+          headers: {
+            'Content-Type': 'application/json',
+          },
+          body: JSON.stringify({ wbsData, requestName, submissionDate, requestType }),
+        });
+
+        if (!response.ok) {
+          throw await exportError(response, `Export failed for regions ${regions.join(', ')}`);
+        }
+
+        logServerTiming(response, regions.join(','));
+        const blob = await response.blob();
+        triggerDownload(blob, `MDM WBS ${submissionDate} - ${requestName}.zip`);
 
-      // Export each region's data separately
+        const failedRegions = response.headers.get('X-Export-Failed-Regions');
+        if (failedRegions) {
+          const completedRegions = regions.filter(region => !failedRegions.split(',').includes(region));
+          toast.warning(`Export completed for regions: ${completedRegions.join(', ')}; failed for: ${failedRegions}`);
+        } else {
+          toast.success(`Export completed successfully for regions: ${regions.join(', ')}`);
+        }
+        return;
+      }
+
+      // Export the single region's data
       const exportPromises = Object.entries(wbsByRegion).map(async ([region, regionData]) => {
         const response = await fetch(`${API_URL}/export`, {
           method: 'POST',
           headers: {
             'Content-Type': 'application/json',
           },
-          body: JSON.stringify({ wbsData: regionData }),
+          body: JSON.stringify({ wbsData: regionData, requestType }),
         });
 
         if (!response.ok) {
-          throw new Error(`Export failed for region ${region}`);
+          throw await exportError(response, `Export failed for region ${region}`);
         }
 
+        logServerTiming(response, region);
+
         // Get the blob from the response
         const blob = await response.blob();
-        
-        // Create a download link
-        const url = window.URL.createObjectURL(blob);
-        const link = document.createElement('a');
-        link.href = url;
+
         // Format: MDM WBS YYYYMMDD REGION - REQUESTNAME.xlsm
-        link.download = `MDM WBS ${submissionDate} ${region} - ${requestName}.xlsm`;
-        
-        // Trigger the download
-        document.body.appendChild(link);
-        link.click();
-        document.body.removeChild(link);
-        window.URL.revokeObjectURL(url);
+        triggerDownload(blob, `MDM WBS ${submissionDate} ${region} - ${requestName}.xlsm`);
 
         return region;
       });
@@ -78,7 +177,7 @@ export function ExportButton({ wbsData, requestName, submissionDate }: ExportBut
       toast.success(`Export completed successfully for regions: ${completedRegions.join(', ')}`);
     } catch (error) {
       console.error('Error exporting to Excel:', error);
-      toast.error('Failed to export data');
+      toast.error(error instanceof Error ? error.message : 'Failed to export data');
     } finally {
       setLoading(false);
     }
@@ -86,15 +185,29 @@ export function ExportButton({ wbsData, requestName, submissionDate }: ExportBut
 
   return (
     <div>
-      <Button
-        onClick={handleExport}
-        variant="outline"
-        className="gap-2"
-        disabled={loading}
-      >
-        <Download className="h-4 w-4" />
-        {loading ? 'Exporting...' : 'Export to Excel'}
-      </Button>
+      <div className="flex gap-2">
+        <Button
+          onClick={() => handleExport()}
+          variant="outline"
+          className="gap-2"
+          disabled={loading}
+        >
+          <Download className="h-4 w-4" />
+          {loading ? 'Exporting...' : 'Export to Excel'}
+        </Button>
+        {requestId && (
+          <Button
+            onClick={() => handleExport(true)}
+            variant="outline"
+            className="gap-2"
+            disabled={loading}
+            title="Only the rows changed or added since the last changes export of this request"
+          >
+            <GitCompare className="h-4 w-4" />
+            Export changes
+          </Button>
+        )}
+      </div>
       {loading && (
         <div style={{ marginTop: 8, color: '#555', fontSize: 14 }}>
           Please wait while files are being exported, don&apos;t leave this page.
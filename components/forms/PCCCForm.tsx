@@ -24,7 +24,7 @@ import {
   TableRow,
 } from "@/components/ui/table";
 import { useState } from "react";
-import { getControllingAreaOptions, getFunctionalAreaOptions } from "./WBSForm";
+import { getControllingAreaOptions, getFunctionalAreaOptions, useLookups } from "@/lib/services/lookups";
 import type { RegionType } from "@/types";
 
 const basePCCCSchema = z.object({
@@ -55,6 +55,7 @@ interface PCCCFormProps {
 }
 
 export default function PCCCForm({ region, onSubmit, initialData }: PCCCFormProps) {
+  useLookups();
   const [selectedRows, setSelectedRows] = useState<number[]>([]);
 
   const form = useForm<FormValues>({
@@ -26,6 +26,7 @@ import {
 import { Card, CardContent } from "@/components/ui/card";
 import { Plus, Trash2, Info } from "lucide-react";
 import { Popover, PopoverTrigger, PopoverContent } from "@/components/ui/popover";
+import { getControllingAreaOptions, getFunctionalAreaOptions, useLookups } from "@/lib/services/lookups";
 
 // Add these CSS classes near the top of the file, after imports
 const tableStyles = {
@@ -141,59 +142,6 @@ interface WBSFormProps {
 }
 
 // Export the helper functions
-export const getControllingAreaOptions = (region: RegionType) => {
-  switch (region) {
-    case "DE":
-      return [
-        { value: "5123", label: "Holding" },
-        { value: "2574", label: "Waste" },
-        { value: "5321", label: "Holding Beteiligungen" },
-        { value: "3123", label: "Kernkraftwerke" },
-      ];
-    case "NL":
-      return [
-        { value: "4213", label: "Vattenfall" },
-        { value: "6754", label: "Netbeheer" },
-        { value: "2342", label: "Overig" },
-      ];
-    case "SE":
-    case "DK":
-    case "UK":
-      return [
-        { value: "521", label: "Vattenfall AB" },
-        { value: "6474", label: "2Nordic AB" },
-        { value: "3321", label: "BusinessServices." },
-        { value: "4211", label: "Nuclear plant" }
-      ];
-    default:
-      return [];
-  }
-};
-
-export const getFunctionalAreaOptions = (region: RegionType) => {
-  switch (region) {
-    case "SE":
-    case "DK":
-    case "UK":
-      return [
-        { value: "1235", label: "OPC Oper & mainte" },
-        { value: "2211", label: "MAC Maint/distr" },
-        { value: "5321", label: "MAC Maint/distri extra" },
-        { value: "1121", label: "MAC Breakdown" },
-      ];
-    case "DE":
-      return [
-        { value: "1001", label: "Production" },
-        { value: "1002", label: "Quality Control" },
-        { value: "1003", label: "Maintenance" },
-      ];
-    case "NL":
-      return [];
-    default:
-      return [];
-  }
-};
-
 export const getProjectSpecOptions = (region: RegionType) => {
   switch (region) {
     case "DE":
@@ -277,6 +225,8 @@ const fieldDescriptions: Record<string, string> = {
 };
 
 export default function WBSForm({ onSubmit, initialData, requestName }: WBSFormProps) {
+  // Controlling and functional area options come from the export service
+  useLookups();
   const [selectedRows, setSelectedRows] = useState<number[]>([]);
   const [selectedFields, setSelectedFields] = useState<(keyof WBSFormData)[]>([]);
   const [isMatchDialogOpen, setIsMatchDialogOpen] = useState(false);
@@ -0,0 +1,237 @@
+"""One workbook per region from the WBS elements of many requests.
+
+Requests are read one at a time and their WBS elements are spooled to a
+temporary file per region; only a small index (projectDefinition,
+motherCode, level and file offsets) is kept in memory, so a day's worth of
+requests is merged with bounded memory. When the same projectDefinition
+appears in several requests, the rows of the last request win. Each
+region's workbook lists parents before their children: roots in the order
+they were first seen, then each element's subtree depth first.
+"""
+import json
+import os
+import shutil
+import tempfile
+import zipfile
+
+from fill_excel_template import StageClock, WbsWorkbookStream
+from wbs_columns import BATCH_SIZE
+from wbs_validation import WbsValidator
+
+# Keys every WBS row of a request's submittedData has
+WBS_ROW_KEYS = ('projectDefinition', 'level')
+
+
+def _text(value):
+    return '' if value is None else str(value).strip()
+
+
+def _level(value):
+    text = _text(value)
+    return int(text) if text.isdigit() else 0
+
+
+def wbs_rows(record):
+    """Return the WBS elements submitted with a request record."""
+    if record.get('requestType') not in (None, '', 'WBS'):
+        return []
+    data = record.get('submittedData')
+    if isinstance(data, dict):
+        data = [data]
+    if not isinstance(data, list):
+        return []
+    return [row for row in data if isinstance(row, dict) and all(key in row for key in WBS_ROW_KEYS)]
+
+
+class _Element:
+    __slots__ = ('mother_code', 'level', 'rows')
+
+    def __init__(self, mother_code, level, rows):
+        self.mother_code = mother_code
+        self.level = level
+        self.rows = rows
+
+
+class RegionSpool:
+    """The WBS elements of one region, on disk, indexed by projectDefinition.
+
+    Each index entry holds the file offsets of the element's rows (an
+    element has one row per settlement rule) and the request and position
+    they came from.
+    """
+
+    def __init__(self, region):
+        self.region = region
+        self.file = tempfile.TemporaryFile()
+        self.elements = {}
+        self.replaced = 0
+        self._unnamed = 0
+
+    def add(self, rows, source):
+        """Spool one request's rows for this region; source is the request id."""
+        by_definition = {}
+        for index, row in rows:
+            definition = _text(row.get('projectDefinition'))
+            if not definition:
+                # Cannot be de-duplicated; always kept
+                self._unnamed += 1
+                definition = ('', self._unnamed)
+            offset = self.file.seek(0, os.SEEK_END)
+            self.file.write(json.dumps(row).encode('utf-8') + b'\n')
+            entry = by_definition.get(definition)
+            if entry is None:
+                entry = by_definition[definition] = _Element(
+                    _text(row.get('motherCode')), _level(row.get('level')), [])
+            entry.rows.append((offset, source, index))
+        for definition, entry in by_definition.items():
+            if definition in self.elements:
+                self.replaced += 1
+            self.elements[definition] = entry
+
+    def ordered(self):
+        """Yield the index entries with every parent before its children."""
+        children = {}
+        roots = []
+        for definition, entry in self.elements.items():
+            if entry.mother_code and entry.mother_code in self.elements and entry.mother_code != definition:
+                children.setdefault(entry.mother_code, []).append(definition)
+            else:
+                roots.append(definition)
+        visited = set()
+
+        def by_level(definitions):
+            # Stable, so elements of one level keep the order they were first seen in
+            return sorted(definitions, key=lambda definition: self.elements[definition].level)
+
+        stack = list(reversed(by_level(roots)))
+        while stack:
+            definition = stack.pop()
+            if definition in visited:
+                continue
+            visited.add(definition)
+            yield self.elements[definition]
+            stack.extend(reversed(by_level(children.get(definition, ()))))
+        # Elements on a motherCode cycle are not reachable from any root
+        for definition, entry in self.elements.items():
+            if definition not in visited:
+                yield entry
+
+    def iter_batches(self, batch_size=BATCH_SIZE):
+        """Yield lists of (source, index, element) in hierarchy order."""
+        batch = []
+        for entry in self.ordered():
+            for offset, source, index in entry.rows:
+                self.file.seek(offset)
+                batch.append((source, index, json.loads(self.file.readline())))
+                if len(batch) >= batch_size:
+                    yield batch
+                    batch = []
+        if batch:
+            yield batch
+
+    def close(self):
+        self.file.close()
+
+
+class ConsolidatedExport:
+    """Merges requests into one WBS workbook per region."""
+
+    def __init__(self, validate=True):
+        self.validate = validate
+        self.regions = {}
+        self.requests = []
+
+    def add_request(self, record):
+        """Add the WBS elements of one request record ({id, region, submittedData, ...})."""
+        request_id = _text(record.get('id')) or f'#{len(self.requests) + 1}'
+        rows = wbs_rows(record)
+        if not rows:
+            return 0
+        self.requests.append(request_id)
+        by_region = {}
+        for index, row in enumerate(rows):
+            region = _text(row.get('region')) or _text(record.get('region'))
+            if not row.get('region'):
+                row = dict(row, region=region)
+            by_region.setdefault(region, []).append((index, row))
+        for region, region_rows in by_region.items():
+            spool = self.regions.get(region)
+            if spool is None:
+                spool = self.regions[region] = RegionSpool(region)
+            spool.add(region_rows, request_id)
+        return len(rows)
+
+    def write_workbooks(self, archive, filename):
+        """Add one workbook per region to a ZipFile; return (summary, errors).
+
+        filename(region) names each workbook. Rows are validated in the order
+        they are written; errors are keyed by region and "requestId[index]".
+        """
+        summary, errors = {}, {}
+        for region, spool in sorted(self.regions.items()):
+            validator = WbsValidator()
+            sources = []
+            with tempfile.TemporaryFile() as out:
+                writer = WbsWorkbookStream(out, 'WBS')
+                for batch in spool.iter_batches():
+                    elements = [element for _, _, element in batch]
+                    if self.validate:
+                        validator.add(elements)
+                        sources.extend(f'{source}[{index}]' for source, index, _ in batch)
+                    writer.write(elements)
+                writer.close()
+                region_errors = validator.finish() if self.validate else {}
+                if region_errors:
+                    errors[region] = {sources[row]: problems for row, problems in region_errors.items()}
+                    continue
+                out.seek(0)
+                with archive.open(filename(region), 'w') as member:
+                    shutil.copyfileobj(out, member)
+            summary[region] = {
+                'rows': writer.count,
+                'elements': len(spool.elements),
+                'replacedDuplicates': spool.replaced,
+                'templateVersion': writer.template.version if writer.template else None,
+            }
+        return summary, errors
+
+    def close(self):
+        for spool in self.regions.values():
+            spool.close()
+
+
+def export_consolidated(records_path, zip_path, name_template, validate=True, timing=None):
+    """Merge the request records in an NDJSON file into a zip of workbooks.
+
+    Runs in a pool worker. Each workbook is named name_template with
+    '{region}' replaced, and consolidated.json summarises the zip. Returns
+    (rows, request ids, summary, errors); nothing is written to zip_path
+    when there are no WBS rows.
+    """
+    clock = StageClock(timing)
+    merger = ConsolidatedExport(validate=validate)
+    try:
+        rows = 0
+        with open(records_path, 'rb') as f:
+            for line in f:
+                if line.strip():
+                    record = json.loads(line)
+                    if isinstance(record, dict):
+                        rows += merger.add_request(record)
+        clock.mark('merge')
+        if not rows:
+            return 0, [], {}, {}
+
+        def filename(region):
+            return name_template.replace('{region}', region.replace('/', '-').replace('\\', '-'))
+
+        with zipfile.ZipFile(zip_path, 'w', zipfile.ZIP_STORED) as archive:
+            summary, errors = merger.write_workbooks(archive, filename)
+            if not errors:
+                archive.writestr('consolidated.json', json.dumps(
+                    {'requests': merger.requests, 'regions': summary}, indent=2))
+        clock.mark('fill')
+        return rows, merger.requests, summary, errors
+    finally:
+        merger.close()
+
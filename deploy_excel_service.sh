@@ -9,14 +9,28 @@ sudo apt-get install -y python3 python3-pip wine-stable
 
 # Install Python packages
 pip3 install fastapi uvicorn xlwings
+pip3 install -r requirements.txt
 
 # Create service directory
 sudo mkdir -p /opt/excel_service
 sudo mkdir -p /opt/excel_service/templates
+sudo mkdir -p /var/lib/excel_service/export_jobs
 
 # Copy service files
-sudo cp excel_export_service.py /opt/excel_service/
+sudo cp excel_export_service.py main.py fill_excel_template.py template_cache.py xlsx_patch.py \
+    export_pool.py export_cache.py export_jobs.py export_metrics.py wbs_columns.py wbs_validation.py \
+    template_registry.py wbs_import.py consolidated_export.py request_store.py \
+    wbs_lookups.py incremental_export.py /opt/excel_service/
 sudo cp templates/wbs_template_actual.xlsm /opt/excel_service/templates/
+# Keep a registry that already lists uploaded template versions
+sudo cp -n templates/registry.json /opt/excel_service/templates/
+sudo cp templates/lookups.json /opt/excel_service/templates/
+
+# Admin token for template uploads; generated once and kept across deploys
+if [ ! -f /etc/excel_service.env ]; then
+    echo "ADMIN_TOKEN=$(openssl rand -hex 32)" | sudo tee /etc/excel_service.env > /dev/null
+    sudo chmod 600 /etc/excel_service.env
+fi
 
 # Create systemd service
 sudo tee /etc/systemd/system/excel-service.service << EOF
@@ -27,7 +41,16 @@ After=network.target
 [Service]
 User=root
 WorkingDirectory=/opt/excel_service
-ExecStart=/usr/bin/python3 excel_export_service.py
+# Queued export jobs, their results and the last export of each request live outside the install directory
+EnvironmentFile=/etc/excel_service.env
+Environment=EXPORT_JOBS_DIR=/var/lib/excel_service/export_jobs
+Environment=EXPORT_HISTORY_DIR=/var/lib/excel_service/export_history
+# Request dump that consolidated exports look requestIds up in
+Environment=REQUESTS_NDJSON=/var/lib/excel_service/requests.ndjson
+# main.py replaces the xlwings service (excel_export_service.py); workbooks are
+# built by openpyxl in the export pool, so Excel is no longer involved
+Environment=EXPORT_ENGINE=openpyxl
+ExecStart=/usr/bin/python3 main.py
 Restart=always
 
 [Install]
@@ -6,6 +6,8 @@ import json
 import tempfile
 from pathlib import Path
 import platform
+from fill_excel_template import get_template
+from wbs_columns import WBS_ROWS
 
 app = FastAPI()
 
@@ -24,7 +26,8 @@ if platform.system() == 'Linux':
     xw.App(visible=False, spec='wine')
 
 @app.post("/export")
-async def export_excel(wbs_data: dict):
+async def export_excel(payload: dict):
+    wbs_data = payload.get("wbsData", [])
     try:
         # Create temporary files
         with tempfile.NamedTemporaryFile(suffix='.json', delete=False) as temp_json:
@@ -34,55 +37,22 @@ async def export_excel(wbs_data: dict):
         with tempfile.NamedTemporaryFile(suffix='.xlsm', delete=False) as temp_excel:
             temp_excel_path = temp_excel.name
 
-        # Get the template path
-        template_path = os.path.join(os.path.dirname(__file__), 'templates', 'wbs_template_actual.xlsm')
+        # The registered template for the region and request type, and its layout
+        region = wbs_data[0].get('region') if wbs_data else None
+        template = get_template(region, payload.get("requestType"))
+        layout = template.layout
 
         # Use xlwings to fill the template
         app = xw.App(visible=False)
-        wb = app.books.open(template_path)
-        ws = wb.sheets['Shared Template']
-        start_row = 18
+        wb = app.books.open(template.path)
+        ws = wb.sheets[layout.sheet_name]
 
-        # Set Business Controller (D7) and Business Responsible (D8)
-        ws.range('D7').value = wbs_data[0].get('requesterDisplayName', '')
-        ws.range('D8').value = wbs_data[0].get('responsiblePerson', '')
+        # Business Controller and Business Responsible
+        for (row, column), value in layout.header_values(wbs_data).items():
+            ws.range((row, column)).value = value
 
-        for i, element in enumerate(wbs_data):
-            row = start_row + i
-            ws.range((row, 1)).value = element.get('regionLabel', '')
-            ws.range((row, 2)).value = element.get('type', '')
-            ws.range((row, 3)).value = 'KIS'
-            ws.range((row, 4)).value = element.get('controllingAreaLabel', element.get('controllingArea', ''))
-            ws.range((row, 5)).value = element.get('companyCode', '')
-            ws.range((row, 6)).value = element.get('projectName', '')
-            ws.range((row, 7)).value = element.get('projectDefinition', '')
-            ws.range((row, 8)).value = element.get('level', '')
-            ws.range((row, 9)).value = element.get('projectType', '')
-            ws.range((row, 10)).value = ''
-            ws.range((row, 11)).value = element.get('responsiblePCCC', '')
-            ws.range((row, 12)).value = element.get('responsiblePCCC', '')
-            ws.range((row, 13)).value = 'x' if element.get('planningElement') else ''
-            ws.range((row, 14)).value = 'x' if element.get('rubricElement') else ''
-            ws.range((row, 15)).value = 'x' if element.get('billingElement') else ''
-            
-            percent = element.get('settlementRulePercent', '')
-            if percent not in ('', None):
-                try:
-                    ws.range((row, 16)).value = float(percent) / 100
-                except Exception:
-                    ws.range((row, 16)).value = percent
-            else:
-                ws.range((row, 16)).value = ''
-                
-            ws.range((row, 17)).value = element.get('settlementRuleGoal', '')
-            ws.range((row, 19)).value = element.get('responsiblePerson', '')
-            ws.range((row, 20)).value = element.get('userId', '')
-            ws.range((row, 21)).value = element.get('employmentNumber', '')
-            ws.range((row, 22)).value = element.get('functionalArea', '')
-            ws.range((row, 24)).value = element.get('comment', '')
-            ws.range((row, 26)).value = element.get('tgPhase', '')
-            ws.range((row, 27)).value = element.get('projectSpec', '')
-            ws.range((row, 28)).value = element.get('motherCode', '')
+        # One range write per block of adjacent columns instead of one per cell
+        WBS_ROWS.write_xlwings(ws, layout.start_row, WBS_ROWS.iter_rows(wbs_data))
 
         # Save and close
         wb.save(temp_excel_path)
@@ -0,0 +1,130 @@
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+
+
+class ExportCache:
+    """Size-bounded LRU of generated workbooks keyed by content hash.
+
+    Entries evicted from memory are spilled to ``disk_dir`` and promoted back
+    on the next hit; the disk tier is itself trimmed oldest-first once it grows
+    past ``disk_max_bytes``. Keys are hex digests, so they double as filenames.
+    """
+
+    def __init__(self, max_bytes=None, disk_dir=None, disk_max_bytes=None):
+        self.max_bytes = max_bytes if max_bytes is not None else int(
+            os.getenv('EXPORT_CACHE_BYTES', str(64 * 1024 * 1024)))
+        self.disk_max_bytes = disk_max_bytes if disk_max_bytes is not None else int(
+            os.getenv('EXPORT_CACHE_DISK_BYTES', str(1024 * 1024 * 1024)))
+        self.disk_dir = disk_dir or os.getenv(
+            'EXPORT_CACHE_DIR', os.path.join(tempfile.gettempdir(), 'wbs_export_cache'))
+        self._memory = OrderedDict()
+        self._memory_bytes = 0
+        self._disk = OrderedDict()
+        self._disk_bytes = 0
+        self._lock = threading.Lock()
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        if self.disk_max_bytes > 0:
+            os.makedirs(self.disk_dir, exist_ok=True)
+            entries = []
+            for name in os.listdir(self.disk_dir):
+                if name.endswith('.xlsm'):
+                    stat = os.stat(os.path.join(self.disk_dir, name))
+                    entries.append((stat.st_mtime, name[:-5], stat.st_size))
+            for _, key, size in sorted(entries):
+                self._disk[key] = size
+                self._disk_bytes += size
+
+    def _path(self, key):
+        return os.path.join(self.disk_dir, key + '.xlsm')
+
+    def get(self, key):
+        """Return the cached bytes for key, or None."""
+        with self._lock:
+            data = self._memory.get(key)
+            if data is not None:
+                self._memory.move_to_end(key)
+                self.memory_hits += 1
+                return data
+            on_disk = key in self._disk
+        if on_disk:
+            try:
+                with open(self._path(key), 'rb') as f:
+                    data = f.read()
+            except OSError:
+                data = None
+                with self._lock:
+                    self._disk_bytes -= self._disk.pop(key, 0)
+            if data is not None:
+                # Promote back to memory; the file is no longer needed
+                with self._lock:
+                    self.disk_hits += 1
+                    self._disk_bytes -= self._disk.pop(key, 0)
+                self._remove_file(key)
+                self.put(key, data)
+                return data
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def put(self, key, data):
+        if len(data) > self.max_bytes:
+            self._spill(key, data)
+            return
+        with self._lock:
+            if key in self._memory:
+                self._memory_bytes -= len(self._memory.pop(key))
+            self._memory[key] = data
+            self._memory_bytes += len(data)
+            evicted = []
+            while self._memory_bytes > self.max_bytes:
+                old_key, old_data = self._memory.popitem(last=False)
+                self._memory_bytes -= len(old_data)
+                evicted.append((old_key, old_data))
+        for old_key, old_data in evicted:
+            self._spill(old_key, old_data)
+
+    def _spill(self, key, data):
+        if len(data) > self.disk_max_bytes:
+            return
+        tmp_path = self._path(key) + '.tmp'
+        try:
+            with open(tmp_path, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, self._path(key))
+        except OSError:
+            return
+        with self._lock:
+            if key in self._disk:
+                self._disk_bytes -= self._disk.pop(key)
+            self._disk[key] = len(data)
+            self._disk_bytes += len(data)
+            trimmed = []
+            while self._disk_bytes > self.disk_max_bytes:
+                old_key, size = self._disk.popitem(last=False)
+                self._disk_bytes -= size
+                trimmed.append(old_key)
+        for old_key in trimmed:
+            self._remove_file(old_key)
+
+    def _remove_file(self, key):
+        try:
+            os.remove(self._path(key))
+        except OSError:
+            pass
+
+    def stats(self):
+        with self._lock:
+            return {
+                'hits': self.memory_hits + self.disk_hits,
+                'memoryHits': self.memory_hits,
+                'diskHits': self.disk_hits,
+                'misses': self.misses,
+                'memoryEntries': len(self._memory),
+                'memoryBytes': self._memory_bytes,
+                'diskEntries': len(self._disk),
+                'diskBytes': self._disk_bytes,
+            }
@@ -0,0 +1,146 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    status TEXT NOT NULL,
+    region TEXT,
+    template_path TEXT NOT NULL,
+    template_version TEXT,
+    payload TEXT,
+    rows_total INTEGER NOT NULL,
+    rows_written INTEGER NOT NULL DEFAULT 0,
+    error TEXT,
+    result_path TEXT,
+    created_at REAL NOT NULL,
+    started_at REAL,
+    finished_at REAL,
+    expires_at REAL
+);
+CREATE INDEX IF NOT EXISTS jobs_status_created ON jobs (status, created_at);
+CREATE INDEX IF NOT EXISTS jobs_expires ON jobs (expires_at);
+'''
+
+
+class ExportJobStore:
+    """Export jobs persisted in SQLite so they survive a service restart.
+
+    Jobs move from 'queued' to 'running' to 'done' or 'failed'. Finished jobs
+    get an ``expires_at`` of now + ``ttl`` seconds, after which ``expire``
+    removes the row and its result file.
+    """
+
+    def __init__(self, directory=None, ttl=None):
+        self.directory = directory or os.getenv(
+            'EXPORT_JOBS_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'export_jobs'))
+        self.ttl = ttl or float(os.getenv('EXPORT_JOB_TTL', str(24 * 3600)))
+        os.makedirs(self.directory, exist_ok=True)
+        self._conn = sqlite3.connect(
+            os.path.join(self.directory, 'jobs.sqlite3'), check_same_thread=False, isolation_level=None)
+        self._conn.row_factory = sqlite3.Row
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.executescript(SCHEMA)
+        self._lock = threading.Lock()
+
+    def _execute(self, sql, params=()):
+        with self._lock:
+            return self._conn.execute(sql, params).fetchall()
+
+    def result_path(self, job_id):
+        return os.path.join(self.directory, job_id + '.xlsm')
+
+    def create(self, template_path, region, wbs_data, template_version=None):
+        job_id = uuid.uuid4().hex
+        self._execute(
+            'INSERT INTO jobs (id, status, region, template_path, template_version, payload, rows_total,'
+            ' created_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+            (job_id, 'queued', region, template_path, template_version, json.dumps(wbs_data), len(wbs_data),
+             time.time()),
+        )
+        return job_id
+
+    def get(self, job_id):
+        rows = self._execute('SELECT * FROM jobs WHERE id = ?', (job_id,))
+        return dict(rows[0]) if rows else None
+
+    def requeue_running(self):
+        """Put jobs interrupted by a restart back in the queue."""
+        self._execute(
+            "UPDATE jobs SET status = 'queued', rows_written = 0, started_at = NULL"
+            " WHERE status = 'running'")
+
+    def claim_next(self):
+        """Mark the oldest queued job as running and return it, or None."""
+        rows = self._execute(
+            "UPDATE jobs SET status = 'running', started_at = ?"
+            " WHERE id = (SELECT id FROM jobs WHERE status = 'queued' ORDER BY created_at LIMIT 1)"
+            " RETURNING *",
+            (time.time(),),
+        )
+        if not rows:
+            return None
+        job = dict(rows[0])
+        job['wbs_data'] = json.loads(job.pop('payload'))
+        return job
+
+    def requeue(self, job_id):
+        self._execute(
+            "UPDATE jobs SET status = 'queued', rows_written = 0, started_at = NULL WHERE id = ?", (job_id,))
+
+    def progress(self, job_id, rows_written):
+        self._execute('UPDATE jobs SET rows_written = ? WHERE id = ?', (rows_written, job_id))
+
+    def finish(self, job_id, result_path):
+        now = time.time()
+        self._execute(
+            "UPDATE jobs SET status = 'done', payload = NULL, result_path = ?, rows_written = rows_total,"
+            " finished_at = ?, expires_at = ? WHERE id = ?",
+            (result_path, now, now + self.ttl, job_id),
+        )
+
+    def fail(self, job_id, error):
+        now = time.time()
+        self._execute(
+            "UPDATE jobs SET status = 'failed', payload = NULL, error = ?, finished_at = ?, expires_at = ?"
+            " WHERE id = ?",
+            (error, now, now + self.ttl, job_id),
+        )
+
+    def expire(self, now=None):
+        """Delete finished jobs past their TTL along with their result files."""
+        now = now or time.time()
+        rows = self._execute(
+            'DELETE FROM jobs WHERE expires_at IS NOT NULL AND expires_at < ? RETURNING result_path', (now,))
+        for row in rows:
+            if row['result_path']:
+                try:
+                    os.remove(row['result_path'])
+                except OSError:
+                    pass
+        return len(rows)
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+def job_status(job):
+    """The public view of a job row."""
+    return {
+        'id': job['id'],
+        'status': job['status'],
+        'region': job['region'],
+        'templateVersion': job['template_version'],
+        'rowsWritten': job['rows_written'],
+        'rowsTotal': job['rows_total'],
+        'error': job['error'],
+        'createdAt': job['created_at'],
+        'startedAt': job['started_at'],
+        'finishedAt': job['finished_at'],
+        'expiresAt': job['expires_at'],
+    }
@@ -0,0 +1,74 @@
+import time
+from contextlib import contextmanager
+
+from prometheus_client import Counter, Gauge, Histogram, generate_latest
+
+STAGE_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+ROW_BUCKETS = (1, 10, 100, 1000, 10000, 100000, 1000000)
+
+STAGE_SECONDS = Histogram(
+    'wbs_export_stage_seconds', 'Time spent in each stage of an export', ['stage'], buckets=STAGE_BUCKETS)
+EXPORT_ROWS = Histogram('wbs_export_rows', 'WBS elements per export', buckets=ROW_BUCKETS)
+BYTES_OUT = Counter('wbs_export_bytes_out', 'Bytes of exported workbooks sent to clients')
+IN_FLIGHT = Gauge('wbs_exports_in_flight', 'Exports currently being built or sent')
+EXPORT_ERRORS = Counter('wbs_export_errors', 'Failed exports', ['region'])
+
+# Prometheus text format; Starlette appends the charset itself
+METRICS_MEDIA_TYPE = 'text/plain; version=0.0.4'
+
+
+def render_metrics():
+    return generate_latest()
+
+
+class ExportTrace:
+    """Stage timings and outcome of one export.
+
+    Stages are template (load or clone), fill, save and send, plus queue
+    (waiting for a pool worker) and cache (export cache lookup). Each stage
+    is observed in STAGE_SECONDS as soon as it is reported, and kept for the
+    response's Server-Timing header. The export counts as in flight from
+    creation until ``finish``.
+    """
+
+    def __init__(self, region=None):
+        self.region = region
+        self.stages = {}
+        self.finished = False
+        IN_FLIGHT.inc()
+
+    def stage(self, name, seconds):
+        STAGE_SECONDS.labels(name).observe(seconds)
+        self.stages[name] = self.stages.get(name, 0) + seconds
+
+    @contextmanager
+    def timed(self, name):
+        start = time.perf_counter()
+        yield
+        self.stage(name, time.perf_counter() - start)
+
+    def finish(self, rows=None, bytes_out=0, error=False):
+        if self.finished:
+            return
+        self.finished = True
+        IN_FLIGHT.dec()
+        if rows is not None:
+            EXPORT_ROWS.observe(rows)
+        if bytes_out:
+            BYTES_OUT.inc(bytes_out)
+        if error:
+            EXPORT_ERRORS.labels(self.region or 'unknown').inc()
+
+
+def server_timing(*traces):
+    """Server-Timing header value with the stages of traces summed, in ms."""
+    stages = {}
+    for trace in traces:
+        for name, seconds in trace.stages.items():
+            stages[name] = stages.get(name, 0) + seconds
+    return ', '.join(f'{name};dur={seconds * 1000:.1f}' for name, seconds in stages.items())
+
+
+def timing_headers(*traces):
+    # Timing-Allow-Origin lets the browser show the timings for a cross-origin fetch
+    return {'Server-Timing': server_timing(*traces), 'Timing-Allow-Origin': '*'}
@@ -0,0 +1,252 @@
+import asyncio
+import multiprocessing
+import os
+import time
+
+from template_cache import template_cache
+
+
+class PoolBusy(Exception):
+    """Raised when the export queue is full."""
+
+    def __init__(self, retry_after):
+        super().__init__(f"Export queue is full, retry after {retry_after}s")
+        self.retry_after = retry_after
+
+
+class ExportTimeout(Exception):
+    """Raised when an export job runs past the pool's timeout."""
+
+
+def _cache_counters():
+    stats = template_cache.stats()
+    return {key: stats[key] for key in ('hits', 'misses', 'reloads')}
+
+
+class _PipeWriter:
+    """Write-only file object that forwards output to the parent in chunks."""
+
+    def __init__(self, conn, chunk_size):
+        self.conn = conn
+        self.chunk_size = chunk_size
+        self.buffer = bytearray()
+
+    def announce_size(self, size):
+        self.conn.send(('size', size))
+
+    def write(self, data):
+        self.buffer += data
+        if len(self.buffer) >= self.chunk_size:
+            self.close()
+        return len(data)
+
+    def writelines(self, chunks):
+        for chunk in chunks:
+            self.write(chunk)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        if self.buffer:
+            self.conn.send(('chunk', bytes(self.buffer)))
+            self.buffer = bytearray()
+
+
+def _worker_main(conn, initializer, initargs):
+    if initializer is not None:
+        initializer(*initargs)
+    while True:
+        try:
+            func, args, kwargs, chunk_size, report_progress, report_timing = conn.recv()
+        except (EOFError, OSError):
+            return
+        if report_progress:
+            kwargs = dict(kwargs, progress=lambda rows: conn.send(('progress', rows)))
+        if report_timing:
+            kwargs = dict(kwargs, timing=lambda stage, seconds: conn.send(('timing', stage, seconds)))
+        try:
+            if chunk_size:
+                out = _PipeWriter(conn, chunk_size)
+                reply = ('ok', func(*args, out=out, **kwargs))
+                out.close()
+            else:
+                reply = ('ok', func(*args, **kwargs))
+        except Exception as e:
+            reply = ('error', e)
+        try:
+            conn.send(reply + (_cache_counters(),))
+        except Exception as e:
+            # The exception itself could not be pickled
+            conn.send(('error', RuntimeError(f"{type(e).__name__}: {e}"), _cache_counters()))
+
+
+class _Worker:
+    def __init__(self, ctx, initializer, initargs):
+        self.conn, child_conn = ctx.Pipe()
+        self.process = ctx.Process(
+            target=_worker_main, args=(child_conn, initializer, initargs), daemon=True)
+        self.process.start()
+        child_conn.close()
+        self.cache_counters = {}
+
+    def kill(self):
+        self.process.kill()
+        self.process.join()
+        self.conn.close()
+
+    async def retire(self):
+        """Kill the process without blocking the event loop on the join."""
+        self.process.kill()
+        await asyncio.to_thread(self.process.join)
+        self.conn.close()
+
+
+class ExportPool:
+    """A fixed set of worker processes that build workbooks off the event loop.
+
+    Workers are started with ``initializer`` so they hold the template before
+    the first job arrives. At most ``workers + max_queue`` jobs are accepted at
+    once; beyond that ``run`` and ``stream`` raise PoolBusy. A job that exceeds ``timeout``
+    seconds has its worker killed and replaced; the other workers keep going.
+    """
+
+    def __init__(self, workers=None, max_queue=None, timeout=None, retry_after=None,
+                 initializer=None, initargs=()):
+        self.workers = workers or int(os.getenv('EXPORT_WORKERS', os.cpu_count() or 2))
+        self.max_queue = max_queue if max_queue is not None else int(os.getenv('EXPORT_QUEUE_SIZE', '16'))
+        self.timeout = timeout or float(os.getenv('EXPORT_TIMEOUT', '60'))
+        self.retry_after = retry_after or int(os.getenv('EXPORT_RETRY_AFTER', '5'))
+        self.initializer = initializer
+        self.initargs = initargs
+        self._ctx = multiprocessing.get_context('spawn')
+        self._all = []
+        self._idle = None
+        self.pending = 0
+        self.timeouts = 0
+        self.restarts = 0
+        self.rejected = 0
+
+    def _spawn(self):
+        worker = _Worker(self._ctx, self.initializer, self.initargs)
+        self._all.append(worker)
+        return worker
+
+    async def _retire(self, worker):
+        self._all.remove(worker)
+        self.restarts += 1
+        replacement = self._spawn()
+        await worker.retire()
+        return replacement
+
+    def start(self):
+        self._idle = asyncio.Queue()
+        for _ in range(self.workers):
+            self._idle.put_nowait(self._spawn())
+
+    def close(self):
+        for worker in self._all:
+            worker.kill()
+        self._all = []
+
+    def _admit(self):
+        if self.pending >= self.workers + self.max_queue:
+            self.rejected += 1
+            raise PoolBusy(self.retry_after)
+        self.pending += 1
+
+    def _recv(self, worker, deadline, timeout):
+        if not worker.conn.poll(max(deadline - time.monotonic(), 0)):
+            raise ExportTimeout(f"Export did not finish within {timeout:g}s")
+        return worker.conn.recv()
+
+    async def _job(self, func, args, kwargs, chunk_size=0, on_progress=None, on_timing=None, timeout=None):
+        timeout = timeout or self.timeout
+        self._admit()
+        try:
+            queued = time.monotonic()
+            worker = await self._idle.get()
+            finished = False
+            try:
+                loop = asyncio.get_running_loop()
+                if on_timing is not None:
+                    on_timing('queue', time.monotonic() - queued)
+                deadline = time.monotonic() + timeout
+                job = (func, args, kwargs, chunk_size, on_progress is not None, on_timing is not None)
+                await loop.run_in_executor(None, worker.conn.send, job)
+                while True:
+                    message = await loop.run_in_executor(None, self._recv, worker, deadline, timeout)
+                    if message[0] == 'progress':
+                        on_progress(message[1])
+                        continue
+                    if message[0] == 'timing':
+                        on_timing(message[1], message[2])
+                        continue
+                    if message[0] in ('size', 'chunk'):
+                        yield message
+                        continue
+                    finished = True
+                    status, value, worker.cache_counters = message
+                    if status == 'error':
+                        raise value
+                    yield ('result', value)
+                    return
+            except BaseException as e:
+                if not finished:
+                    # Timed out, crashed or abandoned: the worker's state is unknown
+                    if isinstance(e, ExportTimeout):
+                        self.timeouts += 1
+                    worker = await self._retire(worker)
+                raise
+            finally:
+                self._idle.put_nowait(worker)
+        finally:
+            self.pending -= 1
+
+    async def run(self, func, *args, on_progress=None, on_timing=None, timeout=None, **kwargs):
+        """Run func(*args, **kwargs) in a worker process and return its result.
+
+        With on_progress, func is also passed a ``progress`` callable whose
+        calls are relayed to on_progress in the event loop. Likewise with
+        on_timing, func is passed a ``timing(stage, seconds)`` callable, and
+        on_timing also receives the 'queue' time spent waiting for a worker.
+        timeout overrides the pool's default for this job.
+        """
+        job = self._job(func, args, kwargs, 0, on_progress, on_timing, timeout)
+        try:
+            async for kind, value in job:
+                if kind == 'result':
+                    return value
+        finally:
+            # Hands the worker back now rather than when the generator is collected
+            await job.aclose()
+
+    async def stream(self, func, *args, chunk_size=65536, on_timing=None, **kwargs):
+        """Run func(*args, out=<file>, **kwargs) in a worker, yielding its output.
+
+        Yields ('size', total) if func announces the total size up front,
+        then ('chunk', bytes) pieces as the worker writes them. on_timing is
+        as for ``run``.
+        """
+        job = self._job(func, args, kwargs, chunk_size, on_timing=on_timing)
+        try:
+            async for kind, value in job:
+                if kind != 'result':
+                    yield kind, value
+        finally:
+            await job.aclose()
+
+    def stats(self):
+        cache = {'hits': 0, 'misses': 0, 'reloads': 0}
+        for worker in self._all:
+            for key, value in worker.cache_counters.items():
+                cache[key] += value
+        return {
+            'workers': self.workers,
+            'maxQueue': self.max_queue,
+            'pending': self.pending,
+            'timeouts': self.timeouts,
+            'restarts': self.restarts,
+            'rejected': self.rejected,
+            'templateCache': cache,
+        }
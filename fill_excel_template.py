@@ -1,159 +1,315 @@
-from fastapi import FastAPI, HTTPException
-from fastapi.middleware.cors import CORSMiddleware
-import openpyxl
+import argparse
 import os
-import tempfile
 import json
-from fastapi.responses import StreamingResponse
+import hashlib
+import itertools
 import io
+import signal
+import socketserver
+import struct
 import sys
+import time
+import traceback
+from template_cache import template_cache
+from template_registry import SHEET_NAME, template_layout, template_registry
+from wbs_columns import BATCH_SIZE, WBS_ROWS
+from wbs_lookups import wbs_lookups
+import xlsx_patch
 
-app = FastAPI()
-
-app.add_middleware(
-    CORSMiddleware,
-    allow_origins=["https://mdm-vattenflow.vercel.app"],
-    allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"],
-)
-
-# Add region full name mapping at the top
-REGION_FULL_NAMES = {
-    'DE': 'Germany',
-    'NL': 'Netherlands',
-    'UK': 'Nordic',
-    'SE': 'Nordic',
-    'DK': 'Nordic'
-}
-
-def get_full_region_name(region_code):
-    return REGION_FULL_NAMES.get(region_code, region_code)
-
-def combine_code_label(code, label):
-    if code and label and str(code) not in str(label):
-        return f"{code} {label}"
-    elif label:
-        return label
-    elif code:
-        return code
-    return ''
-
-def get_template_path(region):
-    """Get the appropriate template path based on region."""
-    # For now, using the same template for all regions
-    # In the future, you can add region-specific templates here
-    return os.path.join(os.path.dirname(__file__), 'templates', 'wbs_template_actual.xlsm')
-
-def fill_excel_template(template_path, output_path, wbs_data):
-    wb = openpyxl.load_workbook(template_path, keep_vba=True)
-    ws = wb['Shared Template']
-    start_row = 18
-    ws['D7'] = wbs_data[0].get('requesterDisplayName', '') if wbs_data else ''
-    ws['D8'] = wbs_data[0].get('responsiblePerson', '') if wbs_data else ''
-    # Helper to write integer if possible
-    def write_int(ws, row, col, value):
-        try:
-            if value is not None and value != '':
-                ws.cell(row=row, column=col, value=int(value))
-            else:
-                ws.cell(row=row, column=col, value=value)
-        except Exception:
-            ws.cell(row=row, column=col, value=value)
-
-    for i, element in enumerate(wbs_data):
-        row = start_row + i
-        # Use full region name
-        region_code = element.get('region', '')
-        ws.cell(row=row, column=1, value=get_full_region_name(region_code))
-        ws.cell(row=row, column=2, value=element.get('type', ''))
-        ws.cell(row=row, column=3, value=element.get('system', 'KIS'))
-        # Combine code and label for controlling area
-        controlling_area = combine_code_label(
-            element.get('controllingArea', ''),
-            element.get('controllingAreaLabel', '')
-        )
-        ws.cell(row=row, column=4, value=controlling_area)
-        write_int(ws, row, 5, element.get('companyCode', ''))
-        ws.cell(row=row, column=6, value=element.get('projectName', ''))
-        ws.cell(row=row, column=7, value=element.get('projectDefinition', ''))
-        write_int(ws, row, 8, element.get('level', ''))
-        ws.cell(row=row, column=9, value=element.get('projectType', ''))
-        write_int(ws, row, 10, element.get('investmentProfile', ''))
-        write_int(ws, row, 11, element.get('responsibleProfitCenter', ''))
-        write_int(ws, row, 12, element.get('responsibleCostCenter', ''))
-        ws.cell(row=row, column=13, value='x' if element.get('planningElement') else '')
-        ws.cell(row=row, column=14, value='x' if element.get('rubricElement') else '')
-        ws.cell(row=row, column=15, value='x' if element.get('billingElement') else '')
-        percent = element.get('settlementRulePercent', '')
-        if percent not in ('', None):
-            try:
-                ws.cell(row=row, column=16, value=float(percent) / 100)
-            except Exception:
-                ws.cell(row=row, column=16, value=percent)
+DEFAULT_ENGINE = os.getenv('EXPORT_ENGINE', 'openpyxl')
+PROGRESS_EVERY = 500
+# Daemon frames are a 4-byte big-endian length followed by the payload
+FRAME_HEADER = struct.Struct('>I')
+
+def get_template(region, request_type=None):
+    """Get the registered template (path, version and layout) for an export."""
+    return template_registry.resolve(region, request_type)
+
+def get_template_path(region, request_type=None):
+    """Get the appropriate template path based on region and request type."""
+    return get_template(region, request_type).path
+
+def header_rows(layout, wbs_data):
+    """The Business Controller and Business Responsible cells as (row, {column: value})."""
+    rows = {}
+    for (row, column), value in layout.header_values(wbs_data).items():
+        rows.setdefault(row, {})[column] = value
+    return sorted(rows.items())
+
+def wbs_sheet_rows(wbs_data, start_row):
+    """Yield (row, {column: value}) for every WBS element, from start_row down."""
+    for row_number, row in enumerate(WBS_ROWS.iter_rows(wbs_data), start_row):
+        yield row_number, WBS_ROWS.cells(row)
+
+def export_key(template_path, wbs_data, engine=None):
+    """Hash of the template version and every value the export would write."""
+    digest = hashlib.sha256()
+    digest.update(template_cache.version(template_path).encode())
+    digest.update((engine or DEFAULT_ENGINE).encode())
+    digest.update(json.dumps(header_rows(template_layout(template_path), wbs_data), default=str).encode())
+    for row in WBS_ROWS.iter_rows(wbs_data):
+        digest.update(b'\n')
+        digest.update(json.dumps(row, default=str).encode())
+    return digest.hexdigest()
+
+def report_progress(rows, progress, every=PROGRESS_EVERY):
+    """Yield from rows, calling progress(count) every few rows and at the end."""
+    count = 0
+    for count, row in enumerate(rows, 1):
+        yield row
+        if count % every == 0:
+            progress(count)
+    progress(count)
+
+class StageClock:
+    """Reports the time since the previous mark to timing(stage, seconds)."""
+
+    def __init__(self, timing):
+        self.timing = timing
+        self.last = time.perf_counter()
+
+    def mark(self, stage):
+        now = time.perf_counter()
+        if self.timing is not None:
+            self.timing(stage, now - self.last)
+        self.last = now
+
+def fill_excel_template(template_path, output_path, wbs_data, engine=None, progress=None, timing=None):
+    """Fill the 'Shared Template' sheet with wbs_data and save to output_path.
+
+    output_path may also be a writable binary file object; it does not need
+    to be seekable, so the workbook can be streamed as it is produced.
+
+    engine selects the writer: 'openpyxl' (default) loads and re-saves the
+    whole workbook, 'xml' patches the sheet XML inside the template package
+    and copies every other part unchanged. EXPORT_ENGINE sets the default.
+    progress, if given, is called with the number of WBS rows written so far.
+    timing, if given, is called with (stage, seconds) as the 'template',
+    'fill' and 'save' stages complete.
+    """
+    engine = engine or DEFAULT_ENGINE
+    clock = StageClock(timing)
+    # Where the header cells and the first WBS row are in this template
+    layout = template_layout(template_path)
+    if engine == 'xml':
+        template = xlsx_patch.get_patch_template(template_path, SHEET_NAME)
+        clock.mark('template')
+        rows = header_rows(layout, wbs_data)
+        element_rows = wbs_sheet_rows(wbs_data, layout.start_row)
+        if progress is not None:
+            element_rows = report_progress(element_rows, progress)
+        rows = itertools.chain(rows, element_rows)
+        sheet = template.render_sheet(rows).encode('utf-8')
+        clock.mark('fill')
+        data = template.package({template.sheet_part: sheet})
+        if hasattr(output_path, 'write'):
+            # The package size is known before the first byte is written
+            if hasattr(output_path, 'announce_size'):
+                output_path.announce_size(sum(len(chunk) for chunk in data))
+            output_path.writelines(data)
         else:
-            ws.cell(row=row, column=16, value='')
-        ws.cell(row=row, column=17, value=element.get('settlementRuleGoal', ''))
-        ws.cell(row=row, column=18, value=element.get('projectProfile', ''))
-        ws.cell(row=row, column=19, value=element.get('responsiblePerson', ''))
-        ws.cell(row=row, column=20, value=element.get('userId', ''))
-        write_int(ws, row, 21, element.get('employmentNumber', ''))
-        # Combine code and label for functional area
-        functional_area = combine_code_label(
-            element.get('functionalArea', ''),
-            element.get('functionalAreaLabel', '')
-        )
-        ws.cell(row=row, column=22, value=functional_area)
-        ws.cell(row=row, column=24, value=element.get('comment', ''))
-        ws.cell(row=row, column=25, value=element.get('tm1Project', ''))
-        # Write tgPhase as integer if possible
-        write_int(ws, row, 26, element.get('tgPhase', ''))
-        # Project specification: if value is 'ASSET', write 'Asset' instead
-        project_spec = element.get('projectSpec', '')
-        if isinstance(project_spec, str) and project_spec.strip().upper() == 'ASSET':
-            ws.cell(row=row, column=27, value='Asset')
+            with open(output_path, 'wb') as f:
+                f.writelines(data)
+        clock.mark('save')
+        return
+    if engine != 'openpyxl':
+        raise ValueError(f"Unknown export engine: {engine}")
+    # Parsed copies of the template come from the in-memory cache
+    with template_cache.checkout(template_path) as wb:
+        clock.mark('template')
+        ws = wb[SHEET_NAME]
+        for (row, column), value in layout.header_values(wbs_data).items():
+            ws.cell(row=row, column=column, value=value)
+        rows = WBS_ROWS.iter_rows(wbs_data)
+        if progress is not None:
+            rows = report_progress(rows, progress)
+        WBS_ROWS.write_openpyxl(ws, layout.start_row, rows)
+        clock.mark('fill')
+        wb.save(output_path)
+        clock.mark('save')
+
+class WbsWorkbookStream:
+    """Incremental xml-engine export for WBS elements that arrive in batches.
+
+    The template is chosen from the first element's region and the request
+    type, and the header cells are taken from the first element. Rows are
+    deflated into out as each batch is written, so memory use does not
+    depend on the number of elements.
+    """
+
+    def __init__(self, out, request_type=None):
+        self.out = out
+        self.request_type = request_type
+        self.template = None
+        self.stream = None
+        self.count = 0
+
+    def write(self, elements):
+        if not elements:
+            return
+        rows = []
+        if self.stream is None:
+            self.template = get_template(elements[0].get('region'), self.request_type)
+            template = xlsx_patch.get_patch_template(self.template.path, SHEET_NAME)
+            self.stream = xlsx_patch.PackageStream(template, self.out)
+            rows = header_rows(self.template.layout, elements)
+        start_row = self.template.layout.start_row + self.count
+        rows.extend(
+            (row_number, WBS_ROWS.cells(row))
+            for row_number, row in enumerate(WBS_ROWS.rows(elements), start_row))
+        self.count += len(elements)
+        self.stream.write_rows(rows)
+
+    def close(self):
+        if self.stream is not None:
+            self.stream.close()
+
+def export_ndjson_file(ndjson_path, output_path, request_type=None, timing=None):
+    """Export the WBS elements in an NDJSON file (one per line) to output_path.
+
+    Runs in a pool worker; returns (rows written, template version).
+    """
+    clock = StageClock(timing)
+    with open(output_path, 'wb') as out:
+        writer = WbsWorkbookStream(out, request_type)
+        with open(ndjson_path, 'rb') as f:
+            while True:
+                lines = list(itertools.islice(f, BATCH_SIZE))
+                if not lines:
+                    break
+                writer.write([json.loads(line) for line in lines if line.strip()])
+        clock.mark('fill')
+        writer.close()
+    clock.mark('save')
+    return writer.count, writer.template.version if writer.template else None
+
+def warm_templates(template_paths, engine=None):
+    """Parse templates and lookup tables ahead of the first export (pool workers and the daemon)."""
+    engine = engine or DEFAULT_ENGINE
+    for template_path in template_paths:
+        # Also builds the xml engine's PatchTemplate
+        template_layout(template_path)
+        if engine != 'xml':
+            template_cache.preload(template_path)
+    wbs_lookups.tables()
+
+def export_workbook(template_path, wbs_data, engine=None, out=None, timing=None):
+    """Fill the template in memory and write it to out, or return the bytes."""
+    if out is not None:
+        fill_excel_template(template_path, out, wbs_data, engine, timing=timing)
+        return None
+    buffer = io.BytesIO()
+    fill_excel_template(template_path, buffer, wbs_data, engine, timing=timing)
+    return buffer.getvalue()
+
+def _read_exactly(stream, size):
+    data = bytearray()
+    while len(data) < size:
+        chunk = stream.read(size - len(data))
+        if not chunk:
+            if data:
+                raise EOFError('Connection closed in the middle of a frame')
+            return None
+        data += chunk
+    return bytes(data)
+
+def read_frame(stream):
+    """Read one length-prefixed frame, or return None at end of input."""
+    header = _read_exactly(stream, FRAME_HEADER.size)
+    if header is None:
+        return None
+    (length,) = FRAME_HEADER.unpack(header)
+    data = _read_exactly(stream, length) if length else b''
+    if data is None:
+        raise EOFError('Connection closed in the middle of a frame')
+    return data
+
+def write_frame(stream, data):
+    stream.write(FRAME_HEADER.pack(len(data)))
+    stream.write(data)
+
+def serve_stream(reader, writer, engine=None):
+    """Answer fill requests from reader until it is closed.
+
+    Each request is one frame holding a JSON object: ``wbsData`` and
+    optionally ``requestType``, ``templatePath`` and ``engine``. Each reply
+    is a JSON frame, ``{"ok": true, "size": n, "templateVersion": v}``
+    followed by a frame with the workbook, or ``{"ok": false, "error": "..."}``
+    on its own. Replies are sent in request order. templateVersion is null
+    when the request named its own templatePath.
+    """
+    while True:
+        frame = read_frame(reader)
+        if frame is None:
+            return
+        try:
+            request = json.loads(frame)
+            wbs_data = request.get('wbsData') or []
+            template_path, version = request.get('templatePath'), None
+            if not template_path:
+                template = get_template(wbs_data[0].get('region') if wbs_data else None,
+                                        request.get('requestType'))
+                template_path, version = template.path, template.version
+            data = export_workbook(template_path, wbs_data, request.get('engine') or engine)
+        except Exception as e:
+            traceback.print_exc()
+            write_frame(writer, json.dumps({'ok': False, 'error': str(e)}).encode('utf-8'))
         else:
-            ws.cell(row=row, column=27, value=project_spec)
-        ws.cell(row=row, column=28, value=element.get('motherCode', ''))
-    wb.save(output_path)
-
-@app.post("/export")
-async def export_excel(payload: dict):
-    wbs_data = payload.get("wbsData", [])
-    if not wbs_data:
-        raise HTTPException(status_code=400, detail="No WBS data provided")
-
-    try:
-        # Get the region from the first WBS element
-        region = wbs_data[0].get('region')
-        if not region:
-            raise HTTPException(status_code=400, detail="Region not specified in WBS data")
-
-        # Get the appropriate template for this region
-        template_path = get_template_path(region)
-        
-        # Create a temporary file for the output
-        with tempfile.NamedTemporaryFile(suffix='.xlsm', delete=False) as tmp:
-            # Fill the template with the WBS data
-            fill_excel_template(template_path, tmp.name, wbs_data)
-            tmp.seek(0)
-            excel_data = tmp.read()
-            
-        # Clean up the temporary file
-        os.unlink(tmp.name)
-        
-        # Return the filled template as a downloadable file
-        return StreamingResponse(
-            io.BytesIO(excel_data),
-            media_type="application/vnd.ms-excel.sheet.macroEnabled.12",
-            headers={"Content-Disposition": "attachment; filename=wbs_export.xlsm"}
-        )
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
+            reply = {'ok': True, 'size': len(data), 'templateVersion': version}
+            write_frame(writer, json.dumps(reply).encode('utf-8'))
+            write_frame(writer, data)
+        writer.flush()
+
+def serve(socket_path=None, engine=None, template_paths=None):
+    """Run as a long-lived fill worker on stdin/stdout or a Unix socket."""
+    warm_templates(template_paths or template_registry.paths(), engine)
+    if socket_path is None:
+        # Frames own stdout; anything printed goes to stderr instead
+        writer = sys.stdout.buffer
+        sys.stdout = sys.stderr
+        serve_stream(sys.stdin.buffer, writer, engine)
+        return
+
+    class Handler(socketserver.StreamRequestHandler):
+        def handle(self):
+            try:
+                serve_stream(self.rfile, self.wfile, engine)
+            except (EOFError, ConnectionError):
+                pass
+
+    if os.path.exists(socket_path):
+        # Left behind by a previous run
+        os.remove(socket_path)
+    # Exit through the finally below so the socket file is removed
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    with socketserver.ThreadingUnixStreamServer(socket_path, Handler) as server:
+        # Do not wait for idle client connections on shutdown
+        server.daemon_threads = True
+        server.block_on_close = False
+        print(f'Fill worker listening on {socket_path}', file=sys.stderr)
+        try:
+            server.serve_forever()
+        finally:
+            os.remove(socket_path)
 
 if __name__ == '__main__':
+    if sys.argv[1:2] == ['--serve']:
+        parser = argparse.ArgumentParser(
+            prog='fill_excel_template.py --serve',
+            description='Fill templates for framed requests on stdin/stdout or a Unix socket.')
+        parser.add_argument('--socket', help='listen on this Unix socket instead of stdin/stdout')
+        parser.add_argument('--engine', choices=['openpyxl', 'xml'], help='default export engine')
+        parser.add_argument('--template', action='append',
+                            help='template to load up front (repeatable; default: every registered template)')
+        args = parser.parse_args(sys.argv[2:])
+        try:
+            serve(args.socket, args.engine, args.template)
+        except (KeyboardInterrupt, EOFError):
+            pass
+        sys.exit(0)
     if len(sys.argv) != 4:
         print('Usage: python fill_excel_template.py <template_path> <output_path> <wbs_data_json>')
+        print('       python fill_excel_template.py --serve [--socket PATH] [--engine xml] [--template PATH]')
         sys.exit(1)
     template_path = sys.argv[1]
     output_path = sys.argv[2]
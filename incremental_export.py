@@ -0,0 +1,287 @@
+"""Re-export a request's workbook by rewriting only the rows that changed.
+
+After every export of a request (one per region) the rendered XML of each
+WBS row is kept together with a fingerprint of the element it came from
+and the workbook itself. A re-export fingerprints the new wbsData, lines it
+up with the previous fingerprints and only converts and renders the
+elements that changed or were inserted; the other rows are reused as they
+are, or renumbered when rows above them were inserted or deleted. A
+re-export without changes returns the kept workbook. Anything that changes
+every row (another template version, new lookup tables or new header
+values) starts over with a full export.
+
+The sheet is still deflated in one pass by zlib, but no Python work is
+spent on unchanged rows.
+"""
+import difflib
+import hashlib
+import json
+import os
+import tempfile
+import time
+
+import xlsx_patch
+from fill_excel_template import StageClock, get_template, header_rows
+from template_registry import SHEET_NAME
+from wbs_columns import BATCH_SIZE, WBS_ROWS
+from wbs_lookups import wbs_lookups
+
+# Bumped when the history file layout changes; older files are ignored
+HISTORY_FORMAT = 1
+# A save prunes the history directory at most this often (seconds)
+PRUNE_INTERVAL = 300
+
+
+class NoPreviousExport(Exception):
+    """Raised for a changes-only export when there is no earlier export to compare with."""
+
+
+_fingerprint_encoder = json.JSONEncoder(sort_keys=True, separators=(',', ':'), default=str)
+
+
+def element_fingerprint(element):
+    """Hash of everything in a WBS element that can end up in its row."""
+    data = _fingerprint_encoder.encode(element).encode('utf-8')
+    return hashlib.blake2b(data, digest_size=12).hexdigest()
+
+
+def _context(template, header, start_row):
+    """Hash of what every row depends on besides its own element."""
+    data = json.dumps([template.sha256, wbs_lookups.tables().version, start_row, header], default=str)
+    return hashlib.sha256(data.encode('utf-8')).hexdigest()
+
+
+def diff_fingerprints(old, new):
+    """Return difflib-style opcodes (tag, i1, i2, j1, j2) turning old into new.
+
+    The common head and tail are matched directly, so an edit of a few rows
+    only runs the sequence matcher over the rows between the first and the
+    last change.
+    """
+    head = 0
+    limit = min(len(old), len(new))
+    while head < limit and old[head] == new[head]:
+        head += 1
+    tail = 0
+    while tail < limit - head and old[-1 - tail] == new[-1 - tail]:
+        tail += 1
+    old_end, new_end = len(old) - tail, len(new) - tail
+    opcodes = [('equal', 0, head, 0, head)] if head else []
+    if head < old_end and head < new_end:
+        matcher = difflib.SequenceMatcher(None, old[head:old_end], new[head:new_end], autojunk=False)
+        opcodes.extend((tag, i1 + head, i2 + head, j1 + head, j2 + head)
+                       for tag, i1, i2, j1, j2 in matcher.get_opcodes())
+    elif head < old_end:
+        opcodes.append(('delete', head, old_end, head, head))
+    elif head < new_end:
+        opcodes.append(('insert', head, head, head, new_end))
+    if tail:
+        opcodes.append(('equal', old_end, len(old), new_end, len(new)))
+    return opcodes
+
+
+class ExportRecord:
+    """The last export of one request and region, as kept on disk."""
+
+    def __init__(self, meta, rows_xml, workbook):
+        self.meta = meta
+        self.rows_xml = rows_xml
+        self.workbook = workbook
+
+    @property
+    def fingerprints(self):
+        return self.meta['fingerprints']
+
+    def row(self, index):
+        return self.rows_xml[index]
+
+
+class ExportHistory:
+    """Last exports by request id and region, one file each.
+
+    A file is a JSON header line (context, fingerprints and row sizes)
+    followed by the rendered rows and the workbook. Files are replaced
+    atomically, so a reader never sees half of one. Files not rewritten for
+    ``max_age`` seconds are removed, and the oldest go first once the
+    directory grows past ``max_bytes``; a re-export after that is a full one.
+    """
+
+    def __init__(self, directory=None, max_age=None, max_bytes=None):
+        self.directory = directory or os.getenv(
+            'EXPORT_HISTORY_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'export_history'))
+        self.max_age = max_age if max_age is not None else float(
+            os.getenv('EXPORT_HISTORY_DAYS', '90')) * 86400
+        self.max_bytes = max_bytes if max_bytes is not None else int(
+            os.getenv('EXPORT_HISTORY_BYTES', str(1024 * 1024 * 1024)))
+        self._pruned = 0.0
+
+    def path(self, request_id, region):
+        name = hashlib.sha256(f'{request_id}\0{region}'.encode('utf-8')).hexdigest()[:32]
+        return os.path.join(self.directory, name + '.wbs')
+
+    def load(self, request_id, region):
+        try:
+            with open(self.path(request_id, region), 'rb') as f:
+                meta = json.loads(f.readline())
+                if meta.get('format') != HISTORY_FORMAT:
+                    return None
+                rows_xml = []
+                for size in meta['rowSizes']:
+                    rows_xml.append(f.read(size).decode('utf-8'))
+                workbook = f.read()
+        except FileNotFoundError:
+            return None
+        except (ValueError, KeyError, UnicodeDecodeError):
+            # Unreadable history only costs a full export
+            return None
+        if len(workbook) != meta.get('workbookSize'):
+            return None
+        return ExportRecord(meta, rows_xml, workbook)
+
+    def save(self, request_id, region, meta, rows_xml, workbook):
+        os.makedirs(self.directory, exist_ok=True)
+        encoded = [row.encode('utf-8') for row in rows_xml]
+        meta = dict(meta, format=HISTORY_FORMAT, requestId=request_id, region=region,
+                    rowSizes=[len(row) for row in encoded], workbookSize=len(workbook))
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, prefix='.tmp-')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(json.dumps(meta).encode('utf-8') + b'\n')
+                f.writelines(encoded)
+                f.write(workbook)
+            os.replace(tmp_path, self.path(request_id, region))
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        if time.time() - self._pruned >= PRUNE_INTERVAL:
+            self.prune()
+
+    def prune(self, now=None):
+        """Remove expired files, then the oldest until under max_bytes; return how many."""
+        now = now or time.time()
+        self._pruned = now
+        files = []
+        try:
+            with os.scandir(self.directory) as entries:
+                for entry in entries:
+                    try:
+                        stat = entry.stat()
+                    except FileNotFoundError:
+                        continue
+                    if entry.name.startswith('.tmp-'):
+                        # Left behind by a worker that was killed mid-save
+                        if now - stat.st_mtime > PRUNE_INTERVAL:
+                            files.append((0, entry.path, stat.st_size))
+                    elif entry.name.endswith('.wbs'):
+                        files.append((stat.st_mtime, entry.path, stat.st_size))
+        except FileNotFoundError:
+            return 0
+        files.sort()
+        total = sum(size for _, _, size in files)
+        removed = 0
+        for mtime, path, size in files:
+            if now - mtime <= self.max_age and total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+                removed += 1
+            except FileNotFoundError:
+                pass
+            total -= size
+        return removed
+
+    def forget(self, request_id, region):
+        try:
+            os.remove(self.path(request_id, region))
+            return True
+        except FileNotFoundError:
+            return False
+
+
+export_history = ExportHistory()
+
+
+def export_request(request_id, wbs_data, request_type=None, changes_only=False, timing=None, history=None):
+    """Export a request's WBS elements, reusing the rows of its last export.
+
+    Returns (workbook bytes, summary). With changes_only the workbook only
+    holds the rows that changed or were inserted since the last export
+    (deleted rows are counted in the summary); the kept export is still
+    brought up to date with the full wbsData. A changes-only export raises
+    NoPreviousExport if there is no kept export of the request and region
+    made with the same template, lookups and header.
+    """
+    history = history or export_history
+    clock = StageClock(timing)
+    region = wbs_data[0].get('region')
+    template_version = get_template(region, request_type)
+    template = xlsx_patch.get_patch_template(template_version.path, SHEET_NAME)
+    start_row = template_version.layout.start_row
+    header = header_rows(template_version.layout, wbs_data)
+    context = _context(template_version, header, start_row)
+    clock.mark('template')
+
+    fingerprints = [element_fingerprint(element) for element in wbs_data]
+    previous = history.load(request_id, region)
+    if previous is not None and previous.meta.get('context') != context:
+        previous = None
+    if previous is None and changes_only:
+        raise NoPreviousExport(f"No earlier export of request {request_id} for region {region} to compare with")
+    if previous is None:
+        opcodes = [('insert', 0, 0, 0, len(wbs_data))]
+    else:
+        opcodes = diff_fingerprints(previous.fingerprints, fingerprints)
+    summary = {
+        'rows': len(wbs_data), 'changed': 0, 'inserted': 0, 'deleted': 0, 'unchanged': 0,
+        'renumbered': 0, 'full': previous is None, 'templateVersion': template_version.version,
+    }
+    rows_xml = [None] * len(wbs_data)
+    # Elements to convert and render, and which of them actually changed
+    render, changed = [], []
+    for tag, i1, i2, j1, j2 in opcodes:
+        if tag == 'equal':
+            summary['unchanged'] += i2 - i1
+            for i, j in zip(range(i1, i2), range(j1, j2)):
+                if i == j:
+                    rows_xml[j] = previous.row(i)
+                elif template.row_format(start_row + i) == template.row_format(start_row + j):
+                    rows_xml[j] = xlsx_patch.renumber_row(previous.row(i), start_row + j)
+                    summary['renumbered'] += 1
+                else:
+                    render.append(j)
+            continue
+        old_count, new_count = i2 - i1, j2 - j1
+        summary['changed'] += min(old_count, new_count)
+        summary['inserted'] += max(new_count - old_count, 0)
+        summary['deleted'] += max(old_count - new_count, 0)
+        render.extend(range(j1, j2))
+        changed.extend(range(j1, j2))
+    clock.mark('diff')
+
+    if previous is not None and not changed and not summary['deleted'] and not changes_only:
+        summary['rendered'] = 0
+        return previous.workbook, summary
+
+    render.sort()
+    changed_cells = []
+    changed_set = set(changed) if changes_only else ()
+    for start in range(0, len(render), BATCH_SIZE):
+        batch = render[start:start + BATCH_SIZE]
+        for j, row in zip(batch, WBS_ROWS.rows([wbs_data[j] for j in batch])):
+            cells = WBS_ROWS.cells(row)
+            rows_xml[j] = template.row_xml(start_row + j, cells)
+            if j in changed_set:
+                changed_cells.append(cells)
+    summary['rendered'] = len(render)
+    clock.mark('fill')
+
+    sheet = template.render_sheet_rows(header, start_row, rows_xml).encode('utf-8')
+    workbook = b''.join(template.package({template.sheet_part: sheet}))
+    history.save(request_id, region, {'context': context, 'fingerprints': fingerprints}, rows_xml, workbook)
+    if changes_only:
+        changed_xml = [template.row_xml(start_row + k, cells) for k, cells in enumerate(changed_cells)]
+        sheet = template.render_sheet_rows(header, start_row, changed_xml).encode('utf-8')
+        workbook = b''.join(template.package({template.sheet_part: sheet}))
+    clock.mark('save')
+    return workbook, summary
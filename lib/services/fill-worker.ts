@@ -0,0 +1,180 @@
+import { spawn, ChildProcessWithoutNullStreams } from "child_process";
+
+// A fill that takes longer than this restarts the worker
+const FILL_TIMEOUT_MS = Number(process.env.FILL_TIMEOUT_MS) || 60_000;
+
+interface FillReply {
+  ok: boolean;
+  size?: number;
+  templateVersion?: string | null;
+  error?: string;
+}
+
+export interface FillResult {
+  workbook: Buffer;
+  templateVersion: string | null;
+}
+
+interface PendingFill {
+  resolve: (result: FillResult) => void;
+  reject: (error: Error) => void;
+}
+
+/**
+ * A long-lived `fill_excel_template.py --serve` process shared by every export.
+ *
+ * Requests and replies are frames: a 4-byte big-endian length followed by the
+ * payload. A request is one JSON frame; the reply is a JSON frame
+ * (`{ ok: true, size, templateVersion }` or `{ ok: false, error }`) followed, on success, by a
+ * frame holding the workbook. Replies come back in request order, so pending
+ * requests are kept in a FIFO. The worker is restarted on the next request if
+ * it exits. If it cannot be written to, or the request it is working on runs
+ * past FILL_TIMEOUT_MS, it is killed and every pending request is rejected.
+ */
+class FillWorker {
+  private child: ChildProcessWithoutNullStreams | null = null;
+  private pending: PendingFill[] = [];
+  // Unread stdout, kept as received; a frame is copied out once it is complete
+  private chunks: Buffer[] = [];
+  private buffered = 0;
+  private frameLength: number | null = null;
+  private reply: FillReply | null = null;
+  private timer: NodeJS.Timeout | null = null;
+
+  private start(): ChildProcessWithoutNullStreams {
+    const child = spawn(
+      process.env.PYTHON || "python",
+      ["fill_excel_template.py", "--serve", "--engine", "xml"],
+      { cwd: process.cwd() }
+    );
+    child.stdout.on("data", (chunk: Buffer) => this.onData(chunk));
+    child.stderr.on("data", (data) => {
+      console.error(`Python error: ${data}`);
+    });
+    // EPIPE and the like when the worker dies mid-write; without a handler they crash the server
+    child.stdin.on("error", (err) =>
+      this.restart(child, new Error(`Fill worker input failed: ${err.message}`))
+    );
+    child.on("error", (err) => this.onExit(child, err));
+    child.on("exit", (code) =>
+      this.onExit(child, new Error(`Fill worker exited with code ${code}`))
+    );
+    this.child = child;
+    return child;
+  }
+
+  private onExit(child: ChildProcessWithoutNullStreams, error: Error) {
+    if (this.child !== child) {
+      return;
+    }
+    this.child = null;
+    this.chunks = [];
+    this.buffered = 0;
+    this.frameLength = null;
+    this.reply = null;
+    this.clearTimer();
+    for (const request of this.pending.splice(0)) {
+      request.reject(error);
+    }
+  }
+
+  private restart(child: ChildProcessWithoutNullStreams, error: Error) {
+    this.onExit(child, error);
+    child.kill();
+  }
+
+  private clearTimer() {
+    if (this.timer) {
+      clearTimeout(this.timer);
+      this.timer = null;
+    }
+  }
+
+  // Times the request at the head of the queue, the one the worker is on
+  private armTimer() {
+    this.clearTimer();
+    const child = this.child;
+    if (child && this.pending.length) {
+      this.timer = setTimeout(
+        () => this.restart(child, new Error(`Fill did not finish within ${FILL_TIMEOUT_MS}ms`)),
+        FILL_TIMEOUT_MS
+      );
+    }
+  }
+
+  private onData(chunk: Buffer) {
+    this.chunks.push(chunk);
+    this.buffered += chunk.length;
+    while (true) {
+      if (this.frameLength === null) {
+        if (this.buffered < 4) {
+          return;
+        }
+        this.frameLength = this.take(4).readUInt32BE(0);
+      }
+      if (this.buffered < this.frameLength) {
+        return;
+      }
+      const frame = this.take(this.frameLength);
+      this.frameLength = null;
+      this.onFrame(frame);
+    }
+  }
+
+  // Removes the first `size` buffered bytes and returns them as one Buffer
+  private take(size: number): Buffer {
+    const parts: Buffer[] = [];
+    let needed = size;
+    while (needed > 0) {
+      const first = this.chunks[0];
+      if (first.length <= needed) {
+        parts.push(first);
+        this.chunks.shift();
+        needed -= first.length;
+      } else {
+        parts.push(first.subarray(0, needed));
+        this.chunks[0] = first.subarray(needed);
+        needed = 0;
+      }
+    }
+    this.buffered -= size;
+    return Buffer.concat(parts, size);
+  }
+
+  private onFrame(frame: Buffer) {
+    if (this.reply) {
+      // The workbook that follows a successful reply
+      const templateVersion = this.reply.templateVersion ?? null;
+      this.reply = null;
+      this.pending.shift()?.resolve({ workbook: frame, templateVersion });
+      this.armTimer();
+      return;
+    }
+    const reply: FillReply = JSON.parse(frame.toString("utf8"));
+    if (reply.ok) {
+      this.reply = reply;
+    } else {
+      this.pending.shift()?.reject(new Error(reply.error || "Fill failed"));
+      this.armTimer();
+    }
+  }
+
+  fill(wbsData: unknown[], requestType?: string): Promise<FillResult> {
+    const child = this.child ?? this.start();
+    const body = Buffer.from(JSON.stringify({ wbsData, requestType }), "utf8");
+    const header = Buffer.alloc(4);
+    header.writeUInt32BE(body.length, 0);
+    return new Promise<FillResult>((resolve, reject) => {
+      this.pending.push({ resolve, reject });
+      if (this.pending.length === 1) {
+        this.armTimer();
+      }
+      child.stdin.write(Buffer.concat([header, body]));
+    });
+  }
+}
+
+// One worker per server process, kept across hot reloads in development
+const globalForFillWorker = globalThis as unknown as { fillWorker?: FillWorker };
+export const fillWorker =
+  globalForFillWorker.fillWorker ?? (globalForFillWorker.fillWorker = new FillWorker());
@@ -0,0 +1,90 @@
+import { useEffect, useState } from "react";
+import bundledLookups from "@/templates/lookups.json";
+import type { RegionType } from "@/types";
+
+export interface LookupOption {
+  value: string;
+  label: string;
+}
+
+type LookupTable = "controllingArea" | "functionalArea";
+
+// GET /lookups: options of { value, label } per table and region
+interface Lookups {
+  version: string;
+  controllingArea: Record<string, LookupOption[]>;
+  functionalArea: Record<string, LookupOption[]>;
+}
+
+const toOptions = (byRegion: Record<string, Record<string, string>>) =>
+  Object.fromEntries(
+    Object.entries(byRegion).map(([region, table]) => [
+      region,
+      Object.entries(table).map(([value, label]) => ({ value, label })),
+    ])
+  );
+
+/**
+ * The export service's lookup tables (templates/lookups.json) are the one source
+ * of controlling and functional area codes and labels. Until GET /lookups has
+ * answered, the copy bundled at build time is used.
+ */
+let lookups: Lookups = {
+  version: bundledLookups.version,
+  controllingArea: toOptions(bundledLookups.controllingArea),
+  functionalArea: toOptions(bundledLookups.functionalArea),
+};
+let loading: Promise<Lookups> | null = null;
+
+const options = (table: LookupTable, region: RegionType | string): LookupOption[] =>
+  lookups[table][region] ?? [];
+
+export const getControllingAreaOptions = (region: RegionType | string) =>
+  options("controllingArea", region);
+
+export const getFunctionalAreaOptions = (region: RegionType | string) =>
+  options("functionalArea", region);
+
+export function loadLookups(): Promise<Lookups> {
+  if (!loading) {
+    const API_URL = process.env.NEXT_PUBLIC_API_URL || "http://127.0.0.1:8000";
+    loading = fetch(`${API_URL}/lookups`)
+      .then((response) => {
+        if (!response.ok) {
+          throw new Error(`GET /lookups failed with ${response.status}`);
+        }
+        return response.json();
+      })
+      .then((data: Lookups) => {
+        lookups = data;
+        return data;
+      })
+      .catch((error) => {
+        console.warn("Using the bundled lookup tables:", error);
+        // Try again on the next mount
+        loading = null;
+        return lookups;
+      });
+  }
+  return loading;
+}
+
+/**
+ * Loads the service's lookup tables once per page load and re-renders the
+ * caller when they arrive. Returns the version in use.
+ */
+export function useLookups(): string {
+  const [version, setVersion] = useState(lookups.version);
+  useEffect(() => {
+    let active = true;
+    loadLookups().then((data) => {
+      if (active) {
+        setVersion(data.version);
+      }
+    });
+    return () => {
+      active = false;
+    };
+  }, []);
+  return version;
+}
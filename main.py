@@ -1,10 +1,33 @@
-from fastapi import FastAPI, HTTPException
+from fastapi import Depends, FastAPI, File, Form, Header, HTTPException, Query, Request, Response, UploadFile
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import StreamingResponse
+from fastapi.responses import FileResponse, JSONResponse, StreamingResponse
+import asyncio
+import hmac
+import io
+import json
 import os
+import shutil
 import tempfile
-import io
-from fill_excel_template import fill_excel_template
+import time
+import zipfile
+from datetime import date
+from typing import List, Optional
+from urllib.parse import quote
+from fill_excel_template import (
+    export_key, export_ndjson_file, export_workbook, fill_excel_template, get_template, warm_templates,
+)
+from consolidated_export import export_consolidated
+from export_cache import ExportCache
+from export_jobs import ExportJobStore, job_status
+from export_metrics import METRICS_MEDIA_TYPE, ExportTrace, render_metrics, timing_headers
+from export_pool import ExportPool, ExportTimeout, PoolBusy
+from incremental_export import NoPreviousExport, export_history, export_request
+from request_store import RequestStore, RequestStoreError, to_timestamp
+from template_registry import TemplateError, template_registry
+from wbs_columns import REGION_FULL_NAMES
+from wbs_import import WORKBOOK_SUFFIXES, WbsImportError, import_ndjson
+from wbs_lookups import REGION_TABLES, WbsLookupError, wbs_lookups
+from wbs_validation import WbsValidator, validate_wbs
 import traceback
 
 app = FastAPI()
@@ -16,44 +39,817 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["ETag", "Server-Timing", "X-Export-Failed-Regions", "X-Template-Version", "X-Import-Rows",
+                    "X-Export-Changes", "X-Validation-Warnings"],
 )
 
+XLSM_MEDIA_TYPE = "application/vnd.ms-excel.sheet.macroEnabled.12"
+NDJSON_MEDIA_TYPE = "application/x-ndjson"
+
+# Template uploads and reloads, lookup reloads, and the request store (reads, appends and
+# consolidated exports by requestIds) need "Authorization: Bearer <ADMIN_TOKEN>";
+# without ADMIN_TOKEN they are turned off
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN", "")
+
+# Payloads are validated before any template work; EXPORT_VALIDATE=0 turns this off
+EXPORT_VALIDATE = os.getenv("EXPORT_VALIDATE", "1") != "0"
+
+# Workbooks are built in worker processes that already hold every registered template
+export_pool = ExportPool(initializer=warm_templates, initargs=(template_registry.paths(),))
+
+# Generated workbooks keyed by a hash of the template version and the written values
+export_cache = ExportCache()
+
+# Large exports run as background jobs that survive a restart
+export_jobs = ExportJobStore()
+EXPORT_JOB_RUNNERS = int(os.getenv("EXPORT_JOB_RUNNERS", "1"))
+EXPORT_JOB_TIMEOUT = float(os.getenv("EXPORT_JOB_TIMEOUT", "1800"))
+# NDJSON dump of requests (one JSON object per line, later lines update earlier ones)
+REQUESTS_NDJSON = os.getenv(
+    "REQUESTS_NDJSON", os.path.join(os.path.dirname(os.path.abspath(__file__)), "requests.ndjson"))
+# The dump indexed in memory for the admin dashboard and analytics
+request_store = RequestStore(REQUESTS_NDJSON)
+# Reading a large filled template back can take much longer than an export
+IMPORT_TIMEOUT = float(os.getenv("IMPORT_TIMEOUT", "600"))
+# Consolidated exports merge many requests in one pool job
+CONSOLIDATED_TIMEOUT = float(os.getenv("CONSOLIDATED_TIMEOUT", "600"))
+job_wakeup = asyncio.Event()
+job_runners = []
+
+@app.exception_handler(PoolBusy)
+async def pool_busy(request: Request, e: PoolBusy):
+    return JSONResponse(
+        status_code=429,
+        content={"detail": "Too many exports in progress, please retry later"},
+        headers={"Retry-After": str(e.retry_after)},
+    )
+
+@app.exception_handler(ExportTimeout)
+async def export_timeout(request: Request, e: ExportTimeout):
+    return JSONResponse(status_code=504, content={"detail": str(e)})
+
+@app.on_event("startup")
+async def start_export_pool():
+    wbs_lookups.tables()
+    export_pool.start()
+    export_jobs.requeue_running()
+    await asyncio.to_thread(request_store.refresh)
+    for _ in range(EXPORT_JOB_RUNNERS):
+        job_runners.append(asyncio.create_task(run_export_jobs()))
+
+@app.on_event("shutdown")
+async def stop_export_pool():
+    for runner in job_runners:
+        runner.cancel()
+    await asyncio.gather(*job_runners, return_exceptions=True)
+    export_pool.close()
+    export_jobs.close()
+
 @app.get("/")
 async def root():
     return {"message": "WBS Excel Export API is running"}
 
+@app.get("/stats")
+async def stats():
+    pool_stats = export_pool.stats()
+    return {
+        "templateCache": pool_stats.pop("templateCache"),
+        "exportPool": pool_stats,
+        "exportCache": export_cache.stats(),
+        "templateRegistry": template_registry.stats(),
+        "lookups": wbs_lookups.stats(),
+        "requestStore": {"requests": len(request_store), "skippedLines": request_store.skipped},
+    }
+
+def require_admin(authorization: Optional[str] = Header(None)):
+    if not ADMIN_TOKEN:
+        raise HTTPException(status_code=403, detail="Admin endpoints are disabled, set ADMIN_TOKEN")
+    scheme, _, token = (authorization or "").partition(" ")
+    if scheme.lower() != "bearer" or not hmac.compare_digest(token.encode(), ADMIN_TOKEN.encode()):
+        raise HTTPException(status_code=401, detail="Admin token required", headers={"WWW-Authenticate": "Bearer"})
+
+@app.get("/templates")
+async def list_templates():
+    templates = await asyncio.to_thread(template_registry.templates)
+    return {"templates": [template.to_dict() for template in templates]}
+
+@app.post("/templates/reload", dependencies=[Depends(require_admin)])
+async def reload_templates():
+    """Re-read templates/registry.json after it was edited by hand."""
+    try:
+        templates = await asyncio.to_thread(template_registry.reload)
+    except TemplateError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return {"templates": [template.to_dict() for template in templates]}
+
+@app.put("/templates/{region}/{request_type}", dependencies=[Depends(require_admin)])
+async def install_template(region: str, request_type: str, request: Request, version: str = Query(...)):
+    """Upload a new template version; exports switch to it once it has been analysed.
+
+    Use "*" for any region or request type. Needs the admin token, and the
+    template must not contain VBA.
+    """
+    data = await request.body()
+    try:
+        template = await asyncio.to_thread(template_registry.install, region, request_type, data, version)
+    except TemplateError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return template.to_dict()
+
+@app.get("/lookups")
+async def get_lookups(region: Optional[str] = Query(None), if_none_match: Optional[str] = Header(None)):
+    """Controlling area, functional area and region labels for the forms.
+
+    With region, only that region's options. The ETag is the tables' version.
+    """
+    tables = await asyncio.to_thread(wbs_lookups.tables)
+    etag = f'"{tables.version}"'
+    if tables.version and etag_matches(if_none_match, etag):
+        return Response(status_code=304, headers={"ETag": etag})
+    if region is not None and region not in REGION_FULL_NAMES:
+        raise HTTPException(status_code=400, detail=f"Unknown region {region}")
+    headers = {"ETag": etag} if tables.version else {}
+    return Response(json.dumps(tables.to_dict(region)), media_type="application/json", headers=headers)
+
+@app.get("/lookups/{table}/{region}/{code}")
+async def get_lookup_label(table: str, region: str, code: str):
+    if table not in REGION_TABLES:
+        raise HTTPException(status_code=404, detail=f"Unknown lookup table {table}")
+    tables = await asyncio.to_thread(wbs_lookups.tables)
+    label = tables.label(table, region, code)
+    if not label:
+        raise HTTPException(status_code=404, detail=f"Unknown {table} {code} for {region}")
+    return {"value": code, "label": label, "version": tables.version}
+
+@app.post("/lookups/reload", dependencies=[Depends(require_admin)])
+async def reload_lookups():
+    """Re-read templates/lookups.json after it was edited."""
+    try:
+        tables = await asyncio.to_thread(wbs_lookups.reload)
+    except WbsLookupError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return {"version": tables.version}
+
+@app.get("/metrics")
+async def metrics():
+    return Response(render_metrics(), media_type=METRICS_MEDIA_TYPE)
+
+def etag_matches(if_none_match, etag):
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == '*':
+        return True
+    return any(tag.strip().removeprefix('W/') == etag for tag in if_none_match.split(','))
+
+def validation_error(errors, warnings=None):
+    detail = {"message": f"WBS data failed validation on {len(errors)} row(s)", "errors": errors}
+    if warnings:
+        detail["warnings"] = warnings
+    return HTTPException(status_code=422, detail=detail)
+
+def warning_headers(warnings):
+    return {"X-Validation-Warnings": str(len(warnings))} if warnings else {}
+
+async def check_wbs(wbs_data):
+    """Reject the request with every validation error before anything is built.
+
+    Returns the validation warnings by row; they do not stop the export.
+    """
+    if not EXPORT_VALIDATE:
+        return {}
+    errors, warnings = await asyncio.to_thread(validate_wbs, wbs_data)
+    if errors:
+        raise validation_error(errors, warnings)
+    return warnings
+
+async def stream_body(first, chunks, trace, rows, cache_key=None):
+    parts = [first] if first else []
+    try:
+        with trace.timed('send'):
+            if first:
+                yield first
+            async for _, data in chunks:
+                parts.append(data)
+                yield data
+    except BaseException:
+        trace.finish(error=True)
+        raise
+    trace.finish(rows=rows, bytes_out=sum(len(part) for part in parts))
+    if cache_key:
+        await asyncio.to_thread(export_cache.put, cache_key, b''.join(parts))
+
+async def build_workbook(template_path, wbs_data, trace):
+    """Return the workbook bytes, from the export cache when possible."""
+    with trace.timed('key'):
+        key = await asyncio.to_thread(export_key, template_path, wbs_data)
+    with trace.timed('cache'):
+        data = await asyncio.to_thread(export_cache.get, key)
+    if data is None:
+        data = await export_pool.run(export_workbook, template_path, wbs_data, on_timing=trace.stage)
+        await asyncio.to_thread(export_cache.put, key, data)
+    return data
+
+async def iter_ndjson(request, copy_to=None):
+    """Yield lists of records from an NDJSON body as its chunks arrive.
+
+    With copy_to, the raw body is also written to that file.
+    """
+    pending = b''
+    line_number = 0
+    async for chunk in request.stream():
+        if copy_to is not None and chunk:
+            await asyncio.to_thread(copy_to.write, chunk)
+        *lines, pending = (pending + chunk).split(b'\n')
+        batch = []
+        for line in lines:
+            line_number += 1
+            if line.strip():
+                batch.append(parse_ndjson_line(line, line_number))
+        if batch:
+            yield batch
+    if pending.strip():
+        yield [parse_ndjson_line(pending, line_number + 1)]
+
+def parse_ndjson_line(line, line_number):
+    try:
+        record = json.loads(line)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=f"Invalid JSON on line {line_number}: {e}")
+    if not isinstance(record, dict):
+        raise HTTPException(status_code=400, detail=f"Line {line_number} is not a WBS element object")
+    return record
+
+async def iter_file(f, trace, rows, chunk_size=65536):
+    sent = 0
+    start = time.perf_counter()
+    try:
+        while True:
+            chunk = await asyncio.to_thread(f.read, chunk_size)
+            if not chunk:
+                break
+            sent += len(chunk)
+            yield chunk
+    except BaseException:
+        trace.finish(error=True)
+        raise
+    finally:
+        f.close()
+    trace.stage('send', time.perf_counter() - start)
+    trace.finish(rows=rows, bytes_out=sent)
+
+async def export_ndjson(request):
+    """Export WBS elements sent one per line.
+
+    The body is validated as it arrives and copied to a temporary file; the
+    workbook is then built from that file in a pool worker, with the pool's
+    admission limit and timeout like any other export.
+    """
+    trace = ExportTrace()
+    validator = WbsValidator()
+    body = tempfile.NamedTemporaryFile(prefix="wbs-", suffix=".ndjson", delete=False)
+    output_path = body.name[:-len(".ndjson")] + ".xlsm"
+    try:
+        rows = 0
+        with body:
+            async for batch in iter_ndjson(request, copy_to=body):
+                if not rows:
+                    trace.region = batch[0].get('region')
+                rows += len(batch)
+                if EXPORT_VALIDATE:
+                    validator.add(batch)
+        errors = validator.finish()
+        if errors:
+            raise validation_error(errors, validator.warnings)
+        if not rows:
+            raise HTTPException(status_code=400, detail="No WBS data provided")
+        rows, version = await export_pool.run(
+            export_ndjson_file, body.name, output_path, request.query_params.get("requestType"),
+            on_timing=trace.stage)
+        out = open(output_path, "rb")
+        size = os.fstat(out.fileno()).st_size
+    except BaseException:
+        trace.finish(error=True)
+        raise
+    finally:
+        for path in (body.name, output_path):
+            # The open output file stays readable until it is closed
+            if os.path.exists(path):
+                os.remove(path)
+    return StreamingResponse(
+        iter_file(out, trace, rows),
+        media_type=XLSM_MEDIA_TYPE,
+        headers={
+            "Content-Disposition": "attachment; filename=wbs_export.xlsm",
+            "Content-Length": str(size),
+            "X-Template-Version": version,
+            **warning_headers(validator.warnings),
+            **timing_headers(trace),
+        },
+    )
+
 @app.post("/export")
-async def export_excel(payload: dict):
+async def export_excel(request: Request):
+    # Bulk requests can be streamed as one WBS element per line
+    if request.headers.get("content-type", "").startswith(NDJSON_MEDIA_TYPE):
+        return await export_ndjson(request)
+    try:
+        payload = await request.json()
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Request body is not valid JSON")
+    if not isinstance(payload, dict):
+        raise HTTPException(status_code=400, detail="Request body must be a JSON object")
     wbs_data = payload.get("wbsData", [])
+    warnings = await check_wbs(wbs_data)
+    region = wbs_data[0].get('region') if wbs_data else None
+    trace = ExportTrace(region)
     try:
-        # Get the absolute path to the template file
-        template_path = os.path.join(os.path.dirname(__file__), 'templates', 'wbs_template_actual.xlsm')
-        
-        # Create a temporary file for the output
-        with tempfile.NamedTemporaryFile(suffix='.xlsm', delete=False) as tmp:
-            # Fill the template with data
-            fill_excel_template(template_path, tmp.name, wbs_data)
-            
-            # Read the filled template
-            tmp.seek(0)
-            excel_data = tmp.read()
-            
-            # Clean up the temporary file
-            tmp.close()
-            os.unlink(tmp.name)
-            
-            # Return the Excel file as a download
-            return StreamingResponse(
-                io.BytesIO(excel_data),
-                media_type="application/vnd.ms-excel.sheet.macroEnabled.12",
-                headers={"Content-Disposition": "attachment; filename=wbs_export.xlsm"}
-            )
+        template = get_template(region, payload.get("requestType"))
+        template_path = template.path
+
+        # Identical requests against the same template produce the same file, served
+        # from export_cache. Browsers never revalidate a POST, so there is no 304 here;
+        # the ETag only identifies the workbook
+        with trace.timed('key'):
+            key = await asyncio.to_thread(export_key, template_path, wbs_data)
+        headers = {
+            "Content-Disposition": "attachment; filename=wbs_export.xlsm",
+            "ETag": f'"{key}"',
+            "X-Template-Version": template.version,
+            **warning_headers(warnings),
+        }
+        with trace.timed('cache'):
+            cached = await asyncio.to_thread(export_cache.get, key)
+        if cached is not None:
+            trace.finish(rows=len(wbs_data), bytes_out=len(cached))
+            return Response(cached, media_type=XLSM_MEDIA_TYPE, headers={**headers, **timing_headers(trace)})
+
+        # Fill the template in a worker process so the event loop stays free;
+        # the workbook is streamed back in chunks while it is being zipped
+        chunks = export_pool.stream(export_workbook, template_path, wbs_data, on_timing=trace.stage)
+
+        # Wait for the first output so a failed fill still becomes an HTTP error
+        kind, first = await chunks.__anext__()
+        if kind == 'size':
+            headers["Content-Length"] = str(first)
+            first = b''
+
+        # Stages still running when the first byte goes out (e.g. an openpyxl
+        # save) only reach /metrics, not the header
+        headers.update(timing_headers(trace))
+
+        # Return the Excel file as a download
+        return StreamingResponse(
+            stream_body(first, chunks, trace, len(wbs_data), cache_key=key),
+            media_type=XLSM_MEDIA_TYPE,
+            headers=headers
+        )
+    except (PoolBusy, ExportTimeout):
+        # Answered by the pool_busy and export_timeout handlers
+        trace.finish(error=True)
+        raise
     except Exception as e:
+        trace.finish(error=True)
         print("\n--- Exception in /export endpoint ---")
         traceback.print_exc()
         print("--- End Exception ---\n")
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.post("/export/requests/{request_id}")
+async def export_request_workbook(request_id: str, payload: dict, changesOnly: bool = Query(False)):
+    """Export a request's workbook, rewriting only the rows that changed since its last export.
+
+    wbsData holds one region's elements. With changesOnly=true the workbook
+    only lists the rows that changed or were inserted, e.g. for a Modify
+    request. X-Export-Changes counts the changed, inserted, deleted and
+    unchanged rows.
+
+    This is the explicit "Export changes" action: it always uses the xml
+    engine and keeps the export in ExportHistory. Regular exports go
+    through POST /export and its export cache. With changesOnly and no
+    earlier export to compare with the answer is 409; export without
+    changesOnly first.
+    """
+    wbs_data = payload.get("wbsData", [])
+    if not isinstance(wbs_data, list) or not wbs_data:
+        raise HTTPException(status_code=400, detail="No WBS data provided")
+    # Exports are kept per region, so one call covers one region
+    regions = sorted({str(element.get('region')) for element in wbs_data if isinstance(element, dict)})
+    if len(regions) > 1:
+        raise HTTPException(status_code=422, detail={
+            "message": "wbsData must hold the elements of one region", "regions": regions})
+    await check_wbs(wbs_data)
+    region = wbs_data[0].get('region')
+    trace = ExportTrace(region)
+    try:
+        data, summary = await export_pool.run(
+            export_request, request_id, wbs_data, payload.get("requestType"), changesOnly,
+            on_timing=trace.stage)
+    except (PoolBusy, ExportTimeout):
+        # Answered by the pool_busy and export_timeout handlers
+        trace.finish(error=True)
+        raise
+    except NoPreviousExport as e:
+        trace.finish()
+        raise HTTPException(status_code=409, detail=str(e))
+    except Exception as e:
+        trace.finish(error=True)
+        print("\n--- Exception in /export/requests endpoint ---")
+        traceback.print_exc()
+        print("--- End Exception ---\n")
+        raise HTTPException(status_code=500, detail=str(e))
+    trace.finish(rows=summary['rendered'], bytes_out=len(data))
+    name = "wbs_changes.xlsm" if changesOnly else "wbs_export.xlsm"
+    return Response(data, media_type=XLSM_MEDIA_TYPE, headers={
+        "Content-Disposition": f"attachment; filename={name}",
+        "X-Template-Version": summary['templateVersion'],
+        "X-Export-Changes": ", ".join(
+            f"{key}={summary[key]}" for key in ("changed", "inserted", "deleted", "unchanged")),
+        **timing_headers(trace),
+    })
+
+@app.delete("/export/requests/{request_id}/{region}", status_code=204)
+async def forget_request_export(request_id: str, region: str):
+    """Drop the kept export so the next one is built from scratch."""
+    if not await asyncio.to_thread(export_history.forget, request_id, region):
+        raise HTTPException(status_code=404, detail=f"No kept export for {request_id} {region}")
+
+async def run_export_jobs():
+    while True:
+        job_wakeup.clear()
+        job = await asyncio.to_thread(export_jobs.claim_next)
+        if job is None:
+            await asyncio.to_thread(export_jobs.expire)
+            try:
+                await asyncio.wait_for(job_wakeup.wait(), timeout=5)
+            except asyncio.TimeoutError:
+                pass
+            continue
+        await run_export_job(job)
+
+def job_progress(job_id):
+    """Return an on_progress callback that saves a job's row count off the event loop, and a flush.
+
+    Only the latest count is written, one write at a time; await flush()
+    before the job's final status is saved.
+    """
+    state = {"rows": None, "task": None}
+
+    async def write():
+        while state["rows"] is not None:
+            rows, state["rows"] = state["rows"], None
+            await asyncio.to_thread(export_jobs.progress, job_id, rows)
+
+    def on_progress(rows):
+        state["rows"] = rows
+        if state["task"] is None or state["task"].done():
+            state["task"] = asyncio.ensure_future(write())
+
+    async def flush():
+        state["rows"] = None
+        if state["task"] is not None:
+            await asyncio.gather(state["task"], return_exceptions=True)
+
+    return on_progress, flush
+
+async def run_export_job(job):
+    result_path = export_jobs.result_path(job['id'])
+    tmp_path = result_path + '.tmp'
+    trace = ExportTrace(job['region'])
+    on_progress, flush_progress = job_progress(job['id'])
+    try:
+        try:
+            await export_pool.run(
+                fill_excel_template, job['template_path'], tmp_path, job['wbs_data'],
+                on_progress=on_progress,
+                on_timing=trace.stage,
+                timeout=EXPORT_JOB_TIMEOUT,
+            )
+        finally:
+            await flush_progress()
+        os.replace(tmp_path, result_path)
+        await asyncio.to_thread(export_jobs.finish, job['id'], result_path)
+        trace.finish(rows=job['rows_total'])
+    except PoolBusy as e:
+        # Interactive exports have the pool; try again shortly
+        trace.finish()
+        await asyncio.to_thread(export_jobs.requeue, job['id'])
+        await asyncio.sleep(e.retry_after)
+    except Exception as e:
+        trace.finish(error=True)
+        print(f"\n--- Export job {job['id']} failed ---")
+        traceback.print_exc()
+        await asyncio.to_thread(export_jobs.fail, job['id'], str(e))
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+@app.post("/export/jobs", status_code=202)
+async def create_export_job(payload: dict):
+    wbs_data = payload.get("wbsData", [])
+    if not wbs_data:
+        raise HTTPException(status_code=400, detail="No WBS data provided")
+    await check_wbs(wbs_data)
+    region = wbs_data[0].get('region')
+    template = get_template(region, payload.get("requestType"))
+    # Serialising a large payload and the insert both stay off the event loop
+    job_id = await asyncio.to_thread(export_jobs.create, template.path, region, wbs_data, template.version)
+    job_wakeup.set()
+    return job_status(await asyncio.to_thread(export_jobs.get, job_id))
+
+@app.get("/export/jobs/{job_id}")
+async def get_export_job(job_id: str):
+    job = await asyncio.to_thread(export_jobs.get, job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Export job not found or expired")
+    return job_status(job)
+
+@app.get("/export/jobs/{job_id}/result")
+async def get_export_job_result(job_id: str):
+    job = await asyncio.to_thread(export_jobs.get, job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Export job not found or expired")
+    if job['status'] != 'done':
+        raise HTTPException(status_code=409, detail=job_status(job))
+    return FileResponse(job['result_path'], media_type=XLSM_MEDIA_TYPE, filename="wbs_export.xlsm")
+
+def safe_filename(name):
+    return name.replace('/', '-').replace('\\', '-')
+
+def export_filename(submission_date, region, request_name):
+    # Format: MDM WBS YYYYMMDD REGION - REQUESTNAME.xlsm
+    return safe_filename(f"MDM WBS {submission_date} {region} - {request_name}.xlsm")
+
+@app.post("/export/batch")
+async def export_batch(payload: dict):
+    wbs_data = payload.get("wbsData", [])
+    if not wbs_data:
+        raise HTTPException(status_code=400, detail="No WBS data provided")
+    await check_wbs(wbs_data)
+    request_name = payload.get("requestName") or "wbs_export"
+    submission_date = payload.get("submissionDate") or date.today().strftime("%Y%m%d")
+
+    # Group WBS elements by region, keeping their original order
+    wbs_by_region = {}
+    for element in wbs_data:
+        wbs_by_region.setdefault(element.get('region') or '', []).append(element)
+
+    # Build every region's workbook concurrently in the worker pool
+    regions = list(wbs_by_region)
+    templates = [get_template(region, payload.get("requestType")) for region in regions]
+    traces = [ExportTrace(region) for region in regions]
+    results = await asyncio.gather(
+        *(build_workbook(template.path, wbs_by_region[region], trace)
+          for region, template, trace in zip(regions, templates, traces)),
+        return_exceptions=True,
+    )
+
+    errors = {}
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_STORED) as archive:
+        for region, trace, result in zip(regions, traces, results):
+            if isinstance(result, BaseException):
+                trace.finish(error=True)
+                errors[region] = str(result)
+                continue
+            trace.finish(rows=len(wbs_by_region[region]), bytes_out=len(result))
+            archive.writestr(export_filename(submission_date, region, request_name), result)
+        if errors:
+            archive.writestr("errors.json", json.dumps(errors, indent=2))
+
+    if len(errors) == len(regions):
+        if all(isinstance(result, PoolBusy) for result in results):
+            raise results[0]
+        raise HTTPException(status_code=500, detail={"errors": errors})
+
+    zip_name = safe_filename(f"MDM WBS {submission_date} - {request_name}.zip")
+    headers = {
+        "Content-Disposition": f"attachment; filename*=UTF-8''{quote(zip_name)}",
+        "Content-Length": str(buffer.getbuffer().nbytes),
+        "X-Template-Version": ", ".join(
+            f"{region}={template.version}" for region, template in zip(regions, templates)),
+        # Stage times summed over the regions
+        **timing_headers(*traces),
+    }
+    if errors:
+        headers["X-Export-Failed-Regions"] = ",".join(errors)
+    buffer.seek(0)
+    return StreamingResponse(buffer, media_type="application/zip", headers=headers)
+
+async def spool_request_records(request, out):
+    """Write the request records to consolidate to out as NDJSON, from an NDJSON body or requestIds."""
+    if request.headers.get("content-type", "").startswith(NDJSON_MEDIA_TYPE):
+        async for _ in iter_ndjson(request, copy_to=out):
+            pass
+        return
+    try:
+        payload = await request.json()
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Request body is not valid JSON")
+    request_ids = payload.get("requestIds") if isinstance(payload, dict) else None
+    if not isinstance(request_ids, list) or not request_ids:
+        raise HTTPException(status_code=400, detail="Send requestIds or an NDJSON dump of requests")
+    # Records from the request store are only handed out to admins
+    require_admin(request.headers.get("authorization"))
+    if not os.path.exists(REQUESTS_NDJSON):
+        raise HTTPException(status_code=503, detail="No request dump available to look up requestIds")
+    request_ids = list(dict.fromkeys(map(str, request_ids)))
+    missing = await asyncio.to_thread(request_store.missing, request_ids)
+    if missing:
+        raise HTTPException(status_code=404, detail={"message": "Unknown requests", "requestIds": missing})
+    for request_id in request_ids:
+        record = await asyncio.to_thread(request_store.get, request_id)
+        if record is not None:
+            await asyncio.to_thread(out.write, json.dumps(record).encode("utf-8") + b"\n")
+
+@app.post("/export/consolidated")
+async def consolidated_export(request: Request, submissionDate: Optional[str] = Query(None)):
+    """Merge the WBS elements of many requests into one workbook per region.
+
+    The body is either ``{"requestIds": [...]}``, looked up in the
+    REQUESTS_NDJSON dump (admin token required), or such a dump itself sent
+    as NDJSON. The records are spooled to a temporary file and merged in a
+    pool worker. Returns a zip with one workbook per region plus
+    consolidated.json summarising it.
+    """
+    submission_date = submissionDate or date.today().strftime("%Y%m%d")
+    trace = ExportTrace("consolidated")
+    records = tempfile.NamedTemporaryFile(prefix="wbs-", suffix=".ndjson", delete=False)
+    zip_path = records.name[:-len(".ndjson")] + ".zip"
+    try:
+        with records:
+            await spool_request_records(request, records)
+        rows, _, summary, errors = await export_pool.run(
+            export_consolidated, records.name, zip_path,
+            export_filename(submission_date, "{region}", "Consolidated"), EXPORT_VALIDATE,
+            on_timing=trace.stage, timeout=CONSOLIDATED_TIMEOUT)
+        if not rows:
+            raise HTTPException(status_code=400, detail="No WBS data in the requests")
+        if errors:
+            raise HTTPException(
+                status_code=422,
+                detail={"message": "WBS data failed validation", "errors": errors},
+            )
+        out = open(zip_path, "rb")
+        size = os.fstat(out.fileno()).st_size
+    except BaseException:
+        trace.finish(error=True)
+        raise
+    finally:
+        for path in (records.name, zip_path):
+            if os.path.exists(path):
+                os.remove(path)
+
+    zip_name = safe_filename(f"MDM WBS {submission_date} - Consolidated.zip")
+    return StreamingResponse(
+        iter_file(out, trace, rows),
+        media_type="application/zip",
+        headers={
+            "Content-Disposition": f"attachment; filename*=UTF-8''{quote(zip_name)}",
+            "Content-Length": str(size),
+            "X-Template-Version": ", ".join(
+                f"{region}={info['templateVersion']}" for region, info in summary.items()),
+            **timing_headers(trace),
+        },
+    )
+
+async def iter_import_files(paths, chunk_size=65536):
+    try:
+        for path in paths:
+            with open(path, 'rb') as f:
+                while True:
+                    chunk = await asyncio.to_thread(f.read, chunk_size)
+                    if not chunk:
+                        break
+                    yield chunk
+    finally:
+        for path in paths:
+            if os.path.exists(path):
+                os.remove(path)
+
+@app.post("/import")
+async def import_workbooks(files: List[UploadFile] = File(...), region: Optional[str] = Form(None)):
+    """Read filled templates back into WBS elements, returned as NDJSON in upload order.
+
+    Each workbook is parsed in its own pool worker, so several uploads are
+    read in parallel, each into a temporary NDJSON file that is streamed
+    back once every workbook has been read. region names the country for
+    rows that only say 'Nordic'.
+    """
+    for upload in files:
+        if not (upload.filename or '').lower().endswith(WORKBOOK_SUFFIXES):
+            raise HTTPException(status_code=400, detail=f"{upload.filename} is not an .xlsm or .xlsx file")
+    if region is not None and region not in REGION_FULL_NAMES:
+        raise HTTPException(status_code=400, detail=f"Unknown region {region}")
+
+    workbooks, outputs = [], []
+    try:
+        for upload in files:
+            suffix = os.path.splitext(upload.filename)[1].lower()
+            with tempfile.NamedTemporaryFile(suffix=suffix, delete=False) as f:
+                workbooks.append(f.name)
+                outputs.append(f.name + '.ndjson')
+                await asyncio.to_thread(shutil.copyfileobj, upload.file, f)
+        results = await asyncio.gather(
+            *(export_pool.run(import_ndjson, path, out, upload.filename, region, timeout=IMPORT_TIMEOUT)
+              for path, out, upload in zip(workbooks, outputs, files)),
+            return_exceptions=True,
+        )
+    except BaseException:
+        for path in outputs:
+            if os.path.exists(path):
+                os.remove(path)
+        raise
+    finally:
+        for path in workbooks:
+            if os.path.exists(path):
+                os.remove(path)
+
+    errors = {upload.filename: result for upload, result in zip(files, results) if isinstance(result, BaseException)}
+    if errors:
+        for path in outputs:
+            if os.path.exists(path):
+                os.remove(path)
+        if all(isinstance(error, PoolBusy) for error in errors.values()):
+            raise next(iter(errors.values()))
+        if all(isinstance(error, WbsImportError) for error in errors.values()):
+            raise HTTPException(status_code=422, detail={"errors": {name: str(e) for name, e in errors.items()}})
+        for name, error in errors.items():
+            print(f"\n--- Import of {name} failed ---")
+            traceback.print_exception(error)
+        raise HTTPException(status_code=500, detail={"errors": {name: str(e) for name, e in errors.items()}})
+
+    return StreamingResponse(
+        iter_import_files(outputs),
+        media_type=NDJSON_MEDIA_TYPE,
+        headers={"X-Import-Rows": str(sum(results))},
+    )
+
+def request_time(name, value):
+    if value is None:
+        return None
+    timestamp = to_timestamp(value)
+    if timestamp is None:
+        raise HTTPException(status_code=400, detail=f"{name} must be an ISO date or epoch seconds")
+    return timestamp
+
+@app.get("/requests", dependencies=[Depends(require_admin)])
+async def list_requests(
+    status: Optional[str] = Query(None),
+    region: Optional[str] = Query(None),
+    requestType: Optional[str] = Query(None),
+    requesterId: Optional[str] = Query(None),
+    createdFrom: Optional[str] = Query(None),
+    createdTo: Optional[str] = Query(None),
+    limit: int = Query(50, ge=1, le=500),
+    cursor: Optional[str] = Query(None),
+):
+    """Request summaries, newest first; pass nextCursor back as cursor for the next page."""
+    filters = {"status": status, "region": region, "requestType": requestType, "requesterId": requesterId}
+    try:
+        requests, next_cursor = await asyncio.to_thread(
+            request_store.query, filters, request_time("createdFrom", createdFrom),
+            request_time("createdTo", createdTo), limit, cursor)
+    except RequestStoreError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return {"requests": requests, "nextCursor": next_cursor}
+
+@app.get("/requests/stats", dependencies=[Depends(require_admin)])
+async def request_stats():
+    """Counts per status, region, request type and week, and turnaround percentiles."""
+    return await asyncio.to_thread(request_store.stats)
+
+@app.get("/requests/{request_id}", dependencies=[Depends(require_admin)])
+async def get_request(request_id: str):
+    record = await asyncio.to_thread(request_store.get, request_id)
+    if record is None:
+        raise HTTPException(status_code=404, detail=f"Unknown request {request_id}")
+    return record
+
+@app.post("/requests", dependencies=[Depends(require_admin)])
+async def append_requests(request: Request):
+    """Add or update request records: a JSON record, a list of them, or NDJSON.
+
+    Records are appended to the REQUESTS_NDJSON dump; a record replaces any
+    earlier one with the same id.
+    """
+    if request.headers.get("content-type", "").startswith(NDJSON_MEDIA_TYPE):
+        records = []
+        async for batch in iter_ndjson(request):
+            records.extend(batch)
+    else:
+        try:
+            records = await request.json()
+        except ValueError:
+            raise HTTPException(status_code=400, detail="Request body is not valid JSON")
+        if isinstance(records, dict):
+            records = [records]
+    if not isinstance(records, list) or not records:
+        raise HTTPException(status_code=400, detail="Send a request record, a list of them or NDJSON")
+    try:
+        ids = await asyncio.to_thread(request_store.append, records)
+    except RequestStoreError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return {"ids": ids}
+
 if __name__ == "__main__":
     import uvicorn
     port = int(os.getenv("PORT", 8000))
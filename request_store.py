@@ -0,0 +1,349 @@
+"""Request records in memory, indexed for the admin pages' queries.
+
+The source is an NDJSON file with one request per line; a later line for
+the same id replaces the earlier one, so the file is kept current by
+appending. Only the fields the queries need are held in memory, with the
+line's offset so the full record can be read back. Every query first
+picks up lines appended since the last one, by this process or another.
+"""
+import base64
+import bisect
+import json
+import os
+import threading
+from collections import Counter
+from datetime import datetime, timezone
+
+# Indexed fields: query parameter -> entry attribute
+INDEXED_FIELDS = {
+    'status': 'status',
+    'region': 'region',
+    'requestType': 'request_type',
+    'requesterId': 'requester_id',
+}
+PERCENTILES = (50, 90, 95, 99)
+MAX_PAGE_SIZE = 500
+
+
+class RequestStoreError(ValueError):
+    pass
+
+
+def to_timestamp(value):
+    """Seconds since the epoch from a Firestore timestamp, ISO string or number."""
+    if value is None or value == '':
+        return None
+    if isinstance(value, dict):
+        seconds = value.get('seconds', value.get('_seconds'))
+        if seconds is None:
+            return None
+        return seconds + value.get('nanoseconds', value.get('_nanoseconds', 0)) / 1e9
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        # Milliseconds, as JavaScript writes them
+        return value / 1000 if value > 1e11 else float(value)
+    try:
+        parsed = datetime.fromisoformat(str(value).replace('Z', '+00:00'))
+    except ValueError:
+        return None
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=timezone.utc)
+    return parsed.timestamp()
+
+
+def iso_week(timestamp):
+    year, week, _ = datetime.fromtimestamp(timestamp, timezone.utc).isocalendar()
+    return f'{year}-W{week:02d}'
+
+
+def _iso(timestamp):
+    return None if timestamp is None else datetime.fromtimestamp(timestamp, timezone.utc).isoformat()
+
+
+def _completed_at(record):
+    """When the request was completed: its last 'Completed' history entry, else updatedAt."""
+    if record.get('status') != 'Completed':
+        return None
+    history = record.get('history')
+    if isinstance(history, list):
+        for entry in reversed(history):
+            if isinstance(entry, dict) and entry.get('status') == 'Completed':
+                timestamp = to_timestamp(entry.get('timestamp'))
+                if timestamp is not None:
+                    return timestamp
+    return to_timestamp(record.get('updatedAt'))
+
+
+class _Entry:
+    __slots__ = ('id', 'offset', 'name', 'status', 'region', 'request_type', 'requester_id',
+                 'requester_name', 'created', 'updated', 'completed', 'rows', 'key')
+
+    def __init__(self, record, offset):
+        self.id = str(record['id'])
+        self.offset = offset
+        self.name = record.get('requestName')
+        self.status = record.get('status')
+        self.region = record.get('region')
+        self.request_type = record.get('requestType')
+        self.requester_id = record.get('requesterId')
+        self.requester_name = record.get('requesterDisplayName') or record.get('requesterEmail')
+        self.created = to_timestamp(record.get('createdAt')) or 0.0
+        self.updated = to_timestamp(record.get('updatedAt'))
+        self.completed = _completed_at(record)
+        data = record.get('submittedData')
+        self.rows = len(data) if isinstance(data, list) else (1 if data else 0)
+        # Sort key of every index: newest first is the end of the list
+        self.key = (self.created, self.id)
+
+    @property
+    def turnaround(self):
+        if self.completed is None or not self.created:
+            return None
+        return max(self.completed - self.created, 0.0)
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'requestName': self.name,
+            'requestType': self.request_type,
+            'region': self.region,
+            'status': self.status,
+            'requesterId': self.requester_id,
+            'requester': self.requester_name,
+            'createdAt': _iso(self.created or None),
+            'updatedAt': _iso(self.updated),
+            'completedAt': _iso(self.completed),
+            'rows': self.rows,
+        }
+
+
+def encode_cursor(key):
+    return base64.urlsafe_b64encode(json.dumps(key).encode('utf-8')).decode('ascii')
+
+
+def decode_cursor(cursor):
+    try:
+        created, request_id = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+        return float(created), str(request_id)
+    except Exception:
+        raise RequestStoreError('Invalid cursor')
+
+
+class RequestStore:
+    """Indexed request summaries loaded from, and appended to, an NDJSON file.
+
+    Every index (all requests, and one per value of status, region,
+    requestType and requesterId) is a list of (createdAt, id) kept sorted,
+    so a page is a bisect plus a walk. Counts per status, region, request
+    type and ISO week, and the sorted turnaround times of completed
+    requests, are updated as records come in.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.RLock()
+        self._reset()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _reset(self):
+        self._entries = {}
+        self._all = []
+        self._indexes = {field: {} for field in INDEXED_FIELDS}
+        self._counts = {field: Counter() for field in ('status', 'region', 'requestType', 'week')}
+        self._week_status = {}
+        self._turnarounds = {None: []}
+        self._offset = 0
+        self._inode = None
+        self.skipped = 0
+
+    def _index_lists(self, entry):
+        yield self._all
+        for field, attribute in INDEXED_FIELDS.items():
+            value = getattr(entry, attribute)
+            if value is not None:
+                yield self._indexes[field].setdefault(value, [])
+
+    def _count(self, entry, delta):
+        week = iso_week(entry.created)
+        for field, value in (('status', entry.status), ('region', entry.region),
+                             ('requestType', entry.request_type), ('week', week)):
+            if value is None:
+                continue
+            counter = self._counts[field]
+            counter[value] += delta
+            if counter[value] <= 0:
+                del counter[value]
+        statuses = self._week_status.setdefault(week, Counter())
+        statuses[entry.status] += delta
+        if statuses[entry.status] <= 0:
+            del statuses[entry.status]
+        turnaround = entry.turnaround
+        if turnaround is not None:
+            for region in (None, entry.region):
+                times = self._turnarounds.setdefault(region, [])
+                if delta > 0:
+                    bisect.insort(times, turnaround)
+                else:
+                    del times[bisect.bisect_left(times, turnaround)]
+
+    def _remove(self, entry):
+        for keys in self._index_lists(entry):
+            index = bisect.bisect_left(keys, entry.key)
+            if index < len(keys) and keys[index] == entry.key:
+                del keys[index]
+        self._count(entry, -1)
+
+    def _add(self, record, offset):
+        if not isinstance(record, dict) or record.get('id') in (None, ''):
+            self.skipped += 1
+            return None
+        entry = _Entry(record, offset)
+        previous = self._entries.get(entry.id)
+        if previous is not None:
+            self._remove(previous)
+        self._entries[entry.id] = entry
+        for keys in self._index_lists(entry):
+            if not keys or keys[-1] < entry.key:
+                keys.append(entry.key)
+            else:
+                bisect.insort(keys, entry.key)
+        self._count(entry, 1)
+        return entry
+
+    def refresh(self):
+        """Read lines appended to the file since the last refresh."""
+        with self._lock:
+            try:
+                stat = os.stat(self.path)
+            except FileNotFoundError:
+                if self._entries:
+                    self._reset()
+                return
+            if stat.st_ino != self._inode or stat.st_size < self._offset:
+                # Replaced or truncated: start over
+                self._reset()
+                self._inode = stat.st_ino
+            if stat.st_size == self._offset:
+                return
+            with open(self.path, 'rb') as f:
+                f.seek(self._offset)
+                offset = self._offset
+                for line in f:
+                    if not line.endswith(b'\n'):
+                        # Still being written; picked up next time
+                        break
+                    if line.strip():
+                        try:
+                            record = json.loads(line)
+                        except ValueError:
+                            record = None
+                        self._add(record, offset)
+                    offset += len(line)
+                self._offset = offset
+
+    def append(self, records):
+        """Append request records to the file and the indexes; return their ids."""
+        lines = []
+        for record in records:
+            if not isinstance(record, dict) or record.get('id') in (None, ''):
+                raise RequestStoreError('Every request record needs an id')
+            lines.append(json.dumps(record, ensure_ascii=False).encode('utf-8') + b'\n')
+        with self._lock:
+            self.refresh()
+            with open(self.path, 'ab+') as f:
+                if f.seek(0, os.SEEK_END):
+                    f.seek(-1, os.SEEK_END)
+                    if f.read(1) != b'\n':
+                        # Never glue a record onto an unfinished line
+                        lines.insert(0, b'\n')
+                f.write(b''.join(lines))
+                f.flush()
+                os.fsync(f.fileno())
+            if self._inode is None:
+                self._inode = os.stat(self.path).st_ino
+            self.refresh()
+        return [str(record['id']) for record in records]
+
+    def missing(self, request_ids):
+        """Return the ids in request_ids that are not in the store."""
+        with self._lock:
+            self.refresh()
+            return [request_id for request_id in request_ids if str(request_id) not in self._entries]
+
+    def get(self, request_id):
+        """Return the full record for request_id, or None."""
+        with self._lock:
+            self.refresh()
+            entry = self._entries.get(str(request_id))
+            if entry is None:
+                return None
+            with open(self.path, 'rb') as f:
+                f.seek(entry.offset)
+                return json.loads(f.readline())
+
+    def query(self, filters=None, created_from=None, created_to=None, limit=50, cursor=None):
+        """Return a page of request summaries, newest first, and the cursor of the next page.
+
+        filters maps INDEXED_FIELDS names to values; created_from and
+        created_to bound createdAt (seconds, inclusive / exclusive).
+        """
+        limit = max(1, min(int(limit), MAX_PAGE_SIZE))
+        filters = {field: value for field, value in (filters or {}).items() if value not in (None, '')}
+        with self._lock:
+            self.refresh()
+            candidates = [self._indexes[field].get(value, []) for field, value in filters.items()]
+            # Walk the smallest index and check the other filters on each entry
+            keys = min(candidates, key=len) if candidates else self._all
+            checks = [(INDEXED_FIELDS[field], value) for field, value in filters.items()]
+            end = len(keys)
+            if cursor is not None:
+                end = bisect.bisect_left(keys, decode_cursor(cursor))
+            if created_to is not None:
+                end = min(end, bisect.bisect_left(keys, (created_to, '')))
+            start = bisect.bisect_left(keys, (created_from, '')) if created_from is not None else 0
+            page = []
+            position = end
+            while position > start and len(page) < limit:
+                position -= 1
+                entry = self._entries[keys[position][1]]
+                if all(getattr(entry, attribute) == value for attribute, value in checks):
+                    page.append(entry)
+            more = False
+            if len(page) == limit:
+                # Only hand out a cursor if another match exists
+                while position > start and not more:
+                    position -= 1
+                    entry = self._entries[keys[position][1]]
+                    more = all(getattr(entry, attribute) == value for attribute, value in checks)
+            return [entry.to_dict() for entry in page], encode_cursor(page[-1].key) if more else None
+
+    def _turnaround_stats(self, times):
+        if not times:
+            return {'count': 0}
+        stats = {'count': len(times), 'meanHours': round(sum(times) / len(times) / 3600, 2)}
+        for percentile in PERCENTILES:
+            # Nearest-rank percentile
+            rank = max(-(-percentile * len(times) // 100) - 1, 0)
+            stats[f'p{percentile}Hours'] = round(times[rank] / 3600, 2)
+        return stats
+
+    def stats(self):
+        """Counts per status, region, request type and week, and turnaround percentiles."""
+        with self._lock:
+            self.refresh()
+            return {
+                'total': len(self._entries),
+                'byStatus': dict(self._counts['status']),
+                'byRegion': dict(self._counts['region']),
+                'byRequestType': dict(self._counts['requestType']),
+                'byWeek': {
+                    week: {'total': self._counts['week'][week], 'byStatus': dict(self._week_status[week])}
+                    for week in sorted(self._counts['week'])
+                },
+                'turnaround': self._turnaround_stats(self._turnarounds[None]),
+                'turnaroundByRegion': {
+                    region: self._turnaround_stats(times)
+                    for region, times in self._turnarounds.items() if region is not None and times
+                },
+            }
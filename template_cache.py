@@ -0,0 +1,141 @@
+import hashlib
+import io
+import os
+import threading
+from collections import deque
+from contextlib import contextmanager
+
+
+class _TemplateEntry:
+    def __init__(self, path, stat, data):
+        self.path = path
+        self.mtime_ns = stat.st_mtime_ns
+        self.size = stat.st_size
+        self.data = data
+        self.sha256 = hashlib.sha256(data).hexdigest()
+        self.spares = deque()
+        self.refilling = False
+        self.current = True
+
+
+class TemplateCache:
+    """Keeps every template parsed in memory and hands out independent copies.
+
+    The raw bytes of each template are read once; parsed workbooks are kept
+    as a small stock of spares that a background thread refills, so a request
+    normally receives an already-parsed copy instead of paying for
+    ``openpyxl.load_workbook`` itself. The file's mtime is checked on every
+    checkout and the template is re-read (and re-hashed) when it changes.
+    """
+
+    def __init__(self, spares=None):
+        if spares is None:
+            spares = int(os.getenv('TEMPLATE_CACHE_SPARES', '2'))
+        self.spares = max(spares, 0)
+        self._entries = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.reloads = 0
+
+    def _parse(self, entry):
+        # Imported here so processes that only need the raw bytes never load openpyxl
+        import openpyxl
+        return openpyxl.load_workbook(io.BytesIO(entry.data), keep_vba=True)
+
+    def _entry(self, path):
+        path = os.path.abspath(path)
+        stat = os.stat(path)
+        with self._lock:
+            entry = self._entries.get(path)
+            if entry and entry.mtime_ns == stat.st_mtime_ns and entry.size == stat.st_size:
+                return entry
+        with open(path, 'rb') as f:
+            data = f.read()
+        new_entry = _TemplateEntry(path, stat, data)
+        with self._lock:
+            entry = self._entries.get(path)
+            if entry and entry.sha256 == new_entry.sha256:
+                # Touched but not changed: keep the parsed copies we have
+                entry.mtime_ns, entry.size = new_entry.mtime_ns, new_entry.size
+                return entry
+            if entry:
+                entry.current = False
+                self.reloads += 1
+            self._entries[path] = new_entry
+            return new_entry
+
+    def _refill(self, entry):
+        while True:
+            with self._lock:
+                if not entry.current or len(entry.spares) >= self.spares:
+                    entry.refilling = False
+                    return
+            try:
+                wb = self._parse(entry)
+            except Exception:
+                with self._lock:
+                    entry.refilling = False
+                raise
+            with self._lock:
+                if entry.current:
+                    entry.spares.append(wb)
+
+    def _schedule_refill(self, entry):
+        with self._lock:
+            if entry.refilling or not entry.current or len(entry.spares) >= self.spares:
+                return
+            entry.refilling = True
+        threading.Thread(target=self._refill, args=(entry,), daemon=True).start()
+
+    def preload(self, path):
+        """Read and parse a template up front, filling its stock of spares."""
+        entry = self._entry(path)
+        with self._lock:
+            entry.refilling = True
+        self._refill(entry)
+        return entry.sha256
+
+    @contextmanager
+    def checkout(self, path):
+        """Yield a fresh workbook for ``path`` that the caller may modify.
+
+        The spare is replaced only once the caller is done with its copy, so
+        the background parse does not compete with the export for the GIL.
+        """
+        entry = self._entry(path)
+        with self._lock:
+            wb = entry.spares.popleft() if entry.spares else None
+            if wb is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        if wb is None:
+            wb = self._parse(entry)
+        try:
+            yield wb
+        finally:
+            self._schedule_refill(entry)
+
+    def template_bytes(self, path):
+        """Return the raw bytes of ``path`` as currently cached."""
+        return self._entry(path).data
+
+    def version(self, path):
+        """Return the sha256 of the cached contents of ``path``."""
+        return self._entry(path).sha256
+
+    def stats(self):
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'reloads': self.reloads,
+                'templates': {
+                    path: {'sha256': entry.sha256, 'spares': len(entry.spares)}
+                    for path, entry in self._entries.items()
+                },
+            }
+
+
+template_cache = TemplateCache()
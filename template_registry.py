@@ -0,0 +1,477 @@
+"""Which template each export is filled into, by region and request type.
+
+``templates/registry.json`` maps "REGION/REQUEST_TYPE" keys, where "*"
+matches anything, to a template file and a version label::
+
+    {"templates": {"*/*": {"file": "wbs_template_actual.xlsm", "version": "10"}}}
+
+A template file is never changed in place: a new version is a new file, and
+the registry switches to it by replacing the manifest, so an export that has
+already resolved its template keeps the version it started with. Every
+process notices a new manifest on its next lookup.
+"""
+import html
+import io
+import json
+import os
+import re
+import tempfile
+import threading
+import traceback
+import zipfile
+
+import xlsx_patch
+from template_cache import template_cache
+from wbs_columns import REGION_FULL_NAMES, WBS_COLUMNS
+
+SHEET_NAME = 'Shared Template'
+TEMPLATE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'templates')
+DEFAULT_TEMPLATE = 'wbs_template_actual.xlsm'
+
+# Start of each column title in the header row, lower-cased with whitespace collapsed
+COLUMN_TITLES = {
+    'region': 'region',
+    'type': 'kind of change',
+    'system': 'system',
+    'controllingArea': 'controlling area',
+    'companyCode': 'company code',
+    'projectName': 'project name',
+    'projectDefinition': 'project definition',
+    'level': 'level',
+    'projectType': 'project typ',
+    'investmentProfile': 'inves',
+    'responsibleProfitCenter': 'responsible profit center',
+    'responsibleCostCenter': 'responsible cost center',
+    'planningElement': 'planning element',
+    'rubricElement': 'rubr',
+    'billingElement': 'billing element',
+    'settlementRulePercent': 'settlement rule %',
+    'settlementRuleGoal': 'settlement rule goal',
+    'projectProfile': 'project profile',
+    'responsiblePerson': 'responsible person',
+    'userId': 'user id',
+    'employmentNumber': 'employment',
+    'functionalArea': 'functional area',
+    'comment': 'comment',
+    'tm1Project': 'tm1',
+    'tgPhase': 'tg phase',
+    'projectSpec': 'project specification',
+    'motherCode': 'mother code',
+}
+
+# The field each mapped column is titled after; code_label columns by their code field
+MAPPED_FIELDS = {
+    column: field[0] if isinstance(field, tuple) else field for column, field, *_ in WBS_COLUMNS
+}
+
+# Labels above the table whose value cell (right of the label) gets a field of the first element
+HEADER_LABELS = (
+    ('business controller', 'requesterDisplayName'),
+    ('business responsible', 'responsiblePerson'),
+)
+
+_CELL_RE = re.compile(r'<c\b([^>]*?)(?:/>|>(.*?)</c>)', re.S)
+_CELL_REF_RE = re.compile(r'\sr="([A-Z]+)(\d+)"')
+_CELL_TYPE_RE = re.compile(r'\st="([^"]*)"')
+_VALUE_RE = re.compile(r'<v>(.*?)</v>', re.S)
+_TEXT_RE = re.compile(r'<t\b[^>]*>(.*?)</t>', re.S)
+_SHARED_STRING_RE = re.compile(r'<si>(.*?)</si>', re.S)
+# vbaProject.bin, vbaProjectSignature*.bin, vbaData.xml and activeX controls
+_MACRO_PART_RE = re.compile(r'(^|/)(vbaproject[^/]*|vbadata[^/]*)$|(^|/)activex/')
+_MERGE_RE = re.compile(r'<mergeCell\b[^>]*?\sref="([A-Z]+)(\d+):([A-Z]+)(\d+)"')
+
+
+class TemplateError(ValueError):
+    pass
+
+
+def _title(text):
+    return ' '.join(text.split()).lower()
+
+
+def title_matches(values):
+    """Number of cells in a row ({column: text}) that look like WBS column titles."""
+    return sum(1 for text in values.values()
+               if isinstance(text, str) and any(_title(text).startswith(prefix) for prefix in COLUMN_TITLES.values()))
+
+
+def column_problems(titles, header_row):
+    """Describe every mapped column whose title in the header row ({column: text}) is wrong."""
+    problems = []
+    for column, field in MAPPED_FIELDS.items():
+        title = titles.get(column)
+        title = title if isinstance(title, str) else ''
+        if not _title(title).startswith(COLUMN_TITLES[field]):
+            problems.append(f"{xlsx_patch.column_letter(column)}{header_row} is '{' '.join(title.split())}', "
+                            f"expected '{COLUMN_TITLES[field]}...' for {field}")
+    return problems
+
+
+def _shared_strings(data):
+    with zipfile.ZipFile(io.BytesIO(data)) as zf:
+        if 'xl/sharedStrings.xml' not in zf.namelist():
+            return []
+        xml = zf.read('xl/sharedStrings.xml').decode('utf-8')
+    return [html.unescape(''.join(_TEXT_RE.findall(si))) for si in _SHARED_STRING_RE.findall(xml)]
+
+
+def _row_values(row, strings):
+    """Return {column: text} for the cells of one row of sheet XML that hold a value."""
+    values = {}
+    for match in _CELL_RE.finditer(row):
+        attrs, inner = match.group(1), match.group(2) or ''
+        ref = _CELL_REF_RE.search(attrs)
+        cell_type = _CELL_TYPE_RE.search(attrs)
+        cell_type = cell_type.group(1) if cell_type else None
+        if cell_type == 'inlineStr':
+            text = ''.join(_TEXT_RE.findall(inner))
+        else:
+            value = _VALUE_RE.search(inner)
+            if value is None:
+                continue
+            text = value.group(1)
+            if cell_type == 's':
+                text = strings[int(text)]
+        text = html.unescape(text)
+        if ref and text.strip():
+            values[xlsx_patch.column_index(ref.group(1))] = text
+    return values
+
+
+def macro_parts(data):
+    """Return the names of the VBA and ActiveX parts in a workbook package."""
+    try:
+        with zipfile.ZipFile(io.BytesIO(data)) as zf:
+            names = zf.namelist()
+    except zipfile.BadZipFile as e:
+        raise TemplateError(f"Template cannot be used: {e}")
+    return [name for name in names if _MACRO_PART_RE.search(name.lower())]
+
+
+# Exports are served as .xlsm, which Excel only opens if the workbook part says so
+MACRO_ENABLED_WORKBOOK = 'application/vnd.ms-excel.sheet.macroEnabled.main+xml'
+_OFFICE_DOCUMENT_RE = re.compile(
+    r'<Relationship\b[^>]*Type="[^"]*/officeDocument"[^>]*Target="/?([^"]+)"'
+    r'|<Relationship\b[^>]*Target="/?([^"]+)"[^>]*Type="[^"]*/officeDocument"')
+
+
+def workbook_content_type(data):
+    """Return the content type of the workbook part of a package, or None."""
+    try:
+        with zipfile.ZipFile(io.BytesIO(data)) as zf:
+            rels = zf.read('_rels/.rels').decode('utf-8')
+            types = zf.read('[Content_Types].xml').decode('utf-8')
+    except (KeyError, UnicodeDecodeError, zipfile.BadZipFile) as e:
+        raise TemplateError(f"Template cannot be used: {e}")
+    match = _OFFICE_DOCUMENT_RE.search(rels)
+    if match is None:
+        return None
+    part = '/' + (match.group(1) or match.group(2))
+    override = re.search(r'<Override\b[^>]*PartName="' + re.escape(part) + r'"[^>]*ContentType="([^"]+)"', types)
+    return override.group(1) if override else None
+
+
+class TemplateLayout:
+    """Where the WBS table and header cells are on a template's sheet.
+
+    ``header_row`` holds the column titles and ``start_row`` is the first
+    row below it (and below any example rows) that is empty in every mapped
+    column. ``header_cells`` maps (row, column) to the element field written
+    there. ``columns`` maps each mapped column to its title.
+    """
+
+    def __init__(self, sheet_name, header_row, start_row, header_cells, columns):
+        self.sheet_name = sheet_name
+        self.header_row = header_row
+        self.start_row = start_row
+        self.header_cells = header_cells
+        self.columns = columns
+
+    def header_values(self, wbs_data):
+        """Return {(row, column): value} for the header cells, taken from the first element."""
+        first = wbs_data[0] if wbs_data else {}
+        return {cell: first.get(field, '') for cell, field in self.header_cells.items()}
+
+    def to_dict(self):
+        return {
+            'sheetName': self.sheet_name,
+            'headerRow': self.header_row,
+            'startRow': self.start_row,
+            'headerCells': {
+                f'{xlsx_patch.column_letter(column)}{row}': field
+                for (row, column), field in self.header_cells.items()
+            },
+            'columns': {xlsx_patch.column_letter(column): title for column, title in self.columns.items()},
+        }
+
+
+def analyse_template(patch_template, data, sheet_name=SHEET_NAME):
+    """Work out the TemplateLayout of a template, or raise TemplateError.
+
+    The column titles must match WBS_COLUMNS exactly: a template whose
+    columns moved would otherwise be filled with values in the wrong place.
+    """
+    strings = _shared_strings(data)
+    header_row, header_titles, best = None, {}, 0
+    rows = {}
+    for number, row in zip(patch_template.row_numbers, patch_template.rows):
+        values = _row_values(row, strings)
+        rows[number] = values
+        matched = title_matches(values)
+        if matched > best:
+            header_row, header_titles, best = number, values, matched
+        if header_row is not None and number > header_row + 50:
+            break
+    if header_row is None:
+        raise TemplateError(f"No WBS column titles found on sheet '{sheet_name}'")
+
+    problems = column_problems(header_titles, header_row)
+    if problems:
+        raise TemplateError('Template columns do not match the WBS export: ' + '; '.join(problems))
+
+    start_row = header_row + 1
+    while any(column in MAPPED_FIELDS for column in rows.get(start_row, ())):
+        start_row += 1
+
+    merges = {}
+    for first_col, first_row, last_col, last_row in _MERGE_RE.findall(patch_template.tail):
+        merges[(int(first_row), xlsx_patch.column_index(first_col))] = xlsx_patch.column_index(last_col)
+    header_cells = {}
+    for label, field in HEADER_LABELS:
+        for number in range(1, header_row):
+            found = [column for column, text in rows.get(number, {}).items() if _title(text).startswith(label)]
+            if found:
+                # The value goes right of the label, after any cells merged into it
+                header_cells[(number, merges.get((number, found[0]), found[0]) + 1)] = field
+                break
+        else:
+            raise TemplateError(f"No '{label}' label above the WBS table")
+
+    columns = {column: ' '.join(header_titles[column].split()) for column in MAPPED_FIELDS}
+    return TemplateLayout(sheet_name, header_row, start_row, header_cells, columns)
+
+
+_layouts = {}
+_layouts_lock = threading.Lock()
+
+
+def template_layout(template_path, sheet_name=SHEET_NAME):
+    """Return the TemplateLayout for the current version of template_path."""
+    key = (os.path.abspath(template_path), sheet_name)
+    version = template_cache.version(template_path)
+    with _layouts_lock:
+        cached = _layouts.get(key)
+    if cached and cached[0] == version:
+        return cached[1]
+    layout = analyse_template(
+        xlsx_patch.get_patch_template(template_path, sheet_name),
+        template_cache.template_bytes(template_path), sheet_name)
+    with _layouts_lock:
+        _layouts[key] = (version, layout)
+    return layout
+
+
+class TemplateVersion:
+    """One registered template: its file, version label and analysed layout."""
+
+    def __init__(self, key, path, version, sha256, layout):
+        self.key = key
+        self.path = path
+        self.version = version
+        self.sha256 = sha256
+        self.layout = layout
+
+    def to_dict(self):
+        return {
+            'key': self.key,
+            'file': os.path.basename(self.path),
+            'version': self.version,
+            'sha256': self.sha256,
+            'layout': self.layout.to_dict(),
+        }
+
+
+def _key_part(value):
+    return str(value).strip().upper() if value not in (None, '', '*') else '*'
+
+
+def template_key(region, request_type):
+    return f'{_key_part(region)}/{_key_part(request_type)}'
+
+
+class TemplateRegistry:
+    """Templates by region and request type, read from the registry manifest.
+
+    Every template in the manifest is analysed when the manifest is loaded;
+    if any of them fails, the previous registry stays in use. ``resolve``
+    picks the most specific entry: region and request type, then region
+    alone, then request type alone, then the "*/*" default. Without a
+    manifest every export uses templates/wbs_template_actual.xlsm.
+    """
+
+    def __init__(self, manifest_path=None):
+        self.manifest_path = manifest_path or os.getenv(
+            'TEMPLATE_REGISTRY', os.path.join(TEMPLATE_DIR, 'registry.json'))
+        self.directory = os.path.dirname(os.path.abspath(self.manifest_path))
+        self._entries = None
+        self._manifest_stat = None
+        self._lock = threading.Lock()
+        self.swaps = 0
+        self.last_error = None
+
+    def _manifest_state(self):
+        try:
+            stat = os.stat(self.manifest_path)
+        except FileNotFoundError:
+            return None
+        return stat.st_mtime_ns, stat.st_size
+
+    def _read_manifest(self):
+        try:
+            with open(self.manifest_path, 'r', encoding='utf-8') as f:
+                manifest = json.load(f)
+        except FileNotFoundError:
+            return {'*/*': {'file': DEFAULT_TEMPLATE}}
+        except ValueError as e:
+            raise TemplateError(f"Invalid template registry {self.manifest_path}: {e}")
+        templates = manifest.get('templates') if isinstance(manifest, dict) else None
+        if not isinstance(templates, dict) or not templates:
+            raise TemplateError(f"Template registry {self.manifest_path} lists no templates")
+        normalised = {}
+        for key, spec in templates.items():
+            region, _, request_type = str(key).partition('/')
+            normalised[template_key(region, request_type)] = spec
+        return normalised
+
+    def _load_entry(self, key, spec):
+        region, _, request_type = key.partition('/')
+        if region != '*' and region not in REGION_FULL_NAMES:
+            raise TemplateError(f"Unknown region '{region}' in template key '{key}'")
+        if not isinstance(spec, dict) or not spec.get('file'):
+            raise TemplateError(f"Template '{key}' has no file")
+        path = os.path.join(self.directory, spec['file'])
+        try:
+            layout = template_layout(path, spec.get('sheet') or SHEET_NAME)
+        except TemplateError as e:
+            raise TemplateError(f"Template '{key}' ({spec['file']}): {e}")
+        except (OSError, KeyError, zipfile.BadZipFile) as e:
+            raise TemplateError(f"Template '{key}' ({spec['file']}) cannot be read: {e}")
+        sha256 = template_cache.version(path)
+        return TemplateVersion(key, path, str(spec.get('version') or sha256[:12]), sha256, layout)
+
+    def _load(self, templates):
+        entries = {key: self._load_entry(key, spec) for key, spec in templates.items()}
+        if '*/*' not in entries:
+            raise TemplateError("Template registry has no '*/*' default template")
+        return entries
+
+    def _current(self):
+        state = self._manifest_state()
+        entries = self._entries
+        if entries is not None and state == self._manifest_stat:
+            return entries
+        with self._lock:
+            if self._entries is not None and state == self._manifest_stat:
+                return self._entries
+            try:
+                entries = self._load(self._read_manifest())
+            except TemplateError as e:
+                if self._entries is None:
+                    raise
+                # Keep exporting with the templates we have
+                traceback.print_exc()
+                self.last_error = str(e)
+                self._manifest_stat = state
+                return self._entries
+            if self._entries is not None:
+                self.swaps += 1
+            self._entries, self._manifest_stat, self.last_error = entries, state, None
+            return entries
+
+    def reload(self):
+        """Re-read the manifest now, raising TemplateError if it cannot be used."""
+        with self._lock:
+            entries = self._load(self._read_manifest())
+            if self._entries is not None:
+                self.swaps += 1
+            self._entries, self._manifest_stat, self.last_error = entries, self._manifest_state(), None
+        return list(entries.values())
+
+    def resolve(self, region=None, request_type=None):
+        """Return the TemplateVersion for an export."""
+        entries = self._current()
+        region, request_type = _key_part(region), _key_part(request_type)
+        for key in (f'{region}/{request_type}', f'{region}/*', f'*/{request_type}', '*/*'):
+            entry = entries.get(key)
+            if entry is not None:
+                return entry
+
+    def templates(self):
+        return list(self._current().values())
+
+    def paths(self):
+        return sorted({entry.path for entry in self._current().values()})
+
+    def install(self, region, request_type, data, version):
+        """Add a new template version and switch the registry to it.
+
+        The template is analysed before anything is written; it is then saved
+        as its own file and the manifest is replaced atomically. Uploads with
+        VBA or ActiveX parts are refused: only templates shipped with the
+        service (listed in the manifest by hand) may carry macros. The
+        workbook must still be saved as .xlsm, since exports are served as
+        such and Excel rejects an .xlsm holding a plain .xlsx workbook.
+        """
+        key = template_key(region, request_type)
+        if key.partition('/')[0] not in REGION_FULL_NAMES and not key.startswith('*/'):
+            raise TemplateError(f"Unknown region '{region}'")
+        version = str(version or '').strip()
+        if not re.fullmatch(r'[A-Za-z0-9._-]{1,40}', version):
+            raise TemplateError('Template version must be 1-40 letters, digits, dots, dashes or underscores')
+        macros = macro_parts(data)
+        if macros:
+            raise TemplateError('Uploaded templates must not contain macros or ActiveX controls: '
+                                + ', '.join(macros))
+        if workbook_content_type(data) != MACRO_ENABLED_WORKBOOK:
+            raise TemplateError('Uploaded templates must be saved as .xlsm (macro-enabled workbook) '
+                                'without macros; exports are served as .xlsm')
+        try:
+            analyse_template(xlsx_patch.PatchTemplate(data, SHEET_NAME), data)
+        except (KeyError, ValueError, zipfile.BadZipFile) as e:
+            raise TemplateError(f"Template cannot be used: {e}")
+        with self._lock:
+            templates = self._read_manifest()
+            name = f"wbs_template_{key.replace('*', 'all').replace('/', '_')}_{version}.xlsm"
+            path = os.path.join(self.directory, name)
+            if os.path.exists(path):
+                raise TemplateError(f"Template version {version} already exists for {key}")
+            self._write_atomic(path, data)
+            spec = {'file': name, 'version': version}
+            templates[key] = spec
+            entries = dict(self._entries or self._load(templates))
+            entries[key] = self._load_entry(key, spec)
+            self._write_atomic(self.manifest_path, json.dumps({'templates': templates}, indent=2).encode('utf-8'))
+            self._entries, self._manifest_stat, self.last_error = entries, self._manifest_state(), None
+            self.swaps += 1
+            return entries[key]
+
+    def _write_atomic(self, path, data):
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, prefix='.tmp-')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+    def stats(self):
+        return {
+            'swaps': self.swaps,
+            'lastError': self.last_error,
+            'templates': {entry.key: entry.version for entry in self._current().values()},
+        }
+
+
+template_registry = TemplateRegistry()
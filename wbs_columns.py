@@ -0,0 +1,204 @@
+"""The mapping from WBS element fields to the columns of 'Shared Template'.
+
+Every export path (openpyxl, xlwings and the raw XML writer) fills rows from
+the one spec below, compiled once into ``WBS_ROWS``. Values are coerced a
+column at a time for a whole batch of elements before any cell is written.
+Coded columns take their labels from the service's lookup tables
+(wbs_lookups), so an element only needs the code.
+"""
+import itertools
+
+from wbs_lookups import wbs_lookups
+
+REGION_FULL_NAMES = {
+    'DE': 'Germany',
+    'NL': 'Netherlands',
+    'UK': 'Nordic',
+    'SE': 'Nordic',
+    'DK': 'Nordic'
+}
+
+# Elements are coerced in batches of this many so memory stays bounded
+BATCH_SIZE = 1000
+
+# (column, field, kind[, default]). 'code_label' takes a (code, label) pair of fields.
+WBS_COLUMNS = (
+    (1, 'region', 'region'),
+    (2, 'type', 'text'),
+    (3, 'system', 'text', 'KIS'),
+    (4, ('controllingArea', 'controllingAreaLabel'), 'code_label'),
+    (5, 'companyCode', 'int'),
+    (6, 'projectName', 'text'),
+    (7, 'projectDefinition', 'text'),
+    (8, 'level', 'int'),
+    (9, 'projectType', 'text'),
+    (10, 'investmentProfile', 'int'),
+    (11, 'responsibleProfitCenter', 'int'),
+    (12, 'responsibleCostCenter', 'int'),
+    (13, 'planningElement', 'flag'),
+    (14, 'rubricElement', 'flag'),
+    (15, 'billingElement', 'flag'),
+    (16, 'settlementRulePercent', 'percent'),
+    (17, 'settlementRuleGoal', 'text'),
+    (18, 'projectProfile', 'text'),
+    (19, 'responsiblePerson', 'text'),
+    (20, 'userId', 'text'),
+    (21, 'employmentNumber', 'int'),
+    (22, ('functionalArea', 'functionalAreaLabel'), 'code_label'),
+    (24, 'comment', 'text'),
+    (25, 'tm1Project', 'text'),
+    (26, 'tgPhase', 'int'),
+    (27, 'projectSpec', 'project_spec'),
+    (28, 'motherCode', 'text'),
+)
+
+
+def get_full_region_name(region_code):
+    return REGION_FULL_NAMES.get(region_code, region_code)
+
+
+def combine_code_label(code, label):
+    if code and label and str(code) not in str(label):
+        return f"{code} {label}"
+    elif label:
+        return label
+    elif code:
+        return code
+    return ''
+
+
+def to_int(value):
+    """Return value as an integer if possible, otherwise unchanged."""
+    try:
+        if value is not None and value != '':
+            return int(value)
+    except Exception:
+        pass
+    return value
+
+
+def to_percent(value):
+    """Return a percentage as a fraction (50 -> 0.5), or the value unchanged."""
+    if value in ('', None):
+        return ''
+    try:
+        return float(value) / 100
+    except Exception:
+        return value
+
+
+def _int_column(values):
+    try:
+        # Fast path for a column of integers and blanks
+        return [value if value == '' else int(value) for value in values]
+    except Exception:
+        return [to_int(value) for value in values]
+
+
+def _percent_column(values):
+    try:
+        return [value if value == '' else float(value) / 100 for value in values]
+    except Exception:
+        return [to_percent(value) for value in values]
+
+
+def _project_spec_column(values):
+    # 'ASSET' is written as 'Asset'
+    return ['Asset' if isinstance(value, str) and value.strip().upper() == 'ASSET' else value
+            for value in values]
+
+
+def _region_column(values):
+    tables = wbs_lookups.tables()
+    return [tables.region_name(value) or REGION_FULL_NAMES.get(value, value) for value in values]
+
+
+_CONVERTERS = {
+    'text': None,
+    'int': _int_column,
+    'flag': lambda values: ['x' if value else '' for value in values],
+    'percent': _percent_column,
+    'region': _region_column,
+    'project_spec': _project_spec_column,
+}
+
+
+class CompiledColumns:
+    """A column spec compiled into per-column extract-and-convert steps.
+
+    ``rows`` turns elements into tuples of cell values ordered like
+    ``columns``; the writers place those tuples on a worksheet.
+    """
+
+    def __init__(self, spec):
+        self.columns = tuple(entry[0] for entry in spec)
+        self._steps = [self._compile(*entry) for entry in spec]
+        # Runs of adjacent columns as (first column, start, end) slices of a row
+        self.blocks = []
+        start = 0
+        for i in range(1, len(self.columns) + 1):
+            if i == len(self.columns) or self.columns[i] != self.columns[i - 1] + 1:
+                self.blocks.append((self.columns[start], start, i))
+                start = i
+
+    @staticmethod
+    def _compile(column, field, kind, default=''):
+        if kind == 'code_label':
+            # The code field names the lookup table; a label sent with the element
+            # is only used for codes the table does not know
+            code_field, label_field = field
+
+            def step(elements):
+                tables = wbs_lookups.tables()
+                cells = []
+                for element in elements:
+                    code = element.get(code_field, '')
+                    label = tables.label(code_field, element.get('region'), code) or element.get(label_field, '')
+                    cells.append(combine_code_label(code, label))
+                return cells
+            return step
+        if kind not in _CONVERTERS:
+            raise ValueError(f"Unknown column kind {kind!r} for column {column}")
+        convert = _CONVERTERS[kind]
+        if convert is None:
+            return lambda elements: [element.get(field, default) for element in elements]
+        return lambda elements: convert([element.get(field, default) for element in elements])
+
+    def rows(self, elements):
+        """Return one tuple of cell values per element."""
+        return list(zip(*(step(elements) for step in self._steps))) if elements else []
+
+    def iter_rows(self, elements, batch_size=BATCH_SIZE):
+        """Yield row tuples, converting elements a batch at a time."""
+        for start in range(0, len(elements), batch_size):
+            yield from self.rows(elements[start:start + batch_size])
+
+    def cells(self, row):
+        """Map a row tuple to {column: value}."""
+        return dict(zip(self.columns, row))
+
+    def write_openpyxl(self, ws, start_row, rows):
+        """Write row tuples to an openpyxl worksheet from start_row down."""
+        cell = ws.cell
+        columns = self.columns
+        for row_number, row in enumerate(rows, start_row):
+            for column, value in zip(columns, row):
+                cell(row=row_number, column=column, value=value)
+
+    def write_xlwings(self, sheet, start_row, rows, batch_size=BATCH_SIZE):
+        """Write row tuples to an xlwings sheet, one 2D range per block per batch.
+
+        Each range assignment is a round trip to Excel, so cells are never
+        written one at a time.
+        """
+        rows = iter(rows)
+        while True:
+            batch = list(itertools.islice(rows, batch_size))
+            if not batch:
+                return
+            for first_column, start, end in self.blocks:
+                sheet.range((start_row, first_column)).value = [row[start:end] for row in batch]
+            start_row += len(batch)
+
+
+WBS_ROWS = CompiledColumns(WBS_COLUMNS)
@@ -0,0 +1,254 @@
+"""Read filled 'Shared Template' workbooks back into WBS elements.
+
+The sheet is streamed with openpyxl in read-only, values-only mode, so a
+workbook with tens of thousands of rows is never held in memory. Every
+column is converted back with the inverse of its export conversion in
+wbs_columns: percentages are multiplied by 100, 'x' flags become booleans
+and "code label" cells are split into their code and label fields.
+
+Usage:
+    python wbs_import.py <workbook> [<workbook> ...] [-o OUT.ndjson] [--jobs N] [--region SE]
+"""
+import argparse
+import concurrent.futures
+import json
+import os
+import shutil
+import sys
+import tempfile
+
+from template_registry import MAPPED_FIELDS, SHEET_NAME, column_problems, template_registry, title_matches
+from wbs_columns import REGION_FULL_NAMES, WBS_COLUMNS
+
+WORKBOOK_SUFFIXES = ('.xlsm', '.xlsx')
+# The column titles are looked for this far down the sheet
+HEADER_SEARCH_ROWS = 50
+# Full region name -> codes; 'Nordic' covers SE, DK and UK
+REGION_CODES = {}
+for _code, _name in REGION_FULL_NAMES.items():
+    REGION_CODES.setdefault(_name, []).append(_code)
+
+
+class WbsImportError(ValueError):
+    pass
+
+
+def _text(value):
+    if value is None:
+        return ''
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return str(value).strip()
+
+
+def _percent(value):
+    """Settlement rule % as entered in the form: 0.5 in the cell -> '50'."""
+    if value is None or value == '':
+        return ''
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return f'{round(value * 100, 6):g}'
+    return _text(value).rstrip('%').strip()
+
+
+def _flag(value):
+    return _text(value).lower() == 'x' or value is True
+
+
+def split_code_label(value):
+    """Inverse of combine_code_label: '5123 Holding' -> ('5123', 'Holding').
+
+    The first word is the code when it contains a digit; otherwise the
+    whole cell is the label.
+    """
+    text = _text(value)
+    code, _, label = text.partition(' ')
+    if any(char.isdigit() for char in code):
+        return code, label.strip()
+    return '', text
+
+
+def _region(value, default_region):
+    text = _text(value)
+    if text.upper() in REGION_FULL_NAMES:
+        return text.upper()
+    codes = REGION_CODES.get(text)
+    if not codes:
+        return text
+    if len(codes) == 1:
+        return codes[0]
+    # 'Nordic' does not say which country; use the caller's if it fits
+    return default_region if default_region in codes else text
+
+
+def _project_spec(value):
+    text = _text(value)
+    return 'ASSET' if text.upper() == 'ASSET' else text
+
+
+_READERS = {
+    'text': _text,
+    'int': _text,
+    'flag': _flag,
+    'percent': _percent,
+    'project_spec': _project_spec,
+}
+
+
+def _compile_readers(default_region):
+    """Return (column index, function(element, value)) for every mapped column."""
+    readers = []
+    for column, field, kind, *_ in WBS_COLUMNS:
+        if kind == 'code_label':
+            code_field, label_field = field
+
+            def read(element, value, code_field=code_field, label_field=label_field):
+                element[code_field], element[label_field] = split_code_label(value)
+        elif kind == 'region':
+            def read(element, value, field=field):
+                element[field] = _region(value, default_region)
+        else:
+            def read(element, value, field=field, convert=_READERS[kind]):
+                element[field] = convert(value)
+        readers.append((column - 1, read))
+    return readers
+
+
+def iter_wbs_rows(path, region=None):
+    """Yield (row number, WBS element) for every filled row of the workbook at path.
+
+    The header row is found by its column titles, so rows inserted above the
+    table are allowed; the WBS rows start as far below it as in the default
+    template (row 18 when the titles are on row 13). The Business Controller
+    cell fills requesterDisplayName. region is used where the sheet only
+    says 'Nordic'.
+    """
+    # Imported here so the service only loads openpyxl in the processes that import
+    import openpyxl
+    layout = template_registry.resolve().layout
+    readers = _compile_readers(region)
+    last_column = max(column for column, *_ in WBS_COLUMNS)
+    try:
+        wb = openpyxl.load_workbook(path, read_only=True, data_only=True, keep_links=False)
+    except FileNotFoundError:
+        raise
+    except Exception as e:
+        raise WbsImportError(f"Not an Excel workbook: {e}")
+    try:
+        if SHEET_NAME not in wb.sheetnames:
+            raise WbsImportError(f"Workbook has no '{SHEET_NAME}' sheet")
+        rows = wb[SHEET_NAME].iter_rows(max_col=last_column, values_only=True)
+        above = []
+        for number, values in enumerate(rows, 1):
+            titles = {column: value for column, value in enumerate(values, 1) if value is not None}
+            if title_matches(titles) >= len(MAPPED_FIELDS) // 2:
+                break
+            above.append(values)
+            if number >= HEADER_SEARCH_ROWS:
+                raise WbsImportError(f"No WBS column titles in the first {HEADER_SEARCH_ROWS} rows")
+        else:
+            raise WbsImportError('No WBS column titles found')
+        problems = column_problems(titles, number)
+        if problems:
+            raise WbsImportError('Columns do not match the WBS template: ' + '; '.join(problems))
+
+        shift = number - layout.header_row
+        header = {}
+        for (row, column), field in layout.header_cells.items():
+            if 0 < row + shift <= len(above) and column <= len(above[row + shift - 1]):
+                header[field] = _text(above[row + shift - 1][column - 1])
+        above = None
+
+        start_row = layout.start_row + shift
+        for number, values in enumerate(rows, number + 1):
+            if number < start_row or not any(value not in (None, '') for value in values):
+                continue
+            values = tuple(values) + (None,) * (last_column - len(values))
+            element = {}
+            for index, read in readers:
+                read(element, values[index])
+            for field, value in header.items():
+                if not element.get(field):
+                    element[field] = value
+            yield number, element
+    finally:
+        wb.close()
+
+
+def import_ndjson(path, out, source=None, region=None):
+    """Write the workbook's WBS elements to out as NDJSON and return how many.
+
+    out is a path or a binary file object. Each line also carries
+    sourceFile and sourceRow so problems can be traced back to the sheet.
+    """
+    source = source or os.path.basename(path)
+    if not hasattr(out, 'write'):
+        with open(out, 'wb') as f:
+            return import_ndjson(path, f, source, region)
+    count = 0
+    for number, element in iter_wbs_rows(path, region):
+        element['sourceFile'] = source
+        element['sourceRow'] = number
+        out.write(json.dumps(element, ensure_ascii=False).encode('utf-8'))
+        out.write(b'\n')
+        count += 1
+    return count
+
+
+def _import_to_file(path, region):
+    fd, out_path = tempfile.mkstemp(suffix='.ndjson')
+    os.close(fd)
+    try:
+        return out_path, import_ndjson(path, out_path, region=region)
+    except BaseException:
+        os.remove(out_path)
+        raise
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Read filled WBS templates back into NDJSON WBS elements.')
+    parser.add_argument('workbooks', nargs='+', help='.xlsm/.xlsx files to read')
+    parser.add_argument('-o', '--output', help='write NDJSON here instead of stdout')
+    parser.add_argument('--jobs', type=int, default=os.cpu_count() or 1,
+                        help='workbooks to parse in parallel (default: one per CPU)')
+    parser.add_argument('--region', choices=sorted(REGION_FULL_NAMES),
+                        help="region code for rows that only say 'Nordic'")
+    args = parser.parse_args(argv)
+
+    out = open(args.output, 'wb') if args.output else sys.stdout.buffer
+    total = 0
+    try:
+        if len(args.workbooks) == 1 or args.jobs <= 1:
+            for path in args.workbooks:
+                total += import_ndjson(path, out, region=args.region)
+        else:
+            # Each workbook is parsed into its own file; they are copied out in order
+            with concurrent.futures.ProcessPoolExecutor(min(args.jobs, len(args.workbooks))) as executor:
+                futures = [executor.submit(_import_to_file, path, args.region) for path in args.workbooks]
+                try:
+                    for future in futures:
+                        out_path, count = future.result()
+                        with open(out_path, 'rb') as f:
+                            shutil.copyfileobj(f, out)
+                        os.remove(out_path)
+                        total += count
+                except BaseException:
+                    # Remove the files of workbooks that were parsed but not copied out
+                    executor.shutdown(cancel_futures=True)
+                    for future in futures:
+                        if not future.cancelled() and future.exception() is None:
+                            out_path = future.result()[0]
+                            if os.path.exists(out_path):
+                                os.remove(out_path)
+                    raise
+    except WbsImportError as e:
+        print(f'Import failed: {e}', file=sys.stderr)
+        return 1
+    finally:
+        if args.output:
+            out.close()
+    print(f'Imported {total} WBS element(s) from {len(args.workbooks)} workbook(s).', file=sys.stderr)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
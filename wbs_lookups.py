@@ -0,0 +1,161 @@
+"""Code -> label tables for the coded WBS fields, owned by the service.
+
+``templates/lookups.json`` holds a version label and one table per coded
+field: controlling area and functional area by region, plus the full name
+written for each region code::
+
+    {"version": "1",
+     "region": {"DE": "Germany", ...},
+     "controllingArea": {"DE": {"5123": "Holding", ...}, ...},
+     "functionalArea": {"DE": {"1001": "Production", ...}, ...}}
+
+Exports resolve the label of a bare code here, so clients only send codes.
+The forms take their options from GET /lookups, with this file bundled as
+their fallback (lib/services/lookups.ts), so codes and labels live only here.
+Like the template registry, every process notices an edited file on its
+next lookup and keeps the previous tables if the new file cannot be used.
+"""
+import json
+import os
+import threading
+import traceback
+
+LOOKUPS_PATH = os.getenv(
+    'WBS_LOOKUPS', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'templates', 'lookups.json'))
+# Tables keyed by region, then code
+REGION_TABLES = ('controllingArea', 'functionalArea')
+
+
+class WbsLookupError(ValueError):
+    pass
+
+
+def _labels(name, table):
+    if not isinstance(table, dict) or not all(
+            isinstance(label, str) for label in table.values()):
+        raise WbsLookupError(f"Lookup table '{name}' must map codes to labels")
+    return {str(code): label for code, label in table.items()}
+
+
+class LookupTables:
+    """One version of the lookup tables."""
+
+    def __init__(self, version=None, regions=None, tables=None):
+        self.version = version
+        self.regions = regions or {}
+        self.tables = tables or {name: {} for name in REGION_TABLES}
+
+    @classmethod
+    def from_dict(cls, data):
+        if not isinstance(data, dict) or not str(data.get('version') or '').strip():
+            raise WbsLookupError('Lookup tables need a version')
+        tables = {}
+        for name in REGION_TABLES:
+            by_region = data.get(name) or {}
+            if not isinstance(by_region, dict):
+                raise WbsLookupError(f"Lookup table '{name}' must be keyed by region")
+            tables[name] = {region: _labels(f'{name}/{region}', table) for region, table in by_region.items()}
+        return cls(str(data['version']).strip(), _labels('region', data.get('region') or {}), tables)
+
+    def label(self, table, region, code):
+        """Return the label of code in region's table, or '' if unknown."""
+        if code is None or code == '':
+            return ''
+        return self.tables[table].get(region, {}).get(str(code), '')
+
+    def region_name(self, region, default=None):
+        return self.regions.get(region, default)
+
+    def to_dict(self, region=None):
+        """The tables as the forms use them: options of {value, label} per table."""
+        def options(table):
+            return [{'value': code, 'label': label} for code, label in table.items()]
+
+        if region is not None:
+            return {
+                'version': self.version,
+                'region': region,
+                'regionName': self.regions.get(region),
+                **{name: options(self.tables[name].get(region, {})) for name in REGION_TABLES},
+            }
+        return {
+            'version': self.version,
+            'region': dict(self.regions),
+            **{name: {region: options(table) for region, table in self.tables[name].items()}
+               for name in REGION_TABLES},
+        }
+
+
+class WbsLookups:
+    """The current LookupTables, re-read when the lookups file changes."""
+
+    def __init__(self, path=None):
+        self.path = path or LOOKUPS_PATH
+        self._tables = None
+        self._stat = None
+        self._lock = threading.Lock()
+        self.swaps = 0
+        self.last_error = None
+
+    def _state(self):
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            return None
+        return stat.st_mtime_ns, stat.st_size
+
+    def _read(self):
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            # No tables: labels come from the elements themselves
+            return LookupTables()
+        except ValueError as e:
+            raise WbsLookupError(f"Invalid lookup tables {self.path}: {e}")
+        return LookupTables.from_dict(data)
+
+    def tables(self):
+        """Return the current LookupTables."""
+        state = self._state()
+        tables = self._tables
+        if tables is not None and state == self._stat:
+            return tables
+        with self._lock:
+            if self._tables is not None and state == self._stat:
+                return self._tables
+            try:
+                tables = self._read()
+            except WbsLookupError as e:
+                if self._tables is None:
+                    raise
+                # Keep exporting with the tables we have
+                traceback.print_exc()
+                self.last_error = str(e)
+                self._stat = state
+                return self._tables
+            if self._tables is not None:
+                self.swaps += 1
+            self._tables, self._stat, self.last_error = tables, state, None
+            return tables
+
+    def reload(self):
+        """Re-read the lookups file now, raising WbsLookupError if it cannot be used."""
+        with self._lock:
+            tables = self._read()
+            if self._tables is not None:
+                self.swaps += 1
+            self._tables, self._stat, self.last_error = tables, self._state(), None
+        return tables
+
+    def stats(self):
+        tables = self.tables()
+        return {
+            'version': tables.version,
+            'swaps': self.swaps,
+            'lastError': self.last_error,
+            'codes': {name: sum(map(len, tables.tables[name].values())) for name in REGION_TABLES},
+        }
+
+
+wbs_lookups = WbsLookups()
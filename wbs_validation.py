@@ -0,0 +1,164 @@
+"""Pre-flight checks for WBS payloads, run before any template is loaded.
+
+Errors are collected for the whole payload and returned keyed by row (the
+element's index in wbsData), each as {"field": ..., "message": ...}.
+Warnings are kept the same way for checks stored requests may not pass
+(a missing level, settlement rules not totalling 100%); they never reject
+an export.
+"""
+import os
+import re
+
+MAX_LEVEL = 5
+PROJECT_SPECS = ('ASSET', 'INTERNAL', 'DEPARTMENT')
+# Allowed tollgate phases, comma separated; TG Phase is free text in the form,
+# so by default any value is accepted
+TG_PHASES = tuple(phase.strip() for phase in os.getenv('WBS_TG_PHASES', '').split(',') if phase.strip())
+# Settlement rule totals within this many percentage points of 100 are accepted
+PERCENT_TOLERANCE = 0.01
+
+_COMPANY_CODE_RE = re.compile(r'^\d{4}$')
+_CENTER_RE = re.compile(r'^\d{8}$')
+
+
+def _text(value):
+    return '' if value is None else str(value).strip()
+
+
+class WbsValidator:
+    """Validates WBS elements in order, one batch at a time.
+
+    Keeps an index of projectDefinition -> (row, level) so a motherCode can
+    be checked against its parent in constant time. Rows that share a
+    projectDefinition are one element with several settlement rules, whose
+    percentages should total 100. Call ``finish`` after the last batch.
+    """
+
+    def __init__(self):
+        self.errors = {}
+        self.warnings = {}
+        self.count = 0
+        self._elements = {}
+        self._forward_refs = {}
+        self._settlements = {}
+        self._previous_level = None
+
+    def _error(self, row, field, message):
+        self.errors.setdefault(row, []).append({'field': field, 'message': message})
+
+    def _warning(self, row, field, message):
+        self.warnings.setdefault(row, []).append({'field': field, 'message': message})
+
+    def add(self, elements):
+        for element in elements:
+            self._check(self.count, element)
+            self.count += 1
+
+    def _check(self, row, element):
+        if not isinstance(element, dict):
+            self._error(row, None, 'WBS element must be an object')
+            return
+        definition = _text(element.get('projectDefinition'))
+        level = self._check_level(row, element)
+        self._check_parent(row, definition, level, _text(element.get('motherCode')))
+        if definition and definition not in self._elements:
+            self._elements[definition] = (row, level)
+        self._check_settlement(row, definition, element)
+        self._check_codes(row, element)
+
+        project_spec = _text(element.get('projectSpec'))
+        if project_spec and project_spec.upper() not in PROJECT_SPECS:
+            self._error(row, 'projectSpec',
+                        f"Project spec '{project_spec}' is not one of {', '.join(PROJECT_SPECS)}")
+        tg_phase = _text(element.get('tgPhase'))
+        if tg_phase and TG_PHASES and tg_phase not in TG_PHASES:
+            self._error(row, 'tgPhase', f"TG phase '{tg_phase}' is not one of {', '.join(TG_PHASES)}")
+
+    def _check_level(self, row, element):
+        text = _text(element.get('level'))
+        if not text:
+            self._warning(row, 'level', 'Level is required')
+            return None
+        if not text.isdigit() or not 1 <= int(text) <= MAX_LEVEL:
+            self._error(row, 'level', f"Level must be a whole number from 1 to {MAX_LEVEL}, got '{text}'")
+            return None
+        level = int(text)
+        previous = self._previous_level
+        if previous is not None and level > previous + 1:
+            self._error(row, 'level', f"Level {level} follows a level {previous} element; "
+                                      f"levels can only go one deeper at a time")
+        self._previous_level = level
+        return level
+
+    def _check_parent(self, row, definition, level, mother_code):
+        if not mother_code:
+            return
+        if mother_code == definition:
+            self._error(row, 'motherCode', 'Mother code refers to the element itself')
+            return
+        parent = self._elements.get(mother_code)
+        if parent is None:
+            # Either defined further down (checked in finish) or an existing element
+            self._forward_refs.setdefault(mother_code, []).append(row)
+            return
+        parent_row, parent_level = parent
+        if level is not None and parent_level is not None and parent_level != level - 1:
+            self._error(row, 'motherCode', f"Mother code {mother_code} (row {parent_row}) is level "
+                                           f"{parent_level}, but this level {level} element needs a "
+                                           f"level {level - 1} parent")
+
+    def _check_settlement(self, row, definition, element):
+        text = _text(element.get('settlementRulePercent'))
+        if not text:
+            return
+        try:
+            percent = float(text)
+        except ValueError:
+            self._error(row, 'settlementRulePercent', f"Settlement rule % must be a number, got '{text}'")
+            return
+        if not 0 < percent <= 100:
+            self._error(row, 'settlementRulePercent',
+                        f"Settlement rule % must be above 0 and at most 100, got {percent:g}")
+            return
+        totals = self._settlements.setdefault(definition or row, [row, 0.0, []])
+        totals[1] += percent
+        totals[2].append(row)
+
+    def _check_codes(self, row, element):
+        company_code = _text(element.get('companyCode'))
+        if company_code and not _COMPANY_CODE_RE.match(company_code):
+            self._error(row, 'companyCode', f"Company code must be 4 digits, got '{company_code}'")
+            company_code = ''
+        for field, name in (('responsibleProfitCenter', 'Profit center'),
+                            ('responsibleCostCenter', 'Cost center')):
+            code = _text(element.get(field))
+            if not code:
+                continue
+            if not _CENTER_RE.match(code):
+                self._error(row, field, f"{name} must be 8 digits, got '{code}'")
+            elif company_code and not code.startswith(company_code):
+                self._error(row, field, f"{name} {code} must start with company code {company_code}")
+
+    def finish(self):
+        """Run the checks that need the whole payload and return the errors by row."""
+        for mother_code, rows in self._forward_refs.items():
+            parent = self._elements.get(mother_code)
+            if parent is not None:
+                for row in rows:
+                    self._error(row, 'motherCode', f"Mother code {mother_code} is defined on a later "
+                                                   f"row ({parent[0]}); parents must come first")
+        for key, (first_row, total, rows) in self._settlements.items():
+            if abs(total - 100) > PERCENT_TOLERANCE:
+                element = f"element {key}" if isinstance(key, str) else 'this element'
+                self._warning(first_row, 'settlementRulePercent',
+                              f"Settlement rules for {element} total {total:g}%, expected 100% "
+                              f"(rows {', '.join(map(str, rows))})")
+        self.warnings = dict(sorted(self.warnings.items()))
+        return dict(sorted(self.errors.items()))
+
+
+def validate_wbs(wbs_data):
+    """Return (errors, warnings) in wbs_data, each keyed by row; errors is empty if valid."""
+    validator = WbsValidator()
+    validator.add(wbs_data)
+    return validator.finish(), validator.warnings
@@ -0,0 +1,376 @@
+import io
+import os
+import re
+import struct
+import threading
+import zipfile
+import zlib
+from bisect import bisect_left, bisect_right
+from xml.sax.saxutils import escape
+
+from template_cache import template_cache
+
+_ROW_RE = re.compile(r'<row\b[^>]*?(?:/>|>.*?</row>)', re.S)
+_ROW_OPEN_RE = re.compile(r'<row\b[^>]*?(/?)>')
+_ROW_NUM_RE = re.compile(r'\br="(\d+)"')
+_CELL_RE = re.compile(r'<c\b([^>]*?)(?:/>|>.*?</c>)', re.S)
+_CELL_REF_RE = re.compile(r'\sr="([A-Z]+)\d+"')
+_CELL_TYPE_RE = re.compile(r'\st="[^"]*"')
+_DIMENSION_RE = re.compile(r'<dimension ref="([A-Z]+\d+):([A-Z]+)(\d+)"/>')
+_ILLEGAL_XML_RE = re.compile('[\x00-\x08\x0b\x0c\x0e-\x1f\ufffe\uffff]')
+# The row number in a <row> or <c> tag's r attribute
+_ROW_REF_RE = re.compile(r'(<(?:row|c)\b[^>]*?\sr="[A-Z]*)\d+"')
+
+
+def column_letter(col):
+    letters = ''
+    while col:
+        col, rem = divmod(col - 1, 26)
+        letters = chr(65 + rem) + letters
+    return letters
+
+
+def column_index(letters):
+    col = 0
+    for ch in letters:
+        col = col * 26 + ord(ch) - 64
+    return col
+
+
+def renumber_row(row_xml, num):
+    """Move a rendered row to row num."""
+    return _ROW_REF_RE.sub(lambda m: f'{m.group(1)}{num}"', row_xml)
+
+
+def cell_xml(ref, attrs, value):
+    """Serialize one cell; strings are written inline so sharedStrings.xml is untouched."""
+    if isinstance(value, (int, float)) and not isinstance(value, bool) and value == value \
+            and value not in (float('inf'), float('-inf')):
+        return f'<c r="{ref}"{attrs}><v>{value!r}</v></c>'
+    text = _ILLEGAL_XML_RE.sub('', str(value))
+    space = ' xml:space="preserve"' if text != text.strip() else ''
+    return f'<c r="{ref}"{attrs} t="inlineStr"><is><t{space}>{escape(text)}</t></is></c>'
+
+
+class _Member:
+    """A zip member whose compressed bytes are copied as-is."""
+
+    def __init__(self, info, raw):
+        self.name = info.filename.encode('utf-8')
+        self.flags = info.flag_bits & 0x800
+        self.method = info.compress_type
+        self.crc = info.CRC
+        self.raw = raw
+        self.size = info.file_size
+        self.create_version = (info.create_system << 8) | 20
+        self.external_attr = info.external_attr
+        year, month, day, hour, minute, second = info.date_time
+        self.dostime = (hour << 11) | (minute << 5) | (second // 2)
+        self.dosdate = ((year - 1980) << 9) | (month << 5) | day
+
+
+def _read_members(data):
+    members = []
+    with zipfile.ZipFile(io.BytesIO(data)) as zf:
+        for info in zf.infolist():
+            offset = info.header_offset
+            name_len, extra_len = struct.unpack('<HH', data[offset + 26:offset + 30])
+            start = offset + 30 + name_len + extra_len
+            members.append(_Member(info, data[start:start + info.compress_size]))
+    return members
+
+
+def _find_sheet_part(zf, sheet_name):
+    workbook = zf.read('xl/workbook.xml').decode('utf-8')
+    for attrs in re.findall(r'<sheet\b([^>]*)/>', workbook):
+        name = re.search(r'\bname="([^"]*)"', attrs).group(1)
+        if name == escape(sheet_name, {'"': '&quot;'}):
+            rel_id = re.search(r'\br:id="([^"]*)"', attrs).group(1)
+            break
+    else:
+        raise KeyError(f"Worksheet {sheet_name} does not exist.")
+    rels = zf.read('xl/_rels/workbook.xml.rels').decode('utf-8')
+    for attrs in re.findall(r'<Relationship\b([^>]*)/>', rels):
+        if re.search(r'\bId="%s"' % re.escape(rel_id), attrs):
+            target = re.search(r'\bTarget="([^"]*)"', attrs).group(1)
+            return target.lstrip('/') if target.startswith('/') else 'xl/' + target
+    raise KeyError(f"No relationship {rel_id} for worksheet {sheet_name}.")
+
+
+class PatchTemplate:
+    """A template split into the parts an export has to touch.
+
+    Built once per template version. ``render`` rewrites only the rows that
+    receive values in the target sheet; every other zip member is copied
+    byte-for-byte from the template, including ``vbaProject.bin``.
+    """
+
+    def __init__(self, data, sheet_name):
+        self.members = _read_members(data)
+        with zipfile.ZipFile(io.BytesIO(data)) as zf:
+            self.sheet_part = _find_sheet_part(zf, sheet_name)
+            sheet = zf.read(self.sheet_part).decode('utf-8')
+        if '<sheetData/>' in sheet:
+            sheet = sheet.replace('<sheetData/>', '<sheetData></sheetData>')
+        start = sheet.index('>', sheet.index('<sheetData')) + 1
+        end = sheet.index('</sheetData>')
+        self.head = sheet[:start]
+        self.tail = sheet[end:]
+        self.rows = [m.group(0) for m in _ROW_RE.finditer(sheet, start, end)]
+        self.row_numbers = [int(_ROW_NUM_RE.search(row).group(1)) for row in self.rows]
+        self._parsed_rows = {}
+        self._lock = threading.Lock()
+        # Rows past the end of the template reuse the last row's formatting
+        self.last_row = self.row_numbers[-1] if self.rows else 0
+        self.prototype = self._parse_row(len(self.rows) - 1) if self.rows else ('<row r="{}">', {})
+
+    def _parse_row(self, index):
+        parsed = self._parsed_rows.get(index)
+        if parsed is not None:
+            return parsed
+        row = self.rows[index]
+        match = _ROW_OPEN_RE.match(row)
+        open_tag = _ROW_NUM_RE.sub('r="{}"', match.group(0).replace('{', '{{').replace('}', '}}'), 1)
+        if match.group(1):
+            open_tag = open_tag[:-2] + '>'
+        cells = {}
+        for cell in _CELL_RE.finditer(row, match.end()):
+            attrs = cell.group(1)
+            col = column_index(_CELL_REF_RE.search(attrs).group(1))
+            cells[col] = (cell.group(0), _CELL_TYPE_RE.sub('', _CELL_REF_RE.sub('', attrs)))
+        parsed = (open_tag, cells)
+        with self._lock:
+            self._parsed_rows[index] = parsed
+        return parsed
+
+    def _patch_row(self, num, values, index=None):
+        if index is None:
+            open_tag, cells = self.prototype
+            cells = {col: (None, attrs) for col, (_, attrs) in cells.items()}
+        else:
+            open_tag, cells = self._parse_row(index)
+        written = {col: value for col, value in values.items() if value not in ('', None)}
+        out = [open_tag.format(num)]
+        for col in sorted(cells.keys() | written.keys()):
+            if col in written:
+                attrs = cells[col][1] if col in cells else ''
+                out.append(cell_xml(f'{column_letter(col)}{num}', attrs, written[col]))
+            else:
+                original = cells[col][0]
+                if original is None:
+                    original = f'<c r="{column_letter(col)}{num}"{cells[col][1]}/>'
+                out.append(original)
+        out.append('</row>')
+        return ''.join(out)
+
+    def row_xml(self, num, values):
+        """Return row num with values ({column: value}) written, formatted like the template's row."""
+        index = bisect_left(self.row_numbers, num)
+        if index < len(self.rows) and self.row_numbers[index] == num:
+            return self._patch_row(num, values, index)
+        return self._patch_row(num, values)
+
+    def row_format(self, num):
+        """The template's row num without its row number; None where the template has no row.
+
+        Two rows with the same format render the same values the same way,
+        so a rendered row can be moved between them with ``renumber_row``.
+        """
+        index = bisect_left(self.row_numbers, num)
+        if index < len(self.rows) and self.row_numbers[index] == num:
+            return _ROW_REF_RE.sub(lambda m: m.group(1) + '"', self.rows[index])
+        return None
+
+    def render_sheet_rows(self, rows, first_row, row_xml):
+        """Return the sheet XML with ``rows`` applied above first_row and the
+        already rendered rows in ``row_xml`` placed from first_row down."""
+        merger = SheetMerger(self)
+        body = merger.feed(rows)
+        start = bisect_left(self.row_numbers, first_row, merger.position)
+        body.extend(self.rows[merger.position:start])
+        body.extend(row_xml)
+        last_row = first_row + len(row_xml) - 1
+        body.extend(self.rows[bisect_right(self.row_numbers, last_row, start):])
+        head = self.head
+        if last_row > self.last_row:
+            head = _DIMENSION_RE.sub(
+                lambda m: f'<dimension ref="{m.group(1)}:{m.group(2)}{last_row}"/>', head, 1)
+        return ''.join([head, *body, self.tail])
+
+    def render_sheet(self, rows):
+        """Return the sheet XML with ``rows`` ((row, {column: value}), ascending) applied."""
+        merger = SheetMerger(self)
+        body = merger.feed(rows)
+        body.extend(merger.finish())
+        head = self.head
+        if merger.max_row > self.last_row:
+            head = _DIMENSION_RE.sub(
+                lambda m: f'<dimension ref="{m.group(1)}:{m.group(2)}{merger.max_row}"/>', head, 1)
+        return ''.join([head, *body, self.tail])
+
+    def render(self, rows):
+        """Return the filled package as a list of byte chunks."""
+        return self.package({self.sheet_part: self.render_sheet(rows).encode('utf-8')})
+
+    def package(self, replaced):
+        """Zip the template members, substituting the parts in ``replaced``."""
+        chunks = []
+        central = []
+        offset = 0
+        for member in self.members:
+            name = member.name.decode('utf-8')
+            if name in replaced:
+                content = replaced[name]
+                compressor = zlib.compressobj(6, zlib.DEFLATED, -15)
+                raw = compressor.compress(content) + compressor.flush()
+                method, crc, size = zipfile.ZIP_DEFLATED, zlib.crc32(content), len(content)
+            else:
+                raw, method, crc, size = member.raw, member.method, member.crc, member.size
+            header = _local_header(member, member.flags, method, crc, len(raw), size)
+            central.append(_central_header(member, member.flags, method, crc, len(raw), size, offset))
+            chunks.append(header)
+            chunks.append(raw)
+            offset += len(header) + len(raw)
+        chunks.extend(_end_of_package(central, offset))
+        return chunks
+
+
+def _local_header(member, flags, method, crc, compressed_size, size):
+    return struct.pack(
+        '<IHHHHHIIIHH', 0x04034b50, 20, flags, method,
+        member.dostime, member.dosdate, crc, compressed_size, size, len(member.name), 0,
+    ) + member.name
+
+
+def _central_header(member, flags, method, crc, compressed_size, size, offset):
+    return struct.pack(
+        '<IHHHHHHIIIHHHHHII', 0x02014b50, member.create_version, 20, flags, method,
+        member.dostime, member.dosdate, crc, compressed_size, size, len(member.name),
+        0, 0, 0, 0, member.external_attr, offset,
+    ) + member.name
+
+
+def _end_of_package(central, offset):
+    directory = b''.join(central)
+    return [directory, struct.pack(
+        '<IHHHHIIH', 0x06054b50, 0, 0, len(central), len(central), len(directory), offset, 0)]
+
+
+class SheetMerger:
+    """Merges ascending (row, {column: value}) pairs into a template's rows.
+
+    ``feed`` can be called repeatedly as rows arrive; it returns the XML for
+    every template row up to and including the last row it was given.
+    """
+
+    def __init__(self, template):
+        self.template = template
+        self.position = 0
+        self.max_row = template.last_row
+
+    def feed(self, rows):
+        template = self.template
+        out = []
+        for num, values in rows:
+            index = bisect_left(template.row_numbers, num, self.position)
+            out.extend(template.rows[self.position:index])
+            if index < len(template.rows) and template.row_numbers[index] == num:
+                out.append(template._patch_row(num, values, index))
+                self.position = index + 1
+            else:
+                out.append(template._patch_row(num, values))
+                self.position = index
+            self.max_row = max(self.max_row, num)
+        return out
+
+    def finish(self):
+        out = self.template.rows[self.position:]
+        self.position = len(self.template.rows)
+        return out
+
+
+class PackageStream:
+    """Writes a filled package to ``out`` while its rows are still arriving.
+
+    Members before the sheet part are written straight away, the sheet is
+    deflated incrementally with its sizes in a trailing data descriptor, and
+    the remaining members follow in ``close``. The sheet's <dimension> is
+    dropped since the final row count is not known up front.
+    """
+
+    def __init__(self, template, out):
+        self.template = template
+        self.out = out
+        self.offset = 0
+        self.central = []
+        names = [member.name.decode('utf-8') for member in template.members]
+        index = names.index(template.sheet_part)
+        for member in template.members[:index]:
+            self._copy(member)
+        self.sheet_member = template.members[index]
+        self.remaining = template.members[index + 1:]
+        self.sheet_offset = self.offset
+        self._write(_local_header(
+            self.sheet_member, self.sheet_member.flags | 0x08, zipfile.ZIP_DEFLATED, 0, 0, 0))
+        self.compressor = zlib.compressobj(6, zlib.DEFLATED, -15)
+        self.crc = 0
+        self.size = 0
+        self.compressed_size = 0
+        self.merger = SheetMerger(template)
+        self._write_xml([_DIMENSION_RE.sub('', template.head, 1)])
+
+    def _write(self, data):
+        self.out.write(data)
+        self.offset += len(data)
+
+    def _copy(self, member):
+        self.central.append(_central_header(
+            member, member.flags, member.method, member.crc, len(member.raw), member.size, self.offset))
+        self._write(_local_header(
+            member, member.flags, member.method, member.crc, len(member.raw), member.size))
+        self._write(member.raw)
+
+    def _write_xml(self, pieces):
+        data = ''.join(pieces).encode('utf-8')
+        self.crc = zlib.crc32(data, self.crc)
+        self.size += len(data)
+        self._write_compressed(self.compressor.compress(data))
+
+    def _write_compressed(self, data):
+        if data:
+            self.compressed_size += len(data)
+            self._write(data)
+
+    def write_rows(self, rows):
+        """Write ascending (row, {column: value}) pairs."""
+        self._write_xml(self.merger.feed(rows))
+
+    def close(self):
+        self._write_xml(self.merger.finish() + [self.template.tail])
+        self._write_compressed(self.compressor.flush())
+        self._write(struct.pack('<IIII', 0x08074b50, self.crc, self.compressed_size, self.size))
+        self.central.append(_central_header(
+            self.sheet_member, self.sheet_member.flags | 0x08, zipfile.ZIP_DEFLATED,
+            self.crc, self.compressed_size, self.size, self.sheet_offset))
+        for member in self.remaining:
+            self._copy(member)
+        for chunk in _end_of_package(self.central, self.offset):
+            self._write(chunk)
+
+
+_patch_templates = {}
+_patch_templates_lock = threading.Lock()
+
+
+def get_patch_template(template_path, sheet_name):
+    """Return the PatchTemplate for the current version of template_path."""
+    key = (os.path.abspath(template_path), sheet_name)
+    version = template_cache.version(template_path)
+    with _patch_templates_lock:
+        cached = _patch_templates.get(key)
+    if cached and cached[0] == version:
+        return cached[1]
+    patch_template = PatchTemplate(template_cache.template_bytes(template_path), sheet_name)
+    with _patch_templates_lock:
+        _patch_templates[key] = (version, patch_template)
+    return patch_template